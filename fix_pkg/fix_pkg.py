@@ -1,39 +1,423 @@
 #!/usr/bin/env python3
 
+""" Fixes the prefix of the paths in pkgconfig .pc files """
+
 import sys
+import os
+import argparse
+import concurrent.futures
+import re
+import tempfile
 
-filename = sys.argv[1]
-if len(sys.argv) > 2:
-    prefix = sys.argv[2]
-    if prefix.endswith('/usr'):
-        prefix = prefix[:-4]
-else:
-    prefix = None
+# a variable definition, like "libdir=${prefix}/lib"
+VARIABLE_REGEX = re.compile(r"^([A-Za-z0-9_.]+)(\s*=\s*)(.*?)(\s*)$", re.DOTALL)
+# a field, like "Cflags: -I${includedir}"
+FIELD_REGEX = re.compile(r"^([A-Za-z0-9_.]+)(\s*:\s*)(.*?)(\s*)$", re.DOTALL)
+# an absolute path in /usr, alone or as the argument of -I or -L, at the start of a word
+USR_PATH_REGEX = re.compile(r"(^|\s)(-I|-L)?(?=/usr(/|\s|$))")
+# the fields that contain paths; the others (Name, Description...) are just text
+PATH_FIELDS = {"Cflags", "Cflags.private", "Libs", "Libs.private"}
+# text files that usually contain build-time paths: pkgconfig, libtool, CMake configs, desktop entries and services
+RELOCATABLE_SUFFIXES = (".pc", ".la", ".cmake", ".desktop", ".service")
+# folders whose scripts (like the gdbus-codegen wrapper) can contain build-time paths
+SCRIPT_FOLDERS = {"bin", "sbin", "libexec"}
+# what can follow a replaced path, so /snap/foo/current doesn't match inside /snap/foo/current2
+PATH_END_REGEX = rb"(?=[/\s\"':;,)]|$)"
+
+
+class PcLine:
+    """A line of a .pc file
+
+    Attributes
+    ----------
+    kind : string
+        "variable", "field" or "other" (comments, empty lines...).
+    name : string or None
+        The name of the variable or the field.
+    value : string or None
+        The value of the variable or the field.
+    text : string
+        The original line, including the end of line.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.kind = "other"
+        self.name = None
+        self.value = None
+        self._separator = None
+        self._end = None
+        if text.lstrip().startswith("#"):
+            return
+        for kind, regex in [("variable", VARIABLE_REGEX), ("field", FIELD_REGEX)]:
+            match = regex.match(text)
+            if match is not None:
+                self.kind = kind
+                self.name, self._separator, self.value, self._end = match.groups()
+                return
+
+    def set_value(self, value):
+        """Changes the value, keeping the format of the rest of the line"""
+        if value != self.value:
+            self.value = value
+            self.text = f"{self.name}{self._separator}{value}{self._end}"
+
+
+def parse_pc(content):
+    """Parses the content of a .pc file
+
+    Parameters
+    ----------
+    content : string
+        The content of the file.
+
+    Returns
+    -------
+    array of PcLine
+        One element for each line of the file.
+    """
+    return [PcLine(line) for line in content.splitlines(keepends=True)]
+
+
+def add_prefix(value):
+    """Adds ${prefix} before each path in /usr inside a value
+
+    Only the words that are a path in /usr, or a -I or -L option with a
+    path in /usr, are changed; values like -DDATADIR=/usr/share are kept.
+
+    Parameters
+    ----------
+    value : string
+        The value of a variable or a field.
 
-with open(filename, "r") as pcfile:
-    lines = pcfile.readlines()
+    Returns
+    -------
+    string
+        The new value.
+    """
+    return USR_PATH_REGEX.sub(lambda match: f"{match.group(1)}{match.group(2) or ''}${{prefix}}", value)
 
-if prefix:
-    # remove any prefix entry
-    newlines = []
+
+def fix_pc_content(content, prefix=None):
+    """Fixes the paths of the content of a .pc file
+
+    Parameters
+    ----------
+    content : string
+        The content of the file.
+    prefix : string or None, optional
+        The new value of the prefix variable, or None to keep it.
+
+    Returns
+    -------
+    string
+        The new content.
+    """
+    lines = parse_pc(content)
+    if prefix:
+        # remove any prefix entry and add the new prefix
+        lines = [PcLine(f'prefix={prefix}\n')] + [line for line in lines
+                                                  if line.kind != "variable" or line.name != "prefix"]
     for line in lines:
-        if line.startswith("prefix="):
+        # the prefix variable can't point to itself
+        if (line.kind == "variable" and line.name != "prefix") or (line.kind == "field" and line.name in PATH_FIELDS):
+            line.set_value(add_prefix(line.value))
+    return "".join(line.text for line in lines)
+
+
+def normalize_prefix(prefix):
+    """Removes the final /usr from a prefix, since it is already in the paths"""
+    if prefix and prefix.endswith('/usr'):
+        prefix = prefix[:-4]
+    return prefix
+
+
+def fix_pc_file(filename, prefix=None):
+    """Fixes the paths in a .pc file
+
+    The file is replaced only if its content changes.
+
+    Parameters
+    ----------
+    filename : string
+        The path of the .pc file.
+    prefix : string or None, optional
+        The new value of the prefix variable, or None to keep it.
+
+    Returns
+    -------
+    bool
+        True if the file has been changed.
+    """
+    # replace the file pointed by a symlink, not the symlink itself
+    filename = os.path.realpath(filename)
+    with open(filename, "r") as pcfile:
+        content = pcfile.read()
+    new_content = fix_pc_content(content, prefix)
+    if new_content == content:
+        return False
+    _write_atomically(filename, new_content.encode())
+    return True
+
+
+def _write_atomically(filename, data):
+    """Replaces a file with a new one with the same permissions, so other
+    processes never read a partially written file."""
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+    try:
+        with os.fdopen(descriptor, "wb") as temporary_file:
+            temporary_file.write(data)
+            os.fchmod(temporary_file.fileno(), os.stat(filename).st_mode & 0o7777)
+        os.replace(temporary_path, filename)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def find_pc_files(paths):
+    """Returns the .pc files in a list of files and folders
+
+    The folders are walked recursively, and the .pc files inside any
+    pkgconfig folder (like lib/x86_64-linux-gnu/pkgconfig or
+    share/pkgconfig) are returned.
+
+    Parameters
+    ----------
+    paths : array of strings
+        Paths of .pc files, pkgconfig folders or folders that contain them
+        (like the stage).
+
+    Returns
+    -------
+    array of strings
+        The paths of the .pc files, without duplicates.
+    """
+    pc_files = {}
+    for path in paths:
+        if not os.path.isdir(path):
+            pc_files[path] = None
             continue
-        newlines.append(line)
+        for folder, subfolders, files in os.walk(path):
+            subfolders.sort()
+            if os.path.basename(folder) != "pkgconfig":
+                continue
+            for filename in sorted(files):
+                if filename.endswith(".pc"):
+                    pc_files[os.path.join(folder, filename)] = None
+    return list(pc_files)
+
+
+def fix_pc_files(paths, prefix=None, jobs=None, verbose=False):
+    """Fixes all the .pc files in a list of files and folders
+
+    Parameters
+    ----------
+    paths : array of strings
+        Paths of .pc files or of folders that contain them (see
+        find_pc_files()).
+    prefix : string or None, optional
+        The new value of the prefix variable, or None to keep it.
+    jobs : int or None, optional
+        Number of threads, or None to use one per CPU.
+    verbose : bool, optional
+        Show each file changed, by default False.
+
+    Returns
+    -------
+    tuple of int
+        The number of .pc files found and the number of them changed.
+    """
+    pc_files = find_pc_files(paths)
+    changed_files = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for filename, changed in zip(pc_files, executor.map(lambda filename: fix_pc_file(filename, prefix),
+                                                            pc_files)):
+            if changed:
+                changed_files += 1
+                if verbose:
+                    print(f"Fixing file {filename}")
+    return len(pc_files), changed_files
+
+
+class Relocator:
+    """Replaces build-time paths in the text files of a folder
+
+    All the old paths are searched at once, with a single regular expression
+    that has an alternative for each one (the longest first), so each file
+    is scanned only once, whatever the number of replacements is. The .pc
+    files are also fixed with fix_pc_content() when a prefix is given.
+
+    Parameters
+    ----------
+    replacements : dictionary
+        For each old path (like /snap/gnome-46-2404-sdk/current), the new
+        one.
+    prefix : string or None, optional
+        The new value of the prefix variable of the .pc files, or None to
+        keep it.
+    """
+
+    def __init__(self, replacements, prefix=None):
+        self.prefix = prefix
+        self._replacements = {old.encode(): new.encode() for old, new in replacements.items() if old}
+        self._regex = None
+        if self._replacements:
+            old_paths = sorted(self._replacements, key=len, reverse=True)
+            self._regex = re.compile(b"(?:" + b"|".join(re.escape(old) for old in old_paths) + b")" + PATH_END_REGEX)
+
+    @staticmethod
+    def is_candidate(relative_folder, filename):
+        """Checks if a file can contain build-time paths, by its name and folder"""
+        if filename.endswith(RELOCATABLE_SUFFIXES):
+            return True
+        return not SCRIPT_FOLDERS.isdisjoint(relative_folder.split(os.sep))
+
+    def find_files(self, paths):
+        """Returns the candidate files inside a list of folders
+
+        Each folder is walked once, without following symlinks and skipping
+        the hidden files and folders; only the names are checked.
+        """
+        files_found = []
+        for path in paths:
+            for folder, subfolders, files in os.walk(path):
+                subfolders[:] = sorted(subfolder for subfolder in subfolders if not subfolder.startswith("."))
+                relative_folder = os.path.relpath(folder, path)
+                for filename in sorted(files):
+                    full_path = os.path.join(folder, filename)
+                    if (not filename.startswith(".") and self.is_candidate(relative_folder, filename) and
+                            not os.path.islink(full_path)):
+                        files_found.append(full_path)
+        return files_found
+
+    def relocate_content(self, data, is_pc=False):
+        """Returns the content of a file with the paths replaced
+
+        Parameters
+        ----------
+        data : bytes
+            The content of the file.
+        is_pc : bool, optional
+            Whether the file is a .pc file, whose paths are also fixed with
+            fix_pc_content() if there is a prefix, by default False.
+
+        Returns
+        -------
+        bytes
+            The new content.
+        """
+        if self._regex is not None:
+            data = self._regex.sub(lambda match: self._replacements[match.group(0)], data)
+        if is_pc and self.prefix is not None:
+            try:
+                data = fix_pc_content(data.decode(), self.prefix).encode()
+            except UnicodeDecodeError:
+                pass
+        return data
+
+    def relocate_file(self, filename):
+        """Replaces the paths in a file, writing it only if it changes
+
+        The files in the script folders are changed only if they are text
+        scripts (they start with #!), and binary files are never changed.
+
+        Returns
+        -------
+        bool
+            True if the file has been changed.
+        """
+        with open(filename, "rb") as relocated_file:
+            # don't read the whole binaries in the script folders
+            if not filename.endswith(RELOCATABLE_SUFFIXES) and relocated_file.read(2) != b"#!":
+                return False
+            relocated_file.seek(0)
+            data = relocated_file.read()
+        if b"\0" in data:
+            return False
+        new_data = self.relocate_content(data, filename.endswith(".pc"))
+        if new_data == data:
+            return False
+        _write_atomically(filename, new_data)
+        return True
+
+    def relocate(self, paths, jobs=None, verbose=False):
+        """Replaces the paths in all the candidate files inside a list of folders
+
+        Parameters
+        ----------
+        paths : array of strings
+            The folders to walk, usually the stage.
+        jobs : int or None, optional
+            Number of threads, or None to use one per CPU.
+        verbose : bool, optional
+            Show each file changed, by default False.
+
+        Returns
+        -------
+        tuple of int
+            The number of candidate files found and the number of them
+            changed.
+        """
+        files_found = self.find_files(paths)
+        changed_files = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for filename, changed in zip(files_found, executor.map(self.relocate_file, files_found)):
+                if changed:
+                    changed_files += 1
+                    if verbose:
+                        print(f"Fixing file {filename}")
+        return len(files_found), changed_files
+
+
+def parse_replacements(rules):
+    """Converts a list of OLD=NEW rules into a dictionary
+
+    Raises
+    ------
+    ValueError
+        If a rule doesn't contain '=' or its old path is empty.
+    """
+    replacements = {}
+    for rule in rules:
+        old, separator, new = rule.partition("=")
+        if not separator or not old:
+            raise ValueError(f"Wrong replacement '{rule}'; it must be OLD=NEW")
+        replacements[old] = new
+    return replacements
 
-    # add the new prefix
-    lines = [f'prefix={prefix}\n'] + newlines
 
-# ensure that the specified entries begin with "${prefix}"
+def run():
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("-"):
+        # fix_pkg.py FILE [PREFIX]
+        fix_pc_file(sys.argv[1], normalize_prefix(sys.argv[2] if len(sys.argv) > 2 else None))
+        return
+    parser = argparse.ArgumentParser(prog="fix_pkg", description="Fixes the prefix of the paths in .pc files")
+    modes = parser.add_mutually_exclusive_group(required=True)
+    modes.add_argument('--batch', nargs='+',
+                       help="The .pc files, pkgconfig folders or folders with pkgconfig folders to fix")
+    modes.add_argument('--relocate', nargs='+',
+                       help="The folders (usually the stage) with .pc, .la, CMake, .desktop, .service and script "
+                            "files to fix")
+    parser.add_argument('-r', '--replace', nargs='+', default=[],
+                        help="Paths to replace in --relocate mode, as OLD=NEW (like "
+                             "/snap/gnome-46-2404-sdk/current=/snap/gnome-46-2404/current)")
+    parser.add_argument('-p', '--prefix', default=None, help="The new prefix, usually $CRAFT_STAGE")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of threads (by default, one per CPU)")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help="Show each file changed")
+    args = parser.parse_args()
+    if args.relocate:
+        try:
+            replacements = parse_replacements(args.replace)
+        except ValueError as error:
+            parser.error(str(error))
+        relocator = Relocator(replacements, normalize_prefix(args.prefix))
+        found_files, changed_files = relocator.relocate(args.relocate, args.jobs, args.verbose)
+        print(f"Fixed {changed_files} of {found_files} files")
+        return
+    found_files, changed_files = fix_pc_files(args.batch, normalize_prefix(args.prefix), args.jobs, args.verbose)
+    print(f"Fixed {changed_files} of {found_files} .pc files")
 
-newlines = []
-for line in lines:
-    pos = line.find(f'=/usr')
-    if pos != -1:
-        if not line[pos+1:].startswith('${prefix}'):
-            line = line[:pos+1] + '${prefix}' + line[pos+1:]
-    newlines.append(line)
-lines = newlines
 
-with open(filename, "w") as pcfile:
-    pcfile.writelines(lines)
\ No newline at end of file
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import os
+import fix_pkg
+import shutil
+import unittest
+import tempfile
+
+PC_CONTENT = """prefix=/usr
+exec_prefix=${prefix}
+libdir=/usr/lib/x86_64-linux-gnu
+includedir=${prefix}/include
+datadir = /usr/share
+
+Name: foo
+Description: The foo library, installed in /usr
+Version: 1.0
+Cflags: -I${includedir}/foo -I/usr/include/foo-private -DDATADIR=/usr/share/foo
+Libs: -L/usr/lib/x86_64-linux-gnu/foo -lfoo
+"""
+
+
+class TestFixPkg(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._folder)
+
+    def _write(self, path, content):
+        full_path = os.path.join(self._folder, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w") as pcfile:
+            pcfile.write(content)
+        return full_path
+
+    def _read(self, full_path):
+        with open(full_path, "r") as pcfile:
+            return pcfile.read()
+
+    def test_parse_pc(self):
+        lines = fix_pkg.parse_pc(PC_CONTENT)
+        self.assertEqual(len(lines), 11)
+        self.assertEqual((lines[4].kind, lines[4].name, lines[4].value), ("variable", "datadir", "/usr/share"))
+        self.assertEqual(lines[5].kind, "other")
+        self.assertEqual((lines[7].kind, lines[7].name, lines[7].value),
+                         ("field", "Description", "The foo library, installed in /usr"))
+
+    def test_fix_pc_content(self):
+        self.assertEqual(fix_pkg.fix_pc_content(PC_CONTENT, "/stage"), """prefix=/stage
+exec_prefix=${prefix}
+libdir=${prefix}/usr/lib/x86_64-linux-gnu
+includedir=${prefix}/include
+datadir = ${prefix}/usr/share
+
+Name: foo
+Description: The foo library, installed in /usr
+Version: 1.0
+Cflags: -I${includedir}/foo -I${prefix}/usr/include/foo-private -DDATADIR=/usr/share/foo
+Libs: -L${prefix}/usr/lib/x86_64-linux-gnu/foo -lfoo
+""")
+        # without a new prefix, the prefix variable is kept as is
+        self.assertTrue(fix_pkg.fix_pc_content(PC_CONTENT).startswith("prefix=/usr\n"))
+        fixed_content = fix_pkg.fix_pc_content(PC_CONTENT, "/stage")
+        self.assertEqual(fix_pkg.fix_pc_content(fixed_content, "/stage"), fixed_content)
+
+    def test_normalize_prefix(self):
+        self.assertEqual(fix_pkg.normalize_prefix("/stage/usr"), "/stage")
+        self.assertEqual(fix_pkg.normalize_prefix("/stage"), "/stage")
+        self.assertIsNone(fix_pkg.normalize_prefix(None))
+
+    def test_fix_pc_files(self):
+        pc_files = [self._write("stage/usr/lib/x86_64-linux-gnu/pkgconfig/foo.pc", PC_CONTENT),
+                    self._write("stage/usr/share/pkgconfig/bar.pc", "prefix=/stage\nlibdir=${prefix}/lib\n"),
+                    self._write("stage/usr/share/doc/foo/example.pc", PC_CONTENT)]
+        os.chmod(pc_files[0], 0o640)
+        mtime = os.stat(pc_files[1]).st_mtime_ns
+        self.assertEqual(fix_pkg.fix_pc_files([os.path.join(self._folder, "stage")], "/stage", 2), (2, 1))
+        self.assertEqual(self._read(pc_files[0]), fix_pkg.fix_pc_content(PC_CONTENT, "/stage"))
+        self.assertEqual(os.stat(pc_files[0]).st_mode & 0o777, 0o640)
+        # unchanged files aren't written
+        self.assertEqual(os.stat(pc_files[1]).st_mtime_ns, mtime)
+        # only the files inside pkgconfig folders are searched
+        self.assertEqual(self._read(pc_files[2]), PC_CONTENT)
+        self.assertEqual(fix_pkg.fix_pc_files([pc_files[2]], "/stage"), (1, 1))
+
+    def test_relocate(self):
+        sdk = "/snap/gnome-46-2404-sdk/current"
+        build = "/root/parts/foo/install"
+        files = {"stage/usr/lib/x86_64-linux-gnu/libfoo.la":
+                 f"libdir='{sdk}/usr/lib'\ndependency_libs=' {build}/usr/lib/libbar.la'\n",
+                 "stage/usr/lib/cmake/Foo/FooConfig.cmake": f'set(FOO_INCLUDE "{build}/usr/include")\n',
+                 "stage/usr/share/applications/foo.desktop": f"[Desktop Entry]\nExec={sdk}/usr/bin/foo\n",
+                 "stage/usr/share/dbus-1/services/foo.service": "[D-BUS Service]\nExec=/usr/bin/foo\n",
+                 "stage/usr/bin/gdbus-codegen":
+                 f"#!/usr/bin/python3\nsys.path.insert(0, '{sdk}/usr/share/glib-2.0')\n",
+                 "stage/usr/bin/data": f"{sdk}\n",
+                 "stage/usr/share/foo/readme.txt": f"{sdk}\n",
+                 "stage/usr/lib/pkgconfig/foo.pc": f"prefix=/usr\nlibdir={build}/usr/lib\n"}
+        for path, content in files.items():
+            self._write(path, content)
+        replacements = fix_pkg.parse_replacements([f"{sdk}=/snap/gnome-46-2404/current", f"{build}/usr=/usr",
+                                                   f"{build}=/stage"])
+        relocator = fix_pkg.Relocator(replacements, "/stage")
+        self.assertEqual(relocator.relocate([os.path.join(self._folder, "stage")], 2), (7, 5))
+        path = os.path.join(self._folder, "stage/usr/lib/x86_64-linux-gnu/libfoo.la")
+        self.assertEqual(self._read(path), "libdir='/snap/gnome-46-2404/current/usr/lib'\n"
+                                           "dependency_libs=' /usr/lib/libbar.la'\n")
+        path = os.path.join(self._folder, "stage/usr/lib/pkgconfig/foo.pc")
+        self.assertEqual(self._read(path), "prefix=/stage\nlibdir=${prefix}/usr/lib\n")
+        path = os.path.join(self._folder, "stage/usr/bin/gdbus-codegen")
+        self.assertIn("'/snap/gnome-46-2404/current/usr/share/glib-2.0'", self._read(path))
+        # not scripts nor candidate files
+        for path in ["stage/usr/bin/data", "stage/usr/share/foo/readme.txt"]:
+            self.assertEqual(self._read(os.path.join(self._folder, path)), files[path])
+        self.assertRaises(ValueError, fix_pkg.parse_replacements, ["/usr"])
+
+    def test_relocate_without_prefix(self):
+        build = "/root/parts/foo/install"
+        path = self._write("stage/usr/lib/pkgconfig/foo.pc",
+                           f"prefix=/usr\nlibdir=/usr/lib\nincludedir={build}/usr/include\n")
+        relocator = fix_pkg.Relocator({f"{build}/usr": "/usr"})
+        self.assertEqual(relocator.relocate([os.path.join(self._folder, "stage")]), (1, 1))
+        # only the build paths are replaced
+        self.assertEqual(self._read(path), "prefix=/usr\nlibdir=/usr/lib\nincludedir=/usr/include\n")
+
+    def test_relocate_path_boundary(self):
+        relocator = fix_pkg.Relocator({"/snap/sdk/current": "/snap/runtime/current", "/snap/sdk": "/snap/other"})
+        for content, relocated in [(b"/snap/sdk/current/usr", b"/snap/runtime/current/usr"),
+                                   (b"'/snap/sdk/current'", b"'/snap/runtime/current'"),
+                                   (b"PATH=/snap/sdk/current:/usr", b"PATH=/snap/runtime/current:/usr"),
+                                   (b"/snap/sdk/current", b"/snap/runtime/current"),
+                                   (b"/snap/sdk/currentX/usr", b"/snap/other/currentX/usr"),
+                                   (b"/snap/sdk2/current", b"/snap/sdk2/current")]:
+            self.assertEqual(relocator.relocate_content(content), relocated)
+
+
+if __name__ == '__main__':
+    unittest.main()
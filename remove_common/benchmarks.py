@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+""" Micro-benchmarks for remove_common """
+
+import os
+import sys
+import fnmatch
+import shutil
+import tempfile
+import time
+import timeit
+import remove_common
+
+LOCALES = ["de", "es", "fr", "it", "ja", "pt_BR", "ru", "zh_CN", "zh_TW", "ko", "nl", "pl", "sv", "fi", "da"]
+
+
+def generate_paths(count):
+    """Returns a list of paths similar to the ones in a stage-packages install"""
+    paths = []
+    folders = ["usr/lib/x86_64-linux-gnu", "usr/share/doc/package{}", "usr/share/locale/{}/LC_MESSAGES",
+               "usr/share/icons/hicolor/{}x{}/apps", "usr/lib/x86_64-linux-gnu/girepository-1.0", "usr/bin"]
+    for number in range(count):
+        folder = folders[number % len(folders)]
+        folder = folder.format(LOCALES[number % len(LOCALES)], number % 7)
+        paths.append(f"{folder}/file{number}.{['so', 'mo', 'png', 'typelib', 'txt'][number % 5]}")
+    return paths
+
+
+def generate_rules():
+    """Returns an exclude list like the ones used for locale, icon and typelib trees"""
+    rules = list(remove_common.global_excludes)
+    rules += [f"usr/share/locale/{locale}/*" for locale in LOCALES]
+    rules += [f"usr/share/icons/hicolor/{size}x{size}/*" for size in [16, 22, 24, 32, 48, 64, 128, 256]]
+    rules += ["usr/lib/*/girepository-1.0/Gtk*.typelib", "usr/lib/*/libgtk-*.so*", "usr/share/doc/*/changelog*"]
+    return rules
+
+
+def exclude_loop(paths, rules):
+    """The way remove_common checked the exclude rules before ExcludeMatcher"""
+    excluded = 0
+    for path in paths:
+        for rule in rules:
+            if fnmatch.fnmatch(path, rule):
+                excluded += 1
+                break
+    return excluded
+
+
+def exclude_matcher(paths, rules):
+    matcher = remove_common.ExcludeMatcher(rules)
+    excluded = 0
+    for path in paths:
+        if matcher.is_excluded(path):
+            excluded += 1
+    return excluded
+
+
+def benchmark_exclude(count=100000):
+    paths = generate_paths(count)
+    rules = generate_rules()
+    assert exclude_loop(paths, rules) == exclude_matcher(paths, rules)
+    loop_time = min(timeit.repeat(lambda: exclude_loop(paths, rules), number=1, repeat=3))
+    matcher_time = min(timeit.repeat(lambda: exclude_matcher(paths, rules), number=1, repeat=3))
+    print(f"Exclude rules: {len(paths)} paths, {len(rules)} rules")
+    print(f"  fnmatch loop:   {loop_time:.3f} s")
+    print(f"  ExcludeMatcher: {matcher_time:.3f} s ({loop_time / matcher_time:.1f}x)")
+
+
+def create_extensions(base_folder, paths):
+    """Creates three extensions: one with the libraries, one with the icons and one with the rest"""
+    extensions = [(os.path.join(base_folder, name), map_path)
+                  for name, map_path in [("core24", None), ("gnome-46", None), ("gtk-common-themes", "usr/")]]
+    for number, path in enumerate(paths):
+        if number % 3 == 0:
+            # the files that aren't in any extension, like the ones from the stage
+            continue
+        if path.startswith("usr/share/icons/"):
+            full_path = os.path.join(extensions[2][0], path[len("usr/"):])
+        elif path.startswith("usr/lib/"):
+            full_path = os.path.join(extensions[0][0], path)
+        else:
+            full_path = os.path.join(extensions[1][0], path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        open(full_path, "w").close()
+    return extensions
+
+
+def benchmark_probes(count=20000):
+    base_folder = tempfile.mkdtemp()
+    try:
+        paths = generate_paths(count)
+        extensions = create_extensions(base_folder, paths)
+
+        def fixed_order():
+            return sum(1 for path in paths if remove_common.check_if_exists(extensions, path, False))
+
+        def planned():
+            planner = remove_common.ProbePlanner(extensions)
+            found = 0
+            probes = 0
+            for path in paths:
+                copies, path_probes = planner.find(path)
+                found += len(copies)
+                probes += path_probes
+            return found, probes
+
+        found, probes = planned()
+        assert fixed_order() == found
+        fixed_time = min(timeit.repeat(fixed_order, number=1, repeat=3))
+        planned_time = min(timeit.repeat(planned, number=1, repeat=3))
+        print(f"Extension probes: {len(paths)} paths, {len(extensions)} extensions without index")
+        print(f"  fixed order:  {fixed_time:.3f} s")
+        print(f"  ProbePlanner: {planned_time:.3f} s ({fixed_time / planned_time:.1f}x), "
+              f"{probes / len(paths):.2f} probes per file")
+    finally:
+        shutil.rmtree(base_folder)
+
+
+class SyscallDelay:
+    """Adds a fixed latency to the filesystem calls used to search and remove files
+
+    It simulates a slow filesystem (like overlayfs over a network disk) by
+    sleeping before each call, which, like a real slow syscall, releases
+    the GIL.
+    """
+
+    FUNCTIONS = [(os.path, "exists"), (os.path, "isdir"), (os, "unlink"), (os, "rmdir"), (os, "lstat")]
+
+    def __init__(self, latency):
+        self.latency = latency
+        self._originals = []
+
+    def _delayed(self, function):
+        def delayed_function(*args, **kwargs):
+            time.sleep(self.latency)
+            return function(*args, **kwargs)
+        return delayed_function
+
+    def __enter__(self):
+        for module, name in self.FUNCTIONS:
+            original = getattr(module, name)
+            self._originals.append((module, name, original))
+            setattr(module, name, self._delayed(original))
+        return self
+
+    def __exit__(self, *args):
+        for module, name, original in self._originals:
+            setattr(module, name, original)
+        self._originals = []
+
+
+def benchmark_io_threads(count=5000, latency=0.0002):
+    base_folder = tempfile.mkdtemp()
+    try:
+        paths = generate_paths(count)
+        extensions = create_extensions(base_folder, paths)
+        install_folder = os.path.join(base_folder, "install")
+
+        def create_install_folder():
+            shutil.rmtree(install_folder, ignore_errors=True)
+            for path in paths:
+                os.makedirs(os.path.dirname(os.path.join(install_folder, path)), exist_ok=True)
+                open(os.path.join(install_folder, path), "w").close()
+
+        print(f"I/O threads: {count} files, {latency * 1000000:.0f} us per filesystem call")
+        results = {}
+        for io_threads in [0, 4, 16]:
+            create_install_folder()
+            deduplicator = remove_common.Deduplicator(extensions, io_threads=io_threads)
+            report = remove_common.DedupReport()
+            with SyscallDelay(latency):
+                start = time.perf_counter()
+                deduplicator.process(install_folder, report)
+                elapsed = time.perf_counter() - start
+            results[io_threads] = (report.removed_files, report.removed_folders)
+            print(f"  {io_threads:2} threads: {elapsed:.3f} s")
+        assert len(set(results.values())) == 1
+    finally:
+        shutil.rmtree(base_folder)
+
+
+BENCHMARKS = {"exclude": benchmark_exclude, "probes": benchmark_probes, "io-threads": benchmark_io_threads}
+
+if __name__ == "__main__":
+    for name in (sys.argv[1:] if len(sys.argv) > 1 else BENCHMARKS.keys()):
+        BENCHMARKS[name]()
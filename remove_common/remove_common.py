@@ -8,27 +8,68 @@
 
 import sys
 import os
-import glob
 import argparse
+import concurrent.futures
 import fnmatch
-try:
-    import yaml
-except:
-    print("YAML module not found. Please, add 'python3-yaml' to the 'build-packages' list.")
-    pass
-
-parser = argparse.ArgumentParser(prog="remove_common", description="An utility to remove from snaps files that are already available in extensions")
-parser.add_argument('extension', nargs='*', default=[])
-parser.add_argument('-e', '--exclude', nargs='+', help="A list of files and directories to exclude from checking")
-parser.add_argument('-m', '--map', nargs='+', default=[], help="A list of snap_name:path pairs")
-parser.add_argument('-v', '--verbose', action='store_true', default=False, help="Show extra info")
-parser.add_argument('-q', '--quiet', action='store_true', default=False, help="Don't show any message")
-args = parser.parse_args()
+import hashlib
+import json
+import lzma
+import mmap
+import re
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zlib
 
 # specific case for themed icons
 global_excludes = ['usr/share/icons/*/index.theme']
 global_maps = ['gtk-common-themes:usr']
 
+# version of the on-disk path index format
+INDEX_VERSION = 1
+# maximum number of folder symlinks followed when resolving a path in an index
+MAX_LINK_DEPTH = 16
+# folders modified less than this time (in nanoseconds) before being read are read again
+STAGE_MTIME_MARGIN = 2000000000
+# squashfs format constants
+SQUASHFS_MAGIC = 0x73717368
+SQUASHFS_SUPERBLOCK = struct.Struct("<IIIIIHHHHHHQQQQQQQQ")
+SQUASHFS_DIR = 1
+SQUASHFS_SYMLINK = 3
+SQUASHFS_EXTENDED_DIR = 8
+SQUASHFS_DECOMPRESSORS = {
+    1: zlib.decompress,
+    2: lambda data: lzma.decompress(data, format=lzma.FORMAT_ALONE),
+    4: lzma.decompress,
+}
+# ELF format constants
+ELF_MAGIC = b"\x7fELF"
+# for each class, the format of the header (after e_ident), of a program header and of a dynamic entry
+ELF_HEADERS = {
+    1: ("HHIIIIIHHHHHH", "IIIIIIII", "iI"),
+    2: ("HHIQQQIHHHHHH", "IIQQQQQQ", "qQ"),
+}
+ELF_PT_LOAD = 1
+ELF_PT_DYNAMIC = 2
+ELF_PT_INTERP = 3
+ELF_DT_NULL = 0
+ELF_DT_NEEDED = 1
+ELF_DT_STRTAB = 5
+ELF_DT_STRSZ = 10
+ELF_DT_SONAME = 14
+ELF_DT_RPATH = 15
+ELF_DT_RUNPATH = 29
+# the folders where the dynamic loader searches the libraries, like usr/lib/x86_64-linux-gnu
+LIBRARY_FOLDER_REGEX = re.compile(r"^(usr/)?lib(32|64|x32)?(/[^/]+-linux-gnu[^/]*)?$")
+# number of bytes hashed to discard quickly the files with the same size but different contents
+PARTIAL_HASH_SIZE = 4096
+# libraries usually loaded with dlopen() instead of being linked, which must never be pruned
+DLOPEN_ALLOWLIST = ["*/libnss_*", "*/libGL*", "*/libEGL*", "*/libGLES*", "*/libGLX*", "*/libvulkan*",
+                    "*/libgallium*", "*/libEGL_mesa*", "*/libva-*", "*/libvdpau*", "*/libpulse*", "*/libasound*",
+                    "*/libSegFault*", "*/libmemusage*", "*/libpcprofile*"]
+
 def get_snapcraft_yaml():
     """Returns a string with the full path of the snapcraft file.
 
@@ -50,7 +91,35 @@ def get_snapcraft_yaml():
     return snapcraft_file_path
 
 
-def get_extension_list(cmdline_extensions):
+def load_snapcraft_data():
+    """Reads and parses the snapcraft.yaml file of the project.
+
+    Returns
+    -------
+    dictionary
+        The contents of the snapcraft.yaml file.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the snapcraft.yaml file can't be found.
+    """
+
+    snapcraft_file = get_snapcraft_yaml()
+    if snapcraft_file is None:
+        raise FileNotFoundError("There is no snapcraft.yaml file in the project folder")
+
+    try:
+        import yaml
+    except ImportError:
+        print("YAML module not found. Please, add 'python3-yaml' to the 'build-packages' list.")
+        raise
+
+    with open(snapcraft_file, "r") as snapcraft_stream:
+        return yaml.load(snapcraft_stream, Loader=getattr(yaml, "CLoader", yaml.Loader))
+
+
+def get_extension_list(cmdline_extensions, snapcraft_data=None):
     """Returns an array with the extensions for this project.
 
     Parameters
@@ -58,6 +127,9 @@ def get_extension_list(cmdline_extensions):
     cmdline_extensions : array of strings
         an array with the list of extensions passed by the command line.
         If no extensions were passed, it must be a zero-length array.
+    snapcraft_data : dictionary, optional
+        The contents of the snapcraft.yaml file, as returned by
+        load_snapcraft_data(), or None to read it.
 
     Returns
     -------
@@ -74,12 +146,8 @@ def get_extension_list(cmdline_extensions):
     if len(cmdline_extensions) != 0:
         return cmdline_extensions
 
-    snapcraft_file = get_snapcraft_yaml()
-    if snapcraft_file is None:
-        raise FileNotFoundError("There is no snapcraft.yaml file in the project folder")
-
-    with open(snapcraft_file, "r") as snapcraft_stream:
-        snapcraft_data = yaml.load(snapcraft_stream, Loader=yaml.Loader)
+    if snapcraft_data is None:
+        snapcraft_data = load_snapcraft_data()
     parts_data = snapcraft_data["parts"]
     extensions = []
     for part_name in parts_data:
@@ -92,6 +160,54 @@ def get_extension_list(cmdline_extensions):
     return extensions
 
 
+def get_parts_folder():
+    """Returns the folder where the project parts are stored
+
+    Returns
+    -------
+    string
+        A string with the path where all the parts are stored
+
+    Raises
+    ------
+    Exception
+        The function uses CRAFT_PART_INSTALL environment variable to extract
+        the path for all the parts, so if it has an unexpected format, it
+        won't be able to do it, and raises this exception.
+    """
+    install_folder = os.environ['CRAFT_PART_INSTALL']
+    parts_string = '/parts/'
+    pos = install_folder.rfind(parts_string)
+    if pos == -1:
+        raise Exception("CRAFT_PART_INSTALL has an unrecognized format")
+    return install_folder[:pos + len(parts_string) - 1]  # -1 to remove the trailing '/'
+
+
+def get_parts_install_folders(parts_folder, part_names):
+    """Returns the install folder of each part
+
+    Parameters
+    ----------
+    parts_folder : string
+        The folder where all the parts are stored
+    part_names : iterable of strings
+        The names of the parts
+
+    Returns
+    -------
+    dictionary
+        A dictionary where the key is the part name and the value is the path
+        of its install folder. The parts without an install folder (because
+        they haven't been built yet) aren't included.
+    """
+    folders = {}
+    for part_name in part_names:
+        install_folder = os.path.join(parts_folder, part_name, "install")
+        if os.path.isdir(install_folder):
+            folders[part_name] = install_folder
+    return folders
+
+
 def generate_mappings(predefined_mappings, cmdline_mappings):
     """Parses the specific mappings for each snap
 
@@ -147,7 +263,8 @@ def generate_extensions_paths(extensions, mappings):
     Parameters
     ----------
     extensions : array of strings
-        An array of strings with the names of the extensions used in this snap.
+        An array of strings with the names of the extensions used in this snap,
+        or the paths of their .snap files, if they aren't installed.
     mappings : dictionary
         A dictionary where each key is a string with a snap name and the
         value is another string with the mapping path for that snap, ended
@@ -163,13 +280,617 @@ def generate_extensions_paths(extensions, mappings):
 
     folders = []
     for snap in extensions:
-        path = f"/snap/{snap}/current"
+        if is_snap_image(snap):
+            path = snap
+            snap = os.path.basename(snap)[:-len(".snap")].partition("_")[0]
+        else:
+            path = f"/snap/{snap}/current"
         map_path = mappings[snap] if snap in mappings else None
         folders.append((path, map_path))
     return folders
 
 
-def check_if_exists(extensions_paths, relative_file_path, verbose):
+def get_cache_folder():
+    """Returns the default folder for the persistent path indexes
+
+    The indexes are stored in the user cache folder, so they survive between
+    parts and between builds done in the same container.
+
+    Returns
+    -------
+    string
+        The path of the folder where the indexes must be stored.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "snap-build-tools")
+
+
+def is_snap_image(path):
+    """Checks if an extension path is a .snap file instead of a folder"""
+    return path.endswith(".snap") and os.path.isfile(path)
+
+
+def get_snap_revision(folder):
+    """Returns the snap name and the revision that an extension path points to
+
+    A folder like /snap/gnome-46-2404/current is a symlink to the folder of the
+    installed revision (like /snap/gnome-46-2404/90). Since the contents of a
+    revision never change, it can be used as the key for a persistent index.
+    For .snap files, the name and revision are taken from the file name
+    (like gnome-46-2404_90.snap), or from its size and modification time if
+    the name doesn't contain the revision.
+
+    Parameters
+    ----------
+    folder : string
+        The root path of an extension snap.
+
+    Returns
+    -------
+    tuple of two strings, or None
+        The snap name and its revision, or None if the folder isn't a symlink
+        to a specific revision (like the stage folder), and thus its contents
+        can change.
+    """
+    if is_snap_image(folder):
+        snap_name, _, revision = os.path.basename(folder)[:-len(".snap")].partition("_")
+        if revision == "":
+            image_stat = os.stat(folder)
+            revision = f"{image_stat.st_size}-{image_stat.st_mtime_ns}"
+        return snap_name, revision
+    if not os.path.islink(folder):
+        return None
+    revision = os.path.basename(os.path.realpath(folder))
+    snap_name = os.path.basename(os.path.dirname(os.path.abspath(folder)))
+    return snap_name, revision
+
+
+def _resolve_link_target(relative_link_path, target):
+    """Returns the path, relative to the snap root, pointed by a symlink
+
+    Absolute targets are considered relative to the snap root, and targets
+    pointing outside the snap are discarded.
+    """
+    if target.startswith('/'):
+        full_target = os.path.normpath(target[1:])
+    else:
+        full_target = os.path.normpath(os.path.join(os.path.dirname(relative_link_path), target))
+    if full_target == '.' or full_target.startswith('../') or full_target == '..':
+        return None
+    return full_target
+
+
+def scan_snap_folder(folder):
+    """Walks an extension snap once and returns all the paths inside it
+
+    Parameters
+    ----------
+    folder : string
+        The root path of the extension snap.
+
+    Returns
+    -------
+    tuple with a list of strings and a dictionary
+        The first element is a list with all the paths (files, symlinks and
+        folders) inside the snap, relative to its root. The second element is
+        a dictionary with the symlinks that point to folders, where the key is
+        the path of the symlink and the value is the path of the folder it
+        points to, both relative to the snap root.
+    """
+    paths = []
+    folder_links = {}
+    pending = [""]
+    while len(pending) != 0:
+        relative_folder = pending.pop()
+        try:
+            iterator = os.scandir(os.path.join(folder, relative_folder))
+        except OSError:
+            continue
+        with iterator:
+            for entry in iterator:
+                relative_path = relative_folder + entry.name
+                paths.append(relative_path)
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(relative_path + '/')
+                elif entry.is_symlink() and entry.is_dir():
+                    target = _resolve_link_target(relative_path, os.readlink(entry.path))
+                    if target is not None:
+                        folder_links[relative_path] = target
+    return paths, folder_links
+
+
+class SquashfsImage:
+    """Minimal reader for the metadata of a squashfs image, like a .snap file
+
+    It reads the superblock and then the inode and directory tables in bulk,
+    decompressing each metadata block only when it is needed, which allows
+    to list the contents of a snap without mounting it. File contents aren't
+    supported.
+
+    Parameters
+    ----------
+    image_path : string
+        The path of the squashfs image.
+
+    Raises
+    ------
+    ValueError
+        If the file isn't a squashfs 4.0 image, or it uses an unsupported
+        compression algorithm.
+    """
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+        with open(image_path, "rb") as image_file:
+            superblock = image_file.read(SQUASHFS_SUPERBLOCK.size)
+            if len(superblock) != SQUASHFS_SUPERBLOCK.size:
+                raise ValueError(f"{image_path} is not a squashfs image")
+            (magic, self.inode_count, _, _, _, compression, _, _, _, major, minor, self.root_inode,
+             bytes_used, id_table_start, xattr_table_start, inode_table_start, directory_table_start,
+             fragment_table_start, export_table_start) = SQUASHFS_SUPERBLOCK.unpack(superblock)
+            if magic != SQUASHFS_MAGIC or (major, minor) != (4, 0):
+                raise ValueError(f"{image_path} is not a squashfs 4.0 image")
+            if compression not in SQUASHFS_DECOMPRESSORS:
+                raise ValueError(f"{image_path} uses an unsupported compression algorithm ({compression})")
+            self._decompress = SQUASHFS_DECOMPRESSORS[compression]
+            # the directory table ends where the next table begins
+            directory_table_end = min(position for position in (fragment_table_start, export_table_start,
+                                                                id_table_start, xattr_table_start, bytes_used)
+                                      if position > directory_table_start)
+            image_file.seek(inode_table_start)
+            self._inode_table = image_file.read(directory_table_start - inode_table_start)
+            self._directory_table = image_file.read(directory_table_end - directory_table_start)
+        self._blocks = {}
+
+    def _read_block(self, table, block_start):
+        """Returns the contents of a metadata block and the position of the next one"""
+        key = (id(table), block_start)
+        if key not in self._blocks:
+            header = struct.unpack_from("<H", table, block_start)[0]
+            size = header & 0x7FFF
+            data = table[block_start + 2:block_start + 2 + size]
+            if (header & 0x8000) == 0:
+                data = self._decompress(data)
+            self._blocks[key] = (data, block_start + 2 + size)
+        return self._blocks[key]
+
+    def _read_metadata(self, table, block_start, offset, length):
+        """Reads data from a metadata table, which can span several blocks"""
+        result = b""
+        while length > 0:
+            data, next_block = self._read_block(table, block_start)
+            if offset >= len(data):
+                offset -= len(data)
+            else:
+                chunk = data[offset:offset + length]
+                result += chunk
+                length -= len(chunk)
+                offset = 0
+            block_start = next_block
+        return result
+
+    def _read_inode(self, inode_reference, length):
+        return self._read_metadata(self._inode_table, inode_reference >> 16, inode_reference & 0xFFFF, length)
+
+    def _read_directory(self, inode_reference):
+        """Returns the entries of a folder, as tuples with the name, type and inode reference"""
+        inode_type = struct.unpack("<H", self._read_inode(inode_reference, 2))[0]
+        if inode_type == SQUASHFS_DIR:
+            inode = self._read_inode(inode_reference, 32)
+            block_start, _, file_size, block_offset = struct.unpack_from("<IIHH", inode, 16)
+        elif inode_type == SQUASHFS_EXTENDED_DIR:
+            inode = self._read_inode(inode_reference, 40)
+            _, file_size, block_start, _, _, block_offset = struct.unpack_from("<IIIIHH", inode, 16)
+        else:
+            raise ValueError(f"Inode {inode_reference} in {self.image_path} is not a folder")
+        # the size includes three extra bytes for the '.' and '..' entries
+        listing = self._read_metadata(self._directory_table, block_start, block_offset, file_size - 3)
+        entries = []
+        position = 0
+        while position + 12 <= len(listing):
+            count, inode_block, _ = struct.unpack_from("<III", listing, position)
+            position += 12
+            for _ in range(count + 1):
+                offset, _, entry_type, name_size = struct.unpack_from("<HhHH", listing, position)
+                name = os.fsdecode(listing[position + 8:position + 9 + name_size])
+                position += 9 + name_size
+                entries.append((name, entry_type, (inode_block << 16) | offset))
+        return entries
+
+    def _read_symlink(self, inode_reference):
+        inode = self._read_inode(inode_reference, 24)
+        target_size = struct.unpack_from("<I", inode, 20)[0]
+        return os.fsdecode(self._read_inode(inode_reference, 24 + target_size)[24:])
+
+    def scan(self):
+        """Returns all the paths inside the image
+
+        Returns
+        -------
+        tuple with a list of strings and a dictionary
+            The same than scan_snap_folder() returns for a mounted snap.
+        """
+        paths = []
+        folders = set()
+        symlinks = {}
+        pending = [("", self.root_inode)]
+        while len(pending) != 0:
+            relative_folder, inode_reference = pending.pop()
+            for name, entry_type, entry_reference in self._read_directory(inode_reference):
+                relative_path = relative_folder + name
+                paths.append(relative_path)
+                if entry_type == SQUASHFS_DIR:
+                    folders.add(relative_path)
+                    pending.append((relative_path + '/', entry_reference))
+                elif entry_type == SQUASHFS_SYMLINK:
+                    target = _resolve_link_target(relative_path, self._read_symlink(entry_reference))
+                    if target is not None:
+                        symlinks[relative_path] = target
+        folder_links = {}
+        for link, target in symlinks.items():
+            # follow chains of symlinks to know if they end in a folder
+            for _ in range(MAX_LINK_DEPTH):
+                if target not in symlinks:
+                    break
+                target = symlinks[target]
+            if target in folders:
+                folder_links[link] = symlinks[link]
+        return paths, folder_links
+
+
+class PathIndex:
+    """Set of the paths available inside an extension snap
+
+    The paths are stored already translated with the mapping of the snap, so
+    checking a file from CRAFT_PART_INSTALL is a single set lookup. The symlinks
+    to folders inside the snap are kept apart and resolved only when a lookup
+    fails, to emulate what os.path.exists() does with them.
+
+    Parameters
+    ----------
+    paths : iterable of strings
+        All the paths inside the snap, relative to its root.
+    folder_links : dictionary
+        The symlinks to folders inside the snap, as returned by scan_snap_folder().
+    map_path : string or None
+        The mapping for this snap, ended in '/', or None if no mapping is needed.
+    """
+
+    def __init__(self, paths, folder_links, map_path=None):
+        self.map_path = map_path
+        if map_path is None:
+            self._paths = set(paths)
+            self._folder_links = dict(folder_links)
+            return
+        self._paths = set()
+        for path in paths:
+            self._paths.add(map_path + path)
+            if not path.startswith(map_path):
+                self._paths.add(path)
+        self._folder_links = {}
+        for link, target in folder_links.items():
+            self._folder_links[map_path + link] = map_path + target
+            if not link.startswith(map_path):
+                self._folder_links[link] = map_path + target
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, relative_file_path):
+        return self.find(relative_file_path) is not None
+
+    def find(self, relative_file_path, depth=0):
+        """Searches a path from CRAFT_PART_INSTALL in the index
+
+        Parameters
+        ----------
+        relative_file_path : string
+            The file path, relative to the snap root.
+
+        Returns
+        -------
+        string or None
+            The path where the file has been found (which can differ from
+            `relative_file_path` if it is reached through a folder symlink),
+            or None if the file isn't in the snap.
+        """
+        if relative_file_path in self._paths:
+            return relative_file_path
+        if (len(self._folder_links) == 0) or (depth >= MAX_LINK_DEPTH):
+            return None
+        pos = relative_file_path.find('/')
+        while pos != -1:
+            target = self._folder_links.get(relative_file_path[:pos])
+            if target is not None:
+                return self.find(target + relative_file_path[pos:], depth + 1)
+            pos = relative_file_path.find('/', pos + 1)
+        return None
+
+    def to_snap_path(self, found_path):
+        """Converts a path returned by find() into a path relative to the snap root"""
+        if (self.map_path is not None) and found_path.startswith(self.map_path):
+            return found_path[len(self.map_path):]
+        return found_path
+
+
+def _write_atomically(file_path, data):
+    """Writes a file in a temporary name and renames it, so other processes
+    never read a partially written file."""
+    folder = os.path.dirname(file_path)
+    os.makedirs(folder, exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    try:
+        with os.fdopen(descriptor, "wb") as temporary_file:
+            temporary_file.write(data)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def load_path_index(folder, map_path, cache_folder=None, verbose=False):
+    """Returns the path index for an extension snap
+
+    The index is loaded from the cache folder if there is already one for the
+    revision pointed by `folder`; if not, the snap is walked (or, if `folder`
+    is a .snap file, its squashfs metadata is read) and the index is stored in
+    the cache folder for the next calls. If a .snap file can't be read (like
+    when it uses a compression algorithm not supported by SquashfsImage), the
+    snap mounted in /snap is used instead, and if it isn't installed, the
+    index is empty, so no file is removed because of that snap.
+
+    Parameters
+    ----------
+    folder : string
+        The root path of the extension snap, or the path of its .snap file.
+    map_path : string or None
+        The mapping for this snap, ended in '/', or None if no mapping is needed.
+    cache_folder : string or None
+        The folder where the indexes are stored, or None to not store them.
+    verbose : bool, optional
+        Show extra verbose information, by default False
+
+    Returns
+    -------
+    PathIndex or None
+        The index with all the paths of the snap, or None if `folder` isn't
+        a specific revision of a snap, and thus can't be indexed.
+    """
+    snap_revision = get_snap_revision(folder)
+    if snap_revision is None:
+        return None
+    index_path = None
+    if cache_folder is not None:
+        index_path = os.path.join(cache_folder, f"{snap_revision[0]}_{snap_revision[1]}.index")
+        try:
+            with open(index_path, "rb") as index_file:
+                index_data = json.loads(zlib.decompress(index_file.read()))
+            if index_data["version"] == INDEX_VERSION:
+                if verbose:
+                    print(f"Loaded index for {folder} from {index_path}")
+                return PathIndex(index_data["paths"], index_data["links"], map_path)
+        except (OSError, ValueError, KeyError, zlib.error):
+            pass
+    if is_snap_image(folder):
+        try:
+            paths, folder_links = SquashfsImage(folder).scan()
+        except (OSError, ValueError, struct.error, zlib.error, lzma.LZMAError) as error:
+            mounted_folder = f"/snap/{snap_revision[0]}/current"
+            if not os.path.isdir(mounted_folder):
+                print(f"Can't read {folder}: {error}. Skipping it.")
+                return PathIndex([], {}, map_path)
+            # the mounted revision can be a different one, so its index isn't stored
+            print(f"Can't read {folder}: {error}. Using {mounted_folder} instead.")
+            paths, folder_links = scan_snap_folder(mounted_folder)
+            return PathIndex(paths, folder_links, map_path)
+    else:
+        paths, folder_links = scan_snap_folder(folder)
+    if verbose:
+        print(f"Indexed {len(paths)} paths in {folder}")
+    if index_path is not None:
+        index_data = {"version": INDEX_VERSION, "paths": paths, "links": folder_links}
+        try:
+            _write_atomically(index_path, zlib.compress(json.dumps(index_data).encode("utf-8")))
+        except OSError as error:
+            print(f"Can't store the index for {folder} in {index_path}: {error}")
+    return PathIndex(paths, folder_links, map_path)
+
+
+def load_extensions_indexes(extensions_paths, cache_folder=None, verbose=False):
+    """Returns the path index for each one of the extensions paths
+
+    Parameters
+    ----------
+    extensions_paths : array of tuples with two elements
+        The list of extensions paths, as returned by generate_extensions_paths().
+    cache_folder : string or None
+        The folder where the indexes are stored, or None to not store them.
+    verbose : bool, optional
+        Show extra verbose information, by default False
+
+    Returns
+    -------
+    array of PathIndex
+        An array with the index for each entry in `extensions_paths`, or None
+        for those entries that can't be indexed and must be checked directly
+        in the filesystem.
+    """
+    return [load_path_index(folder, map_path, cache_folder, verbose) for folder, map_path in extensions_paths]
+
+
+class StageIndex:
+    """Incremental index of the paths available in the stage folder
+
+    The stage changes after each part is staged, so its index can't be keyed
+    by a revision like the ones of the base snaps. Instead, it stores the
+    entries of each folder together with the folder modification time, and
+    each folder is checked (with a single stat call) the first time that a
+    lookup needs it; only the folders whose modification time has changed
+    are read again. It is only a cache of the folders; it doesn't know which
+    part staged each file. A part can refresh the folders where it has staged
+    its files with refresh_part(), so the next parts find them up to date.
+
+    Parameters
+    ----------
+    stage_folder : string
+        The path of the stage folder.
+    cache_folder : string or None, optional
+        The folder where the index is stored, or None to not store it.
+    """
+
+    def __init__(self, stage_folder, cache_folder=None):
+        self.stage_folder = stage_folder
+        self.map_path = None
+        self._index_path = None
+        if cache_folder is not None:
+            stage_hash = hashlib.sha1(os.path.realpath(stage_folder).encode("utf-8")).hexdigest()[:16]
+            self._index_path = os.path.join(cache_folder, f"stage-{stage_hash}.index")
+        # the names inside each folder, and the modification time of the folder when it was read
+        self._children = {}
+        self._mtimes = {}
+        self._folder_links = {}
+        self._validated = set()
+        self._lock = threading.Lock()
+        self._modified = False
+        self._load()
+
+    def _load(self):
+        if self._index_path is None:
+            return
+        try:
+            with open(self._index_path, "rb") as index_file:
+                index_data = json.loads(zlib.decompress(index_file.read()))
+            if index_data["version"] != INDEX_VERSION:
+                return
+            self._children = {folder: set(names) for folder, names in index_data["children"].items()}
+            self._mtimes = index_data["mtimes"]
+            self._folder_links = index_data["links"]
+        except (OSError, ValueError, KeyError, zlib.error):
+            pass
+
+    def save(self):
+        """Stores the index in the cache folder, if it has changed"""
+        with self._lock:
+            if (self._index_path is None) or not self._modified:
+                return
+            index_data = {"version": INDEX_VERSION,
+                          "children": {folder: sorted(names) for folder, names in self._children.items()},
+                          "mtimes": self._mtimes,
+                          "links": self._folder_links}
+            try:
+                _write_atomically(self._index_path, zlib.compress(json.dumps(index_data).encode("utf-8")))
+            except OSError as error:
+                print(f"Can't store the stage index in {self._index_path}: {error}")
+            self._modified = False
+
+    def _forget_folder(self, folder):
+        """Removes a folder that doesn't exist anymore in the stage"""
+        for name in self._children.pop(folder, ()):
+            self._folder_links.pop(f"{folder}/{name}" if folder else name, None)
+        self._mtimes.pop(folder, None)
+        self._modified = True
+
+    def _read_folder(self, folder, mtime_ns):
+        """Reads again the entries of a folder in the stage"""
+        self._forget_folder(folder)
+        names = set()
+        with os.scandir(os.path.join(self.stage_folder, folder)) as iterator:
+            for entry in iterator:
+                names.add(entry.name)
+                relative_path = f"{folder}/{entry.name}" if folder else entry.name
+                if entry.is_symlink() and entry.is_dir():
+                    target = _resolve_link_target(relative_path, os.readlink(entry.path))
+                    if target is not None:
+                        self._folder_links[relative_path] = target
+        self._children[folder] = names
+        # a folder modified in the same clock tick than this read could change
+        # again without changing its modification time, so it must be read again
+        if time.time_ns() - mtime_ns < STAGE_MTIME_MARGIN:
+            mtime_ns = 0
+        self._mtimes[folder] = mtime_ns
+
+    def _get_children(self, folder):
+        """Returns the names inside a folder, reading it again if it has changed"""
+        if folder not in self._validated:
+            with self._lock:
+                if folder not in self._validated:
+                    self._validate_folder(folder)
+                    # only marked once it is up to date, because other threads don't take the lock
+                    self._validated.add(folder)
+        return self._children.get(folder)
+
+    def _validate_folder(self, folder):
+        """Checks if a folder has changed since it was read, and reads it again if needed"""
+        try:
+            folder_stat = os.lstat(os.path.join(self.stage_folder, folder))
+        except OSError:
+            folder_stat = None
+        if (folder_stat is None) or not stat.S_ISDIR(folder_stat.st_mode):
+            if (folder in self._children) or (folder in self._mtimes):
+                self._forget_folder(folder)
+            return
+        if self._mtimes.get(folder) != folder_stat.st_mtime_ns:
+            self._read_folder(folder, folder_stat.st_mtime_ns)
+
+    def __contains__(self, relative_file_path):
+        return self.find(relative_file_path) is not None
+
+    def find(self, relative_file_path, depth=0):
+        """Searches a path in the stage
+
+        Parameters
+        ----------
+        relative_file_path : string
+            The file path, relative to the stage root.
+
+        Returns
+        -------
+        string or None
+            The path where the file has been found (which can differ from
+            `relative_file_path` if it is reached through a folder symlink),
+            or None if the file isn't in the stage.
+        """
+        folder, _, name = relative_file_path.rpartition('/')
+        children = self._get_children(folder)
+        if (children is not None) and (name in children):
+            return relative_file_path
+        if depth >= MAX_LINK_DEPTH:
+            return None
+        pos = relative_file_path.find('/')
+        while pos != -1:
+            prefix = relative_file_path[:pos]
+            self._get_children(prefix.rpartition('/')[0])
+            target = self._folder_links.get(prefix)
+            if target is not None:
+                return self.find(target + relative_file_path[pos:], depth + 1)
+            pos = relative_file_path.find('/', pos + 1)
+        return None
+
+    def to_snap_path(self, found_path):
+        return found_path
+
+    def refresh_part(self, install_folder):
+        """Reads again the stage folders where a part has staged its files
+
+        It must be called after the part has been staged. The folders are read
+        even if their modification time hasn't changed.
+
+        Parameters
+        ----------
+        install_folder : string
+            The install folder of the part (usually CRAFT_PART_INSTALL).
+        """
+        folders = {relative_file_path.rpartition('/')[0]
+                   for relative_file_path, _ in walk_install_folder(install_folder)}
+        for folder in sorted(folders):
+            with self._lock:
+                self._validated.discard(folder)
+                self._mtimes.pop(folder, None)
+            self._get_children(folder)
+        self._modified = True
+
+
+def check_if_exists(extensions_paths, relative_file_path, verbose, indexes=None):
     """Checks if an specific file does exist in any of the base paths.
 
     Checks if the specified file at `relative_file_path` does exist in
@@ -193,6 +914,12 @@ def check_if_exists(extensions_paths, relative_file_path, verbose):
     relative_file_path : string
         The file path to search in the folder list, relative to the
         snap root.
+    verbose : bool
+        Show extra verbose information
+    indexes : array of PathIndex, optional
+        The index for each entry in `extensions_paths`, as returned by
+        load_extensions_indexes(). The entries without an index (or all
+        of them if it is None) are checked directly in the filesystem.
 
     Returns
     -------
@@ -200,8 +927,42 @@ def check_if_exists(extensions_paths, relative_file_path, verbose):
         It returns True if the file does exist in, at least, one of the
         specified snaps, and false if it doesn't exist in any of them.
     """
-    # Checks if an specific file does exist in any of the base paths
-    for folder, map_path in extensions_paths:
+    for folder, map_path, snap_path in find_in_extensions(extensions_paths, relative_file_path, indexes):
+        if verbose:
+            print(f"The path {relative_file_path} has been found inside {folder} with map {map_path}: {snap_path}")
+        return True
+    return False
+
+
+def find_in_extensions(extensions_paths, relative_file_path, indexes=None):
+    """Searches a file in each one of the extensions paths.
+
+    This is the search done by check_if_exists(), but it continues after
+    the first extension that contains the file.
+
+    Parameters
+    ----------
+    extensions_paths : array of tuples with two elements
+        The list of extensions paths, as returned by generate_extensions_paths().
+    relative_file_path : string
+        The file path to search in the folder list, relative to the
+        snap root.
+    indexes : array of PathIndex, optional
+        The index for each entry in `extensions_paths`, as returned by
+        load_extensions_indexes().
+
+    Yields
+    ------
+    tuple with three elements
+        The root path of each extension that contains the file, its mapping,
+        and the path of the file relative to that root.
+    """
+    for position, (folder, map_path) in enumerate(extensions_paths):
+        if (indexes is not None) and (indexes[position] is not None):
+            found_path = indexes[position].find(relative_file_path)
+            if found_path is not None:
+                yield folder, map_path, indexes[position].to_snap_path(found_path)
+            continue
         if (map_path is not None) and relative_file_path.startswith(map_path):
             relative_file_path2 = relative_file_path[len(map_path):]
             if relative_file_path2[0] == '/':
@@ -210,93 +971,1975 @@ def check_if_exists(extensions_paths, relative_file_path, verbose):
             relative_file_path2 = relative_file_path
         check_path = os.path.join(folder, relative_file_path2)
         if os.path.exists(check_path):
-            if verbose:
-                print(f"The path {relative_file_path} has been found inside {folder} with map {map_path}: {relative_file_path2}")
-            return True
-    return False
+            yield folder, map_path, relative_file_path2
 
 
-def main(snap_folder, extensions_paths, exclude_list=[], verbose=False, quiet=True):
-    """Main function
-
-    Searches each file in 'snap_folder' inside each path in 'extensions_paths'
-    to check if it is already available there, deleting it in that case, unless
-    it matches any of the rules in 'exclude_list'.
+class ProbePlanner:
+    """Decides in which order the extensions are searched for each file
 
-    The check is done based only on the relative path and file name relative to
-    'snap_folder', searching that inside each path in 'extensions_paths', although
-    taking into account the mapping.
+    Most of the files of a folder are usually found in the same extension
+    (like the icons in gtk-common-themes), so the planner counts, for each
+    folder and its parents, how many files have been found in each extension,
+    and searches first the one with more hits. These statistics are stored in
+    the cache folder, so the next runs start with them. Also, each folder is
+    checked once in each extension, and if it doesn't exist there, the files
+    inside it aren't searched in that extension.
 
     Parameters
     ----------
-    snap_folder : string
-        The path of the folder where the staged .deb have been uncompressed (usually
-        CRAFT_PART_INSTALL)
     extensions_paths : array of tuples with two elements
-        An array with tuples containing each one a string with the root
-        path for one of the extensions snap, and, if required, another
-        string with the mapping for that snap (or None if no mapping is
-        required for that snap).
-    exclude_list : array of strings
-        A list of fnmatch rules for excluding files and/or paths
-    verbose : bool, optional
-        Show extra verbose information, by default False
-    quiet : bool, optional
-        Don't show messages, by default False
+        The list of extensions paths, as returned by generate_extensions_paths().
+    indexes : array of PathIndex or StageIndex, optional
+        The index for each entry in `extensions_paths`, or None for the ones
+        that must be checked directly in the filesystem.
+    names : array of strings, optional
+        The name of each extension, used as the key of the statistics.
+    cache_folder : string or None, optional
+        The folder where the statistics are stored, or None to not store them.
     """
 
-    duplicated_bytes = 0
-    for full_file_path in glob.glob(os.path.join(snap_folder, "**/*"), recursive=True):
-        if not os.path.isfile(full_file_path) and not os.path.islink(full_file_path):
-            continue
-        relative_file_path = full_file_path[len(snap_folder):]
-        if relative_file_path[0] == '/':
-            relative_file_path = relative_file_path[1:]
-        do_exclude = False
-        for exclude in exclude_list:
-            if fnmatch.fnmatch(relative_file_path, exclude):
-                if verbose:
-                    print(f"Excluding {relative_file_path} with rule {exclude}")
-                do_exclude = True
+    def __init__(self, extensions_paths, indexes=None, names=None, cache_folder=None):
+        self.extensions_paths = list(extensions_paths)
+        self.indexes = indexes if indexes is not None else [None] * len(self.extensions_paths)
+        self.names = names if names is not None else [folder for folder, _ in self.extensions_paths]
+        self._stats_path = None if cache_folder is None else os.path.join(cache_folder, "probes.stats")
+        # for each folder, the number of files found in each extension
+        self._hits = {}
+        self._new_hits = {}
+        # for each folder, the extensions that contain it, in the order they are searched
+        self._orders = {}
+        # for each extension, whether each folder exists in it or not
+        self._folders = [{"": True} for _ in self.extensions_paths]
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if self._stats_path is None:
+            return
+        try:
+            with open(self._stats_path, "rb") as stats_file:
+                stats_data = json.loads(zlib.decompress(stats_file.read()))
+            if stats_data["version"] == INDEX_VERSION:
+                self._hits = stats_data["hits"]
+        except (OSError, ValueError, KeyError, zlib.error):
+            pass
+
+    def save(self):
+        """Adds the statistics of this run to the ones stored in the cache folder"""
+        with self._lock:
+            if (self._stats_path is None) or (len(self._new_hits) == 0):
+                return
+            new_hits = self._new_hits
+            self._new_hits = {}
+            # other processes could have stored their statistics after this one read them
+            self._hits = {}
+            self._load()
+            for folder, folder_hits in new_hits.items():
+                stored_hits = self._hits.setdefault(folder, {})
+                for name, hits in folder_hits.items():
+                    stored_hits[name] = stored_hits.get(name, 0) + hits
+            stats_data = {"version": INDEX_VERSION, "hits": self._hits}
+            try:
+                _write_atomically(self._stats_path, zlib.compress(json.dumps(stats_data).encode("utf-8")))
+            except OSError as error:
+                print(f"Can't store the probe statistics in {self._stats_path}: {error}")
+            self._orders = {}
+
+    def _get_plan(self, folder):
+        """Returns the positions of the extensions that contain a folder, sorted by the hits in the folder
+        or its nearest parent, and the number of probes done to know which extensions contain it"""
+        plan = self._orders.get(folder)
+        if plan is not None:
+            return plan, 0
+        prefix = folder
+        hits = self._hits.get(prefix)
+        while (hits is None) and (prefix != ""):
+            prefix = prefix.rpartition('/')[0]
+            hits = self._hits.get(prefix)
+        hits = hits if hits is not None else {}
+        plan = []
+        probes = 0
+        order = sorted(range(len(self.extensions_paths)), key=lambda position: -hits.get(self.names[position], 0))
+        for position in order:
+            exists, folder_probes = self._folder_exists(position, folder)
+            probes += folder_probes
+            if exists:
+                plan.append(position)
+        self._orders[folder] = plan
+        return plan, probes
+
+    def _add_hit(self, folder, position):
+        name = self.names[position]
+        prefix = folder
+        with self._lock:
+            while True:
+                for hits in [self._hits.setdefault(prefix, {}), self._new_hits.setdefault(prefix, {})]:
+                    hits[name] = hits.get(name, 0) + 1
+                if prefix == "":
+                    break
+                prefix = prefix.rpartition('/')[0]
+            if self._orders.get(folder, [position])[0] != position:
+                self._orders.pop(folder, None)
+
+    def _map_path(self, position, relative_path):
+        map_path = self.extensions_paths[position][1]
+        if (map_path is not None) and relative_path.startswith(map_path):
+            return relative_path[len(map_path):].lstrip('/')
+        return relative_path
+
+    def _folder_exists(self, position, folder):
+        """Returns whether a folder exists in an extension, and the number of probes done to know it"""
+        exists = self._folders[position].get(folder)
+        if exists is not None:
+            return exists, 0
+        map_path = self.extensions_paths[position][1]
+        if (map_path is not None) and map_path.startswith(folder + '/'):
+            # the folders of the mapping itself, like 'usr', don't exist in the extension
+            return True, 0
+        exists, probes = self._folder_exists(position, folder.rpartition('/')[0])
+        if exists:
+            probes += 1
+            index = self.indexes[position]
+            if index is not None:
+                exists = index.find(folder) is not None
+            else:
+                exists = os.path.isdir(os.path.join(self.extensions_paths[position][0],
+                                                    self._map_path(position, folder)))
+        self._folders[position][folder] = exists
+        return exists, probes
+
+    def find(self, relative_file_path, all_copies=False):
+        """Searches a file in the extensions
+
+        Parameters
+        ----------
+        relative_file_path : string
+            The file path to search, relative to the snap root.
+        all_copies : bool, optional
+            Search the file in all the extensions, instead of stopping at the
+            first one that contains it. The copies are returned in the same
+            order than `extensions_paths`.
+
+        Returns
+        -------
+        tuple with a list and an int
+            The list of copies found, with the same tuples yielded by
+            find_in_extensions(), and the number of lookups done.
+        """
+        folder = relative_file_path.rpartition('/')[0]
+        plan, probes = self._get_plan(folder)
+        if all_copies:
+            plan = sorted(plan)
+        copies = []
+        for position in plan:
+            probes += 1
+            index = self.indexes[position]
+            extension_folder, map_path = self.extensions_paths[position]
+            if index is not None:
+                found_path = index.find(relative_file_path)
+                if found_path is None:
+                    continue
+                snap_path = index.to_snap_path(found_path)
+            else:
+                snap_path = self._map_path(position, relative_file_path)
+                if not os.path.exists(os.path.join(extension_folder, snap_path)):
+                    continue
+            if len(copies) == 0:
+                self._add_hit(folder, position)
+            copies.append((extension_folder, map_path, snap_path))
+            if not all_copies:
                 break
-        if do_exclude:
-            continue
-        if check_if_exists(extensions_paths, relative_file_path, verbose):
-            if os.path.isfile(full_file_path):
-                duplicated_bytes += os.stat(full_file_path).st_size
-            os.remove(full_file_path)
-            if verbose:
-                print(f"Removing duplicated file {relative_file_path} {full_file_path}")
-    if not quiet:
-        print(f"Removed {duplicated_bytes} bytes in duplicated files")
+        return copies, probes
 
 
-if __name__ == "__main__":
-    verbose = args.verbose
-    exclude = args.exclude
-    extensions = args.extension
-    quiet = args.quiet
-    mapping = {}
+def hash_file(file_path):
+    """Returns the SHA-256 hash of a file
 
-    if exclude is not None:
-        global_excludes += exclude
+    The file is mapped in memory instead of being read, and since hashlib
+    releases the GIL while hashing, several files can be hashed in parallel
+    using threads.
 
-    extensions = get_extension_list(args.extension)
-    if len(extensions) == 0:
-        print("Called remove_common.py without a list of snaps, and no 'build-snaps' entry in the snapcraft.yaml file. Aborting.")
-        sys.exit(1)
+    Parameters
+    ----------
+    file_path : string
+        The path of the file
 
-    mappings = generate_mappings(global_maps, args.map)
+    Returns
+    -------
+    string
+        The hexadecimal digest of the file contents
+    """
+    with open(file_path, "rb") as file_data:
+        if os.fstat(file_data.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(file_data.fileno(), 0, access=mmap.ACCESS_READ) as mapped_data:
+            return hashlib.sha256(mapped_data).hexdigest()
 
-    if verbose:
-        print(f"Removing duplicates already in {extensions}")
 
-    extensions_paths = generate_extensions_paths(extensions, mappings)
-    extensions_paths.append((os.environ["CRAFT_STAGE"], None))
+class ContentVerifier:
+    """Checks if the files in CRAFT_PART_INSTALL are identical to the ones in the extensions
 
-    # This is the folder where to check for duplicates that are already
-    # in other snaps, or in the stage because they were built in other
-    # parts.
-    snap_folder = os.environ["CRAFT_PART_INSTALL"]
+    The sizes are compared first, and only the files whose size matches are
+    hashed, using a pool of threads. The hashes of the files in the extension
+    snaps are cached by snap revision and path, and stored in the cache folder,
+    so each one is calculated only once per build. The same object can be
+    used by several threads, and save() can be called while other threads
+    are still comparing files.
+
+    Parameters
+    ----------
+    cache_folder : string or None
+        The folder where the hashes are stored, or None to not store them.
+    jobs : int or None
+        The number of threads used to hash files, or None to use one per CPU.
+    """
+
+    def __init__(self, cache_folder=None, jobs=None):
+        self._cache_folder = cache_folder
+        self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+        # the hashes of the extension files, for each snap revision
+        self._hashes = {}
+        # the keys of the snap revisions, whose hashes can be stored
+        self._persistent = set()
+        self._modified = set()
+        self._lock = threading.Lock()
+
+    def _get_snap_hashes(self, folder):
+        """Returns the key and the hash cache for an extension path"""
+        snap_revision = get_snap_revision(folder)
+        if snap_revision is None:
+            key = os.path.realpath(folder)
+        else:
+            key = f"{snap_revision[0]}_{snap_revision[1]}"
+        with self._lock:
+            if key not in self._hashes:
+                self._hashes[key] = {}
+                if (snap_revision is not None) and (self._cache_folder is not None):
+                    self._hashes[key] = self._load_hashes(key)
+                    self._persistent.add(key)
+            return key, self._hashes[key]
+
+    def _hashes_path(self, key):
+        return os.path.join(self._cache_folder, f"{key}.hashes")
+
+    def _load_hashes(self, key):
+        try:
+            with open(self._hashes_path(key), "rb") as hashes_file:
+                return json.loads(zlib.decompress(hashes_file.read()))
+        except (OSError, ValueError, zlib.error):
+            return {}
+
+    def save(self):
+        """Stores the new hashes in the cache folder
+
+        It can be called while other threads are running find_identical();
+        the hashes they add after it are stored by the next call.
+        """
+        with self._lock:
+            if self._cache_folder is None:
+                return
+            for key in self._modified:
+                # other processes can have added hashes in the meantime
+                hashes = self._load_hashes(key)
+                hashes.update(self._hashes[key])
+                try:
+                    _write_atomically(self._hashes_path(key), zlib.compress(json.dumps(hashes).encode("utf-8")))
+                except OSError as error:
+                    print(f"Can't store the hashes in {self._hashes_path(key)}: {error}")
+            self._modified = set()
+
+    def find_identical(self, candidates, executor=None):
+        """Checks which files are identical to one of their copies in the extensions
+
+        Parameters
+        ----------
+        candidates : array of tuples with two elements
+            For each file, a tuple with its os.DirEntry and a list with the
+            copies found in the extensions, as tuples with the root path of
+            the extension and the path relative to it, like the ones returned
+            by find_in_extensions().
+        executor : concurrent.futures.Executor or None, optional
+            The executor used to hash the files, which can be shared by
+            several threads, or None to use a new pool with 'jobs' threads.
+
+        Returns
+        -------
+        array of tuples
+            For each candidate, the (folder, path) of the extension copy that is
+            identical to the file, or None if there is none.
+        """
+        results = [None] * len(candidates)
+        # (position, extension copy, hash key, hash cache) of each copy that must be hashed
+        to_compare = []
+        to_hash = set()
+        for position, (entry, copies) in enumerate(candidates):
+            if entry.is_symlink():
+                target = os.readlink(entry.path)
+                for folder, snap_path in copies:
+                    copy_path = os.path.join(folder, snap_path)
+                    if os.path.islink(copy_path) and os.readlink(copy_path) == target:
+                        results[position] = (folder, snap_path)
+                        break
+                continue
+            size = entry.stat(follow_symlinks=False).st_size
+            for folder, snap_path in copies:
+                copy_path = os.path.join(folder, snap_path)
+                try:
+                    copy_stat = os.stat(copy_path)
+                except OSError:
+                    continue
+                if (not stat.S_ISREG(copy_stat.st_mode)) or (copy_stat.st_size != size):
+                    continue
+                if size == 0:
+                    results[position] = (folder, snap_path)
+                    break
+                key, hashes = self._get_snap_hashes(folder)
+                to_compare.append((position, (folder, snap_path), key, hashes))
+                to_hash.add(entry.path)
+                if snap_path not in hashes:
+                    to_hash.add(copy_path)
+
+        if len(to_hash) == 0:
+            return results
+        paths = sorted(to_hash)
+        if executor is not None:
+            file_hashes = dict(zip(paths, executor.map(hash_file, paths)))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                file_hashes = dict(zip(paths, executor.map(hash_file, paths)))
+
+        with self._lock:
+            for position, (folder, snap_path), key, hashes in to_compare:
+                if results[position] is not None:
+                    continue
+                if snap_path not in hashes:
+                    hashes[snap_path] = file_hashes[os.path.join(folder, snap_path)]
+                    if key in self._persistent:
+                        self._modified.add(key)
+                if hashes[snap_path] == file_hashes[candidates[position][0].path]:
+                    results[position] = (folder, snap_path)
+        return results
+
+
+class ElfInfo:
+    """The fields of an ELF file needed to know which libraries it provides and uses
 
-    main(snap_folder, extensions_paths, global_excludes, verbose, quiet)
+    Attributes
+    ----------
+    elf_class : int
+        1 for 32-bit files, 2 for 64-bit files.
+    machine : int
+        The architecture (e_machine), like 62 for x86-64.
+    elf_type : int
+        The type of file (e_type), like 2 for executables or 3 for shared
+        objects and position independent executables.
+    soname : string or None
+        The DT_SONAME of the file, or None if it doesn't have one.
+    needed : array of strings
+        The DT_NEEDED entries, in order.
+    runpath : array of strings
+        The folders in DT_RUNPATH, or in DT_RPATH if there is no DT_RUNPATH.
+    interpreter : string or None
+        The program interpreter (PT_INTERP), only set in executables.
+    """
+
+    def __init__(self, elf_class, machine, elf_type):
+        self.elf_class = elf_class
+        self.machine = machine
+        self.elf_type = elf_type
+        self.soname = None
+        self.needed = []
+        self.runpath = []
+        self.interpreter = None
+
+    @property
+    def abi(self):
+        """The (class, machine) tuple that must match to use a library"""
+        return self.elf_class, self.machine
+
+
+def _read_elf(elf_file):
+    """Parses the headers and the dynamic section of an open ELF file for read_elf_info()"""
+    header = elf_file.read(64)
+    if (len(header) < 52) or (header[:4] != ELF_MAGIC) or (header[4] not in ELF_HEADERS) or (header[5] not in (1, 2)):
+        return None
+    byte_order = "<" if header[5] == 1 else ">"
+    header_format, program_header_format, dynamic_format = ELF_HEADERS[header[4]]
+    (elf_type, machine, _, _, program_header_offset, _, _, _, program_header_size,
+     program_headers, _, _, _) = struct.unpack_from(byte_order + header_format, header, 16)
+    elf_info = ElfInfo(header[4], machine, elf_type)
+
+    program_header_struct = struct.Struct(byte_order + program_header_format)
+    if program_header_size < program_header_struct.size:
+        return elf_info
+    elf_file.seek(program_header_offset)
+    table = elf_file.read(program_header_size * program_headers)
+    segments = []
+    dynamic = None
+    for position in range(0, len(table) - program_header_struct.size + 1, program_header_size):
+        fields = program_header_struct.unpack_from(table, position)
+        if header[4] == 2:
+            segment_type, _, offset, address, _, file_size, _, _ = fields
+        else:
+            segment_type, offset, address, _, file_size, _, _, _ = fields
+        if segment_type == ELF_PT_LOAD:
+            segments.append((address, file_size, offset))
+        elif segment_type == ELF_PT_DYNAMIC:
+            dynamic = (offset, file_size)
+        elif segment_type == ELF_PT_INTERP:
+            elf_file.seek(offset)
+            elf_info.interpreter = elf_file.read(file_size).split(b"\0", 1)[0].decode("utf-8", "surrogateescape")
+    if dynamic is None:
+        return elf_info
+
+    dynamic_struct = struct.Struct(byte_order + dynamic_format)
+    elf_file.seek(dynamic[0])
+    dynamic_data = elf_file.read(dynamic[1])
+    entries = []
+    string_table = None
+    string_table_size = 0
+    for position in range(0, len(dynamic_data) - dynamic_struct.size + 1, dynamic_struct.size):
+        tag, value = dynamic_struct.unpack_from(dynamic_data, position)
+        if tag == ELF_DT_NULL:
+            break
+        if tag == ELF_DT_STRTAB:
+            string_table = value
+        elif tag == ELF_DT_STRSZ:
+            string_table_size = value
+        elif tag in (ELF_DT_NEEDED, ELF_DT_SONAME, ELF_DT_RPATH, ELF_DT_RUNPATH):
+            entries.append((tag, value))
+    if string_table is None:
+        return elf_info
+    # the string table is given as a virtual address, which must be converted to a file offset
+    for address, file_size, offset in segments:
+        if address <= string_table < address + file_size:
+            elf_file.seek(string_table - address + offset)
+            strings = elf_file.read(string_table_size)
+            break
+    else:
+        return elf_info
+
+    rpath = []
+    runpath = None
+    for tag, value in entries:
+        end = strings.find(b"\0", value)
+        string = strings[value:end if end != -1 else len(strings)].decode("utf-8", "surrogateescape")
+        if tag == ELF_DT_NEEDED:
+            elf_info.needed.append(string)
+        elif tag == ELF_DT_SONAME:
+            elf_info.soname = string
+        elif tag == ELF_DT_RPATH:
+            rpath += string.split(":")
+        else:
+            runpath = (runpath or []) + string.split(":")
+    elf_info.runpath = runpath if runpath is not None else rpath
+    return elf_info
+
+
+def read_elf_info(file_path):
+    """Reads the dynamic linking information of an ELF file
+
+    Only the ELF header, the program headers, the dynamic section and its
+    string table are read, so it is fast even for big libraries.
+
+    Parameters
+    ----------
+    file_path : string
+        The path of the file.
+
+    Returns
+    -------
+    ElfInfo or None
+        The information of the file, or None if it isn't an ELF file or it
+        can't be read.
+    """
+    try:
+        with open(file_path, "rb") as elf_file:
+            return _read_elf(elf_file)
+    except (OSError, struct.error, ValueError):
+        return None
+
+
+def is_library_folder(relative_folder_path):
+    """Checks if a folder is one of the standard library folders searched by the dynamic loader
+
+    Parameters
+    ----------
+    relative_folder_path : string
+        The path of the folder relative to the snap root, without a trailing '/'.
+
+    Returns
+    -------
+    bool
+        True for folders like lib, usr/lib, usr/lib64 or usr/lib/x86_64-linux-gnu.
+    """
+    return LIBRARY_FOLDER_REGEX.match(relative_folder_path) is not None
+
+
+def is_library_name(name):
+    """Checks if a file name looks like a shared library, like libfoo.so or libfoo.so.1.2"""
+    return name.endswith(".so") or (".so." in name)
+
+
+def scan_sonames(folder):
+    """Searches the shared libraries in the library folders of an extension snap
+
+    Parameters
+    ----------
+    folder : string
+        The root path of the extension snap.
+
+    Returns
+    -------
+    dictionary
+        For each ABI, as a "SONAME:CLASS:MACHINE" string, the path of the
+        library relative to the snap root.
+    """
+    sonames = {}
+    pending = [""]
+    while len(pending) != 0:
+        relative_folder = pending.pop()
+        try:
+            with os.scandir(os.path.join(folder, relative_folder)) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        for entry in entries:
+            relative_path = f"{relative_folder}/{entry.name}" if relative_folder else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                # only the library folders and the folders that can contain them are walked
+                if is_library_folder(relative_path) or is_library_folder(relative_path + "/lib"):
+                    pending.append(relative_path)
+                continue
+            if (relative_folder == "") or not is_library_name(entry.name) or not entry.is_file(follow_symlinks=False):
+                continue
+            elf_info = read_elf_info(entry.path)
+            if (elf_info is not None) and (elf_info.soname is not None):
+                sonames.setdefault(f"{elf_info.soname}:{elf_info.elf_class}:{elf_info.machine}", relative_path)
+    return sonames
+
+
+def load_soname_index(folder, cache_folder=None, verbose=False):
+    """Returns the shared libraries of an extension snap, indexed by their soname and ABI
+
+    Like the path index, it is stored in the cache folder per revision.
+
+    Parameters
+    ----------
+    folder : string
+        The root path of the extension snap.
+    cache_folder : string or None
+        The folder where the indexes are stored, or None to not store them.
+    verbose : bool, optional
+        Show extra verbose information, by default False
+
+    Returns
+    -------
+    dictionary or None
+        The dictionary returned by scan_sonames(), or None if `folder` is a
+        .snap file, whose library contents can't be read.
+    """
+    if is_snap_image(folder):
+        return None
+    snap_revision = get_snap_revision(folder)
+    index_path = None
+    if (cache_folder is not None) and (snap_revision is not None):
+        index_path = os.path.join(cache_folder, f"{snap_revision[0]}_{snap_revision[1]}.sonames")
+        try:
+            with open(index_path, "rb") as index_file:
+                index_data = json.loads(zlib.decompress(index_file.read()))
+            if index_data["version"] == INDEX_VERSION:
+                return index_data["sonames"]
+        except (OSError, ValueError, KeyError, zlib.error):
+            pass
+    sonames = scan_sonames(folder)
+    if verbose:
+        print(f"Found {len(sonames)} shared libraries in {folder}")
+    if index_path is not None:
+        index_data = {"version": INDEX_VERSION, "sonames": sonames}
+        try:
+            _write_atomically(index_path, zlib.compress(json.dumps(index_data).encode("utf-8")))
+        except OSError as error:
+            print(f"Can't store the soname index for {folder} in {index_path}: {error}")
+    return sonames
+
+
+class ExcludeMatcher:
+    """The exclude rules compiled to be checked in a single step
+
+    The rules with the form 'literal/folder/*' are stored in a trie of path
+    components, which allows to discard whole folders without any pattern
+    matching, and the remaining rules are joined in a single regular expression
+    built with fnmatch.translate(), so the results are exactly the same than
+    calling fnmatch.fnmatch() with each rule.
+
+    Parameters
+    ----------
+    exclude_list : array of strings
+        A list of fnmatch rules for excluding files and/or paths
+    """
+
+    def __init__(self, exclude_list):
+        self.rules = list(exclude_list)
+        # each trie node is a list with the index of the rule that ends in
+        # that node (or None) and a dictionary with the children nodes
+        self._trie = [None, {}]
+        regex_rules = []
+        for position, rule in enumerate(self.rules):
+            literal_folder = rule[:-1]
+            if rule.endswith('/*') and not any(character in literal_folder for character in '*?['):
+                node = self._trie
+                for component in literal_folder[:-1].split('/'):
+                    node = node[1].setdefault(component, [None, {}])
+                if node[0] is None:
+                    node[0] = position
+            else:
+                regex_rules.append(position)
+        self._regex = self._compile(regex_rules)
+        # rules that, matching a folder path followed by '/', match anything inside it
+        self._folder_regex = self._compile([position for position in regex_rules if self.rules[position].endswith('*')])
+
+    def _compile(self, positions):
+        """Joins the rules in a single regular expression with a named group per rule"""
+        if len(positions) == 0:
+            return None
+        groups = []
+        for position in positions:
+            translated = fnmatch.translate(self.rules[position])
+            # older python versions use named groups in the translated patterns,
+            # which must be unique in the joined expression
+            translated = re.sub(r"\(\?P([<=])g(\d+)", f"(?P\\1r{position}g\\2", translated)
+            groups.append(f"(?P<r{position}>{translated})")
+        return re.compile("|".join(groups))
+
+    def _search_trie(self, components):
+        """Returns the lowest rule index in the trie that covers the components"""
+        found = None
+        node = self._trie
+        for component in components:
+            node = node[1].get(component)
+            if node is None:
+                break
+            if (node[0] is not None) and ((found is None) or (node[0] < found)):
+                found = node[0]
+        return found
+
+    def _first_rule(self, trie_position, regex, path):
+        if regex is not None:
+            match = regex.match(path)
+            if match is not None:
+                regex_position = int(match.lastgroup[1:])
+                if (trie_position is None) or (regex_position < trie_position):
+                    return self.rules[regex_position]
+        if trie_position is not None:
+            return self.rules[trie_position]
+        return None
+
+    def match(self, relative_file_path):
+        """Returns the first rule, in list order, that matches a file path
+
+        Parameters
+        ----------
+        relative_file_path : string
+            The file path, relative to the snap root.
+
+        Returns
+        -------
+        string or None
+            The rule that matches the path, or None if no rule does.
+        """
+        trie_position = self._search_trie(relative_file_path.split('/')[:-1])
+        return self._first_rule(trie_position, self._regex, relative_file_path)
+
+    def is_excluded(self, relative_file_path):
+        """Checks if any rule matches a file path
+
+        It is faster than match() because it doesn't need to find which rule
+        is the first one that matches.
+        """
+        if len(self._trie[1]) != 0 and (self._search_trie(relative_file_path.split('/')[:-1]) is not None):
+            return True
+        return (self._regex is not None) and (self._regex.match(relative_file_path) is not None)
+
+    def match_folder(self, relative_folder_path):
+        """Returns the first rule that covers a whole folder
+
+        A rule covers a folder if it matches any path inside that folder, no
+        matter how deep it is.
+
+        Parameters
+        ----------
+        relative_folder_path : string
+            The folder path, relative to the snap root.
+
+        Returns
+        -------
+        string or None
+            The rule that covers the folder, or None if no rule does.
+        """
+        trie_position = self._search_trie(relative_folder_path.split('/'))
+        return self._first_rule(trie_position, self._folder_regex, relative_folder_path + '/')
+
+
+def walk_install_folder(snap_folder, exclude_matcher=None, verbose=False):
+    """Iterates over the files and symlinks inside a folder
+
+    The folder is walked with os.scandir(), yielding each entry as soon as
+    its folder has been read, and using the type information returned with
+    the entries instead of doing extra stat calls. The folders fully covered
+    by a rule in `exclude_matcher` aren't entered. Like glob, hidden files and
+    folders (the ones beginning with a dot) are ignored, and symlinks to
+    folders are returned as entries instead of being walked.
+
+    Parameters
+    ----------
+    snap_folder : string
+        The path of the folder to walk
+    exclude_matcher : ExcludeMatcher, optional
+        The compiled exclude rules, or None to walk all the folders
+    verbose : bool, optional
+        Show extra verbose information, by default False
+
+    Yields
+    ------
+    tuple with a string and an os.DirEntry
+        The path of the file relative to `snap_folder`, and its DirEntry.
+    """
+    pending = [""]
+    while len(pending) != 0:
+        relative_folder = pending.pop()
+        try:
+            with os.scandir(os.path.join(snap_folder, relative_folder)) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            relative_path = relative_folder + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                exclude = None if exclude_matcher is None else exclude_matcher.match_folder(relative_path)
+                if exclude is None:
+                    pending.append(relative_path + '/')
+                elif verbose:
+                    print(f"Excluding folder {relative_path} with rule {exclude}")
+                continue
+            if entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                yield relative_path, entry
+
+
+class InstallFolder:
+    """A folder returned by walk_install_tree()
+
+    Attributes
+    ----------
+    relative_path : string
+        The path of the folder relative to the walked folder, ending in '/'
+        (or an empty string for the walked folder itself).
+    name : string
+        The name of the folder inside its parent.
+    parent : InstallFolder or None
+        The parent folder, or None for the walked folder.
+    fd : int
+        A file descriptor of the folder, open while it is being processed, to
+        remove its entries without resolving the whole path each time.
+    files : array of os.DirEntry
+        The files and symlinks inside the folder, except the hidden ones.
+    subfolders : array of strings
+        The names of the subfolders that are walked.
+    remaining : int
+        The number of entries still inside the folder. It must be decremented
+        each time one of its entries is removed.
+    """
+
+    def __init__(self, relative_path, name, parent, fd):
+        self.relative_path = relative_path
+        self.name = name
+        self.parent = parent
+        self.fd = fd
+        self.files = []
+        self.subfolders = []
+        self.remaining = 0
+
+    def was_emptied(self):
+        """Returns whether the folder had entries and all of them have been removed"""
+        return self.remaining == 0 and (len(self.files) != 0 or len(self.subfolders) != 0)
+
+
+def _read_install_folder(snap_folder, relative_path, name, parent, exclude_matcher, verbose):
+    """Opens and reads a folder for walk_install_tree()"""
+    if parent is None:
+        dir_fd = os.open(snap_folder, os.O_RDONLY | os.O_DIRECTORY)
+    else:
+        dir_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=parent.fd)
+    try:
+        with os.scandir(os.path.join(snap_folder, relative_path)) as iterator:
+            entries = list(iterator)
+    except OSError:
+        os.close(dir_fd)
+        raise
+    folder = InstallFolder(relative_path, name, parent, dir_fd)
+    # hidden entries, excluded folders and other file types are never removed
+    folder.remaining = len(entries)
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            relative_subfolder = relative_path + entry.name
+            exclude = None if exclude_matcher is None else exclude_matcher.match_folder(relative_subfolder)
+            if exclude is None:
+                folder.subfolders.append(entry.name)
+            elif verbose:
+                print(f"Excluding folder {relative_subfolder} with rule {exclude}")
+        elif entry.is_file(follow_symlinks=False) or entry.is_symlink():
+            folder.files.append(entry)
+    return folder
+
+
+def walk_install_tree(snap_folder, exclude_matcher=None, verbose=False):
+    """Iterates over the folders inside a folder, each one after all its subfolders
+
+    It walks the same folders and files than walk_install_folder(), but
+    groups the files by folder and returns the deepest folders first, while
+    keeping open a file descriptor of each folder and its parents. This
+    allows to remove the files relative to their folder, and to remove the
+    folders that become empty, relative to their parent, in the same pass.
+    The descriptor of each folder is closed after it has been processed.
+
+    Parameters
+    ----------
+    snap_folder : string
+        The path of the folder to walk
+    exclude_matcher : ExcludeMatcher, optional
+        The compiled exclude rules, or None to walk all the folders
+    verbose : bool, optional
+        Show extra verbose information, by default False
+
+    Yields
+    ------
+    InstallFolder
+        Each folder, including `snap_folder` itself as the last one.
+    """
+    try:
+        root = _read_install_folder(snap_folder, "", "", None, exclude_matcher, verbose)
+    except OSError:
+        return
+    pending = [(root, iter(root.subfolders))]
+    try:
+        while len(pending) != 0:
+            folder, subfolders = pending[-1]
+            name = next(subfolders, None)
+            if name is not None:
+                try:
+                    subfolder = _read_install_folder(snap_folder, f"{folder.relative_path}{name}/", name, folder,
+                                                     exclude_matcher, verbose)
+                except OSError:
+                    continue
+                pending.append((subfolder, iter(subfolder.subfolders)))
+                continue
+            pending.pop()
+            try:
+                yield folder
+            finally:
+                os.close(folder.fd)
+    finally:
+        for folder, _ in pending:
+            os.close(folder.fd)
+
+
+def remove_duplicate(relative_file_path, entry, verbose=False, dry_run=False, dir_fd=None):
+    """Removes a duplicated file
+
+    Parameters
+    ----------
+    relative_file_path : string
+        The path of the file relative to the snap root.
+    entry : os.DirEntry
+        The entry of the file, as returned by walk_install_folder().
+    verbose : bool, optional
+        Show extra verbose information, by default False
+    dry_run : bool, optional
+        Don't remove the file, only return its size, by default False
+    dir_fd : int or None, optional
+        A file descriptor of the folder that contains the file, to remove it
+        by its name, or None to remove it by its full path.
+
+    Returns
+    -------
+    int
+        The number of bytes freed (or that would be freed).
+    """
+    size = 0
+    if entry.is_file(follow_symlinks=False):
+        size = entry.stat(follow_symlinks=False).st_size
+    if not dry_run:
+        if dir_fd is not None:
+            os.unlink(entry.name, dir_fd=dir_fd)
+        else:
+            os.remove(entry.path)
+    if verbose:
+        print(f"{'Would remove' if dry_run else 'Removing'} duplicated file {relative_file_path} {entry.path}")
+    return size
+
+
+class DedupReport:
+    """Statistics about the files removed from an install folder
+
+    It groups the removed files and bytes by top-level folder and by the
+    extension that contained them, and measures the time spent walking the
+    folder, searching the files in the extensions and removing them.
+
+    Parameters
+    ----------
+    snap_folder : string or None, optional
+        The folder being processed.
+    dry_run : bool, optional
+        Whether the files were only reported, instead of being removed.
+    """
+
+    STEPS = ["walk", "match", "unlink"]
+
+    def __init__(self, snap_folder=None, dry_run=False):
+        self.snap_folder = snap_folder
+        self.dry_run = dry_run
+        self.scanned_files = 0
+        self.excluded_files = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self.removed_folders = 0
+        # the files searched in the extensions, and the lookups done to find them
+        self.searched_files = 0
+        self.probes = 0
+        self.by_folder = {}
+        self.by_extension = {}
+        self.timings = {step: 0.0 for step in self.STEPS}
+
+    @staticmethod
+    def _add(groups, key, size):
+        group = groups.setdefault(key, {"files": 0, "bytes": 0})
+        group["files"] += 1
+        group["bytes"] += size
+
+    def add_removed(self, relative_file_path, extension, size):
+        """Adds a removed file to the statistics
+
+        Parameters
+        ----------
+        relative_file_path : string
+            The path of the file relative to the snap root.
+        extension : string
+            The name of the extension that contained the file.
+        size : int
+            The number of bytes freed.
+        """
+        self.removed_files += 1
+        self.removed_bytes += size
+        self._add(self.by_folder, relative_file_path.split('/', 1)[0], size)
+        self._add(self.by_extension, extension, size)
+
+    def add_time(self, step, seconds):
+        self.timings[step] += seconds
+
+    def merge(self, other):
+        """Adds the statistics of another report to this one"""
+        self.scanned_files += other.scanned_files
+        self.excluded_files += other.excluded_files
+        self.removed_files += other.removed_files
+        self.removed_bytes += other.removed_bytes
+        self.removed_folders += other.removed_folders
+        self.searched_files += other.searched_files
+        self.probes += other.probes
+        for groups, other_groups in [(self.by_folder, other.by_folder), (self.by_extension, other.by_extension)]:
+            for key, other_group in other_groups.items():
+                group = groups.setdefault(key, {"files": 0, "bytes": 0})
+                group["files"] += other_group["files"]
+                group["bytes"] += other_group["bytes"]
+        for step in self.STEPS:
+            self.timings[step] += other.timings[step]
+
+    def to_dict(self):
+        """Returns the report as a dictionary that can be serialized to JSON"""
+        return {"folder": self.snap_folder,
+                "dry_run": self.dry_run,
+                "scanned_files": self.scanned_files,
+                "excluded_files": self.excluded_files,
+                "removed_files": self.removed_files,
+                "removed_bytes": self.removed_bytes,
+                "removed_folders": self.removed_folders,
+                "searched_files": self.searched_files,
+                "probes": self.probes,
+                "probes_per_file": round(self.probes / self.searched_files, 3) if self.searched_files else 0.0,
+                "by_folder": dict(sorted(self.by_folder.items())),
+                "by_extension": dict(sorted(self.by_extension.items())),
+                "timings": {step: round(seconds, 6) for step, seconds in self.timings.items()}}
+
+
+def _timed(iterable, report, step):
+    """Iterates over 'iterable', adding to the report the time spent getting each element"""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            element = next(iterator)
+        except StopIteration:
+            report.add_time(step, time.perf_counter() - start)
+            return
+        report.add_time(step, time.perf_counter() - start)
+        yield element
+
+
+class Deduplicator:
+    """Removes from install folders the files already available in the extensions
+
+    It is built once for a list of extensions, loading their path indexes and
+    compiling the exclude rules, and then it can process as many install
+    folders as needed.
+
+    Parameters
+    ----------
+    extensions_paths : array of tuples with two elements
+        An array with tuples containing each one a string with the root
+        path for one of the extensions snap, and, if required, another
+        string with the mapping for that snap (or None if no mapping is
+        required for that snap).
+    exclude_list : array of strings
+        A list of fnmatch rules for excluding files and/or paths
+    verbose : bool, optional
+        Show extra verbose information, by default False
+    cache_folder : string or None, optional
+        The folder where the path index and the file hashes of each extension
+        snap are stored, or None to not store them, by default None
+    verify_content : bool, optional
+        Remove only the files whose contents are identical to the ones in the
+        extension, by default False. The contents of the files inside .snap
+        images can't be read, so the files found only there are kept.
+    jobs : int or None, optional
+        Number of threads used to hash files, or None to use one per CPU
+    stage_folder : string or None, optional
+        The stage folder, whose files are also searched using an incremental
+        StageIndex, or None to not search in the stage, by default None
+    dry_run : bool, optional
+        Don't remove any file, only report them, by default False
+    io_threads : int, optional
+        Number of threads used to search the files of each folder in the
+        extensions and to remove them, which hides the latency of each
+        filesystem call in slow filesystems (like overlayfs over a network
+        disk), or 0 to do it sequentially, by default 0. The files are
+        still reported and counted in the same order.
+    sonames : bool, optional
+        Also remove the shared libraries in the standard library folders
+        whose soname and ABI are the same than those of a library in the
+        standard library folders of an extension, even if their paths differ,
+        and the symlinks that point to them, by default False
+    """
+
+    def __init__(self, extensions_paths, exclude_list=[], verbose=False, cache_folder=None,
+                 verify_content=False, jobs=None, stage_folder=None, dry_run=False, io_threads=0, sonames=False):
+        self.extensions_paths = list(extensions_paths)
+        self.verbose = verbose
+        self.dry_run = dry_run
+        self.io_threads = io_threads
+        self.indexes = load_extensions_indexes(self.extensions_paths, cache_folder, verbose)
+        self.stage_index = None
+        if stage_folder is not None:
+            self.stage_index = StageIndex(stage_folder, cache_folder)
+            self.extensions_paths.append((stage_folder, None))
+            self.indexes.append(self.stage_index)
+        self.exclude_matcher = ExcludeMatcher(exclude_list)
+        self.verifier = ContentVerifier(cache_folder, jobs) if verify_content else None
+        if verify_content:
+            for folder, _ in self.extensions_paths:
+                if is_snap_image(folder):
+                    print(f"The contents of the files inside {folder} can't be compared, so they will be kept")
+        # the name used in the reports for each extension
+        self.extension_names = {}
+        for folder, _ in self.extensions_paths:
+            snap_revision = get_snap_revision(folder)
+            self.extension_names[folder] = snap_revision[0] if snap_revision is not None else folder
+        self.planner = ProbePlanner(self.extensions_paths, self.indexes,
+                                    [self.extension_names[folder] for folder, _ in self.extensions_paths],
+                                    cache_folder)
+        self.soname_indexes = None
+        if sonames:
+            # the stage isn't included, because its libraries are found by their path
+            self.soname_indexes = [None if (self.stage_index is not None) and (index is self.stage_index)
+                                   else load_soname_index(folder, cache_folder, verbose)
+                                   for (folder, _), index in zip(self.extensions_paths, self.indexes)]
+
+    @classmethod
+    def from_extensions(cls, extensions, mappings, **kwargs):
+        """Creates a Deduplicator from a list of snap names and their mappings
+
+        Parameters
+        ----------
+        extensions : array of strings
+            The names of the extensions used in this snap.
+        mappings : dictionary
+            The mappings for each snap, as returned by generate_mappings().
+        kwargs
+            Any other parameter accepted by the constructor.
+
+        Returns
+        -------
+        Deduplicator
+            The new object.
+        """
+        return cls(generate_extensions_paths(extensions, mappings), **kwargs)
+
+    def is_excluded(self, relative_file_path):
+        """Checks if a file must be kept because it matches an exclude rule"""
+        if not self.verbose:
+            return self.exclude_matcher.is_excluded(relative_file_path)
+        exclude = self.exclude_matcher.match(relative_file_path)
+        if exclude is not None:
+            print(f"Excluding {relative_file_path} with rule {exclude}")
+        return exclude is not None
+
+    def process(self, snap_folder, report=None):
+        """Removes the duplicated files from a folder
+
+        Parameters
+        ----------
+        snap_folder : string
+            The path of the folder where the staged .deb have been uncompressed (usually
+            CRAFT_PART_INSTALL)
+        report : DedupReport or None, optional
+            The report where to add the statistics, or None to not create them.
+
+        Returns
+        -------
+        int
+            The number of bytes freed.
+        """
+        if report is None:
+            report = DedupReport(snap_folder, self.dry_run)
+        executor = self._create_io_executor()
+        try:
+            self._process(snap_folder, report, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.save()
+        return report.removed_bytes
+
+    def save(self):
+        """Stores the file hashes, the stage index and the probe statistics in the cache folder"""
+        if self.verifier is not None:
+            self.verifier.save()
+        if self.stage_index is not None:
+            self.stage_index.save()
+        self.planner.save()
+
+    def _create_io_executor(self):
+        """Returns the executor used to search and remove the files, or None if they are processed sequentially"""
+        if self.io_threads == 0:
+            return None
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.io_threads)
+
+    def _process(self, snap_folder, report, executor, hash_executor=None):
+        """Removes the duplicated files from a folder, without storing anything in the cache folder"""
+        install_folders = walk_install_tree(snap_folder, self.exclude_matcher, self.verbose)
+        for install_folder in _timed(install_folders, report, "walk"):
+            self._process_folder(install_folder, report, executor, hash_executor)
+        return report.removed_bytes
+
+    @staticmethod
+    def _map(executor, function, elements):
+        """Calls a function for each element, in the executor if there is one, returning the results in order"""
+        if (executor is None) or (len(elements) < 2):
+            return map(function, elements)
+        return executor.map(function, elements)
+
+    def _process_folder(self, install_folder, report, executor, hash_executor):
+        """Removes the duplicated files of a folder, and the folder itself if it ends empty"""
+        start = time.perf_counter()
+        searched = []
+        for entry in install_folder.files:
+            relative_file_path = install_folder.relative_path + entry.name
+            report.scanned_files += 1
+            if self.is_excluded(relative_file_path):
+                report.excluded_files += 1
+                continue
+            searched.append((relative_file_path, entry))
+        all_copies = self.verifier is not None
+        results = self._map(executor, lambda relative_file_path: self.planner.find(relative_file_path, all_copies),
+                            [relative_file_path for relative_file_path, _ in searched])
+        duplicates = []
+        libraries = []
+        for (relative_file_path, entry), (copies, probes) in zip(searched, results):
+            report.searched_files += 1
+            report.probes += probes
+            if len(copies) == 0:
+                if (self.soname_indexes is not None) and is_library_name(entry.name):
+                    libraries.append((relative_file_path, entry))
+                continue
+            if self.verbose:
+                for folder, map_path, snap_path in copies:
+                    print(f"The path {relative_file_path} has been found inside {folder} with map {map_path}: "
+                          f"{snap_path}")
+            duplicates.append((relative_file_path, entry, [(folder, snap_path) for folder, _, snap_path in copies]))
+        if (len(libraries) != 0) and is_library_folder(install_folder.relative_path[:-1]):
+            duplicates += self._find_by_soname(libraries, executor)
+        report.add_time("match", time.perf_counter() - start)
+        if self.verifier is not None:
+            duplicates = self._keep_identical(duplicates, report, hash_executor)
+        if self.soname_indexes is not None:
+            duplicates += self._find_library_links(searched, duplicates)
+        self._remove(duplicates, install_folder, report, executor)
+        if (install_folder.parent is not None) and install_folder.was_emptied():
+            self._remove_folder(install_folder, report)
+
+    def _find_by_soname(self, libraries, executor):
+        """Searches in the extensions the libraries with the same soname and ABI
+
+        Parameters
+        ----------
+        libraries : array of tuples
+            For each library not found by its path, a tuple with its relative
+            path and its os.DirEntry.
+        executor : concurrent.futures.Executor or None
+            The executor used to read the libraries, or None to read them
+            sequentially.
+
+        Returns
+        -------
+        array of tuples
+            The libraries found, with the same format used for the duplicates.
+        """
+        libraries = [(relative_file_path, entry) for relative_file_path, entry in libraries
+                     if entry.is_file(follow_symlinks=False)]
+        elf_infos = self._map(executor, lambda library: read_elf_info(library[1].path), libraries)
+        duplicates = []
+        for (relative_file_path, entry), elf_info in zip(libraries, elf_infos):
+            if (elf_info is None) or (elf_info.soname is None):
+                continue
+            key = f"{elf_info.soname}:{elf_info.elf_class}:{elf_info.machine}"
+            copies = [(folder, soname_index[key]) for (folder, _), soname_index
+                      in zip(self.extensions_paths, self.soname_indexes)
+                      if (soname_index is not None) and (key in soname_index)]
+            if len(copies) == 0:
+                continue
+            if self.verbose:
+                print(f"The library {relative_file_path} has the same soname than {copies[0][1]} "
+                      f"inside {copies[0][0]}")
+            duplicates.append((relative_file_path, entry, copies))
+        return duplicates
+
+    def _find_library_links(self, searched, duplicates):
+        """Returns the symlinks of a folder that point, directly or through other symlinks, to a removed library
+
+        Parameters
+        ----------
+        searched : array of tuples
+            The relative path and os.DirEntry of the files of the folder that
+            aren't excluded.
+        duplicates : array of tuples
+            The files of the folder that are going to be removed.
+
+        Returns
+        -------
+        array of tuples
+            The symlinks, with the same format used for the duplicates and the
+            copies of the file they point to.
+        """
+        removed = {entry.name: copies for _, entry, copies in duplicates}
+        links = {}
+        for relative_file_path, entry in searched:
+            if (entry.name not in removed) and entry.is_symlink():
+                target = os.readlink(entry.path)
+                if '/' not in target:
+                    links[entry.name] = (relative_file_path, entry, target)
+        library_links = []
+        found = True
+        while found:
+            found = False
+            for name, (relative_file_path, entry, target) in list(links.items()):
+                if target in removed:
+                    if self.verbose:
+                        print(f"The symlink {relative_file_path} points to the removed library {target}")
+                    removed[name] = removed[target]
+                    library_links.append((relative_file_path, entry, removed[target]))
+                    del links[name]
+                    found = True
+        return library_links
+
+    def _remove(self, duplicates, install_folder, report, executor):
+        """Removes the duplicated files of a folder, adding them to the report
+
+        Parameters
+        ----------
+        duplicates : array of tuples
+            For each file, a tuple with its relative path, its os.DirEntry and
+            the list of (folder, path) copies found in the extensions, being
+            the first one the copy used in the report.
+        install_folder : InstallFolder
+            The folder that contains the files.
+        report : DedupReport
+            The report where to add the removed files.
+        executor : concurrent.futures.Executor or None
+            The executor used to remove the files, or None to remove them
+            sequentially.
+        """
+        start = time.perf_counter()
+        sizes = self._map(executor, lambda duplicate: remove_duplicate(duplicate[0], duplicate[1], False, self.dry_run,
+                                                                       install_folder.fd), duplicates)
+        for (relative_file_path, entry, copies), size in zip(duplicates, sizes):
+            if self.verbose:
+                print(f"{'Would remove' if self.dry_run else 'Removing'} duplicated file {relative_file_path} "
+                      f"{entry.path}")
+            install_folder.remaining -= 1
+            report.add_removed(relative_file_path, self.extension_names[copies[0][0]], size)
+        report.add_time("unlink", time.perf_counter() - start)
+
+    def _remove_folder(self, install_folder, report):
+        """Removes a folder whose entries have all been removed, adding it to the report"""
+        start = time.perf_counter()
+        if not self.dry_run:
+            try:
+                os.rmdir(install_folder.name, dir_fd=install_folder.parent.fd)
+            except OSError as error:
+                # a file could have been added to the folder after it was read
+                if self.verbose:
+                    print(f"Can't remove the folder {install_folder.relative_path}: {error}")
+                return
+        if self.verbose:
+            print(f"{'Would remove' if self.dry_run else 'Removing'} empty folder {install_folder.relative_path}")
+        report.add_time("unlink", time.perf_counter() - start)
+        install_folder.parent.remaining -= 1
+        report.removed_folders += 1
+
+    def process_parts(self, install_folders, jobs=None, reports=None):
+        """Removes the duplicated files from several install folders in parallel
+
+        The parts share the same pools of threads to search, remove and hash
+        the files, and the caches are stored once all of them have been
+        processed.
+
+        Parameters
+        ----------
+        install_folders : dictionary
+            A dictionary where the key is a part name and the value is its
+            install folder, as returned by get_parts_install_folders().
+        jobs : int or None, optional
+            Number of parts processed at the same time, or None to use one per CPU
+        reports : dictionary or None, optional
+            A dictionary where the report of each part will be stored, using
+            the part name as the key, or None to not keep them.
+
+        Returns
+        -------
+        dictionary
+            The number of bytes freed in each part.
+        """
+        jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+        part_names = list(install_folders)
+        if reports is None:
+            reports = {}
+        for part_name in part_names:
+            reports[part_name] = DedupReport(install_folders[part_name], self.dry_run)
+        # the parts share the same pools, so the number of threads doesn't grow with the number of jobs
+        io_executor = self._create_io_executor()
+        hash_executor = None
+        if self.verifier is not None:
+            hash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.verifier.jobs)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                freed_bytes = list(executor.map(lambda part_name: self._process(install_folders[part_name],
+                                                                                reports[part_name], io_executor,
+                                                                                hash_executor),
+                                                part_names))
+        finally:
+            for pool in (io_executor, hash_executor):
+                if pool is not None:
+                    pool.shutdown()
+        # stored once all the parts have been processed
+        self.save()
+        return dict(zip(part_names, freed_bytes))
+
+    def _keep_identical(self, candidates, report, hash_executor=None):
+        """Returns the candidates that are identical to their copy in an extension
+
+        Parameters
+        ----------
+        candidates : array of tuples
+            For each file, a tuple with its relative path, its os.DirEntry and
+            the list of (folder, path) copies found in the extensions.
+        report : DedupReport
+            The report where to add the time spent comparing them.
+        hash_executor : concurrent.futures.Executor or None, optional
+            The executor used to hash the files, or None to use a new one.
+
+        Returns
+        -------
+        array of tuples
+            The identical candidates, with the identical copy as the only one
+            in the list.
+        """
+        start = time.perf_counter()
+        results = self.verifier.find_identical([(entry, copies) for _, entry, copies in candidates], hash_executor)
+        report.add_time("match", time.perf_counter() - start)
+        identical_candidates = []
+        for (relative_file_path, entry, _), identical in zip(candidates, results):
+            if identical is None:
+                if self.verbose:
+                    print(f"Keeping {relative_file_path} because its contents differ from the extensions")
+                continue
+            identical_candidates.append((relative_file_path, entry, [identical]))
+        return identical_candidates
+
+
+class LibraryGraph:
+    """Graph of the shared libraries used by the ELF files of a folder
+
+    Every ELF file outside the standard library folders (executables, plugins,
+    python modules...) is a root of the graph, and each DT_NEEDED entry is
+    resolved like the dynamic loader does: first in the run path of the file
+    (only the folders inside the snap, including the ones relative to
+    $ORIGIN), then in the standard library folders of the folder, and finally
+    in the libraries of the base snaps. The libraries in the standard library
+    folders that can't be reached from any root are never loaded by the snap,
+    unless they are loaded with dlopen(), so those must be added to the
+    allowlist.
+
+    Parameters
+    ----------
+    snap_folder : string
+        The folder to analyze, usually the prime folder.
+    soname_indexes : array of dictionaries, optional
+        The soname index of each base snap, as returned by load_soname_index().
+    allowlist : array of strings, optional
+        fnmatch rules for the libraries that are always considered reachable,
+        like the ones loaded with dlopen().
+    """
+
+    def __init__(self, snap_folder, soname_indexes=(), allowlist=DLOPEN_ALLOWLIST):
+        self.snap_folder = snap_folder
+        self.soname_indexes = [soname_index for soname_index in soname_indexes if soname_index is not None]
+        self.allow_matcher = ExcludeMatcher(allowlist)
+        # the ELF files, and the symlinks with their targets, relative to the snap folder
+        self.elf_files = {}
+        self.links = {}
+        # the paths in the standard library folders for each file name
+        self.library_names = {}
+        # for each DT_NEEDED that can't be resolved, the files that need it
+        self.missing = {}
+        self._scan()
+
+    def _scan(self):
+        for relative_path, entry in walk_install_folder(self.snap_folder):
+            folder, _, name = relative_path.rpartition('/')
+            if is_library_folder(folder):
+                self.library_names.setdefault(name, []).append(relative_path)
+            if entry.is_symlink():
+                target = _resolve_link_target(relative_path, os.readlink(entry.path))
+                if target is not None:
+                    self.links[relative_path] = target
+                continue
+            if not (is_library_name(name) or (entry.stat(follow_symlinks=False).st_mode & 0o111)):
+                continue
+            elf_info = read_elf_info(entry.path)
+            if elf_info is not None:
+                self.elf_files[relative_path] = elf_info
+
+    def is_library(self, relative_path):
+        """Checks if an ELF file is a shared library in a standard library folder, which can be pruned"""
+        folder, _, name = relative_path.rpartition('/')
+        return is_library_folder(folder) and is_library_name(name)
+
+    def _resolve_links(self, relative_path):
+        for _ in range(MAX_LINK_DEPTH):
+            if relative_path not in self.links:
+                break
+            relative_path = self.links[relative_path]
+        return relative_path
+
+    def _search_folders(self, relative_path, elf_info):
+        """Returns the folders inside the snap of the run path of an ELF file"""
+        origin = os.path.dirname(relative_path)
+        folders = []
+        for folder in elf_info.runpath:
+            if ("$ORIGIN" in folder) or ("${ORIGIN}" in folder):
+                folder = folder.replace("${ORIGIN}", "/" + origin).replace("$ORIGIN", "/" + origin)
+            folder = _resolve_link_target(relative_path, folder) if folder.startswith('/') else None
+            if folder is not None:
+                folders.append(folder)
+        return folders
+
+    def resolve(self, relative_path, needed):
+        """Returns the path of the library loaded for a DT_NEEDED entry of an ELF file
+
+        Parameters
+        ----------
+        relative_path : string
+            The path of the ELF file that needs the library.
+        needed : string
+            The DT_NEEDED entry.
+
+        Returns
+        -------
+        string, True or None
+            The path of the library in the folder, True if it is loaded from a
+            base snap, or None if it can't be found.
+        """
+        elf_info = self.elf_files[relative_path]
+        candidates = [f"{folder}/{needed}" for folder in self._search_folders(relative_path, elf_info)]
+        candidates += self.library_names.get(needed, [])
+        for candidate in candidates:
+            library = self._resolve_links(candidate)
+            library_info = self.elf_files.get(library)
+            if (library_info is not None) and (library_info.abi == elf_info.abi):
+                return library
+        key = f"{needed}:{elf_info.elf_class}:{elf_info.machine}"
+        for soname_index in self.soname_indexes:
+            if key in soname_index:
+                return True
+        return None
+
+    def find_reachable(self):
+        """Returns the ELF files reachable from the roots"""
+        pending = [relative_path for relative_path in self.elf_files
+                   if not self.is_library(relative_path) or self.allow_matcher.is_excluded(relative_path)]
+        reachable = set(pending)
+        while len(pending) != 0:
+            relative_path = pending.pop()
+            for needed in self.elf_files[relative_path].needed:
+                library = self.resolve(relative_path, needed)
+                if library is None:
+                    self.missing.setdefault(needed, []).append(relative_path)
+                elif (library is not True) and (library not in reachable):
+                    reachable.add(library)
+                    pending.append(library)
+        return reachable
+
+    def find_unreachable(self):
+        """Returns the libraries that can't be reached, and the symlinks that point to them
+
+        Returns
+        -------
+        tuple with two arrays of strings
+            The unreachable libraries and the symlinks that point to them,
+            sorted, relative to the snap folder.
+        """
+        reachable = self.find_reachable()
+        unreachable = sorted(relative_path for relative_path in self.elf_files
+                             if self.is_library(relative_path) and (relative_path not in reachable))
+        unreachable_set = set(unreachable)
+        links = sorted(link for link in self.links if self._resolve_links(link) in unreachable_set)
+        return unreachable, links
+
+
+def prune_unreachable(snap_folder, extensions_paths, allowlist=DLOPEN_ALLOWLIST, cache_folder=None, verbose=False,
+                      dry_run=True):
+    """Searches, and optionally removes, the shared libraries that no ELF file in a folder needs
+
+    Parameters
+    ----------
+    snap_folder : string
+        The folder to analyze. It must contain all the snap (like the prime
+        folder), because the libraries used only by other parts would be
+        considered unreachable.
+    extensions_paths : array of tuples with two elements
+        The list of extensions paths, as returned by generate_extensions_paths(),
+        used to know which libraries are loaded from the base snaps.
+    allowlist : array of strings, optional
+        fnmatch rules for the libraries loaded with dlopen(), which must be kept.
+    cache_folder : string or None, optional
+        The folder where the soname indexes of the base snaps are stored.
+    verbose : bool, optional
+        Show extra verbose information, by default False
+    dry_run : bool, optional
+        Only report the libraries, without removing them, by default True
+
+    Returns
+    -------
+    dictionary
+        The report, with the unreachable libraries, the symlinks that point to
+        them, the bytes that they use, and the DT_NEEDED entries that can't be
+        found with the files that need them.
+    """
+    soname_indexes = [load_soname_index(folder, cache_folder, verbose) for folder, _ in extensions_paths]
+    graph = LibraryGraph(snap_folder, soname_indexes, allowlist)
+    unreachable, links = graph.find_unreachable()
+    removed_bytes = 0
+    for relative_path in unreachable + links:
+        full_path = os.path.join(snap_folder, relative_path)
+        if relative_path in graph.elf_files:
+            removed_bytes += os.lstat(full_path).st_size
+        if verbose:
+            print(f"{'Would remove' if dry_run else 'Removing'} unreachable library {relative_path}")
+        if not dry_run:
+            os.remove(full_path)
+    return {"folder": snap_folder,
+            "dry_run": dry_run,
+            "elf_files": len(graph.elf_files),
+            "unreachable": unreachable,
+            "links": links,
+            "removed_bytes": removed_bytes,
+            "missing": {needed: sorted(users) for needed, users in sorted(graph.missing.items())}}
+
+
+def hash_file_start(file_path, size=PARTIAL_HASH_SIZE):
+    """Returns the SHA-256 hash of the first bytes of a file, to discard quickly the files that differ"""
+    with open(file_path, "rb") as file_data:
+        return hashlib.sha256(file_data.read(size)).hexdigest()
+
+
+def _replace_with_link(file_path, target_path, mode):
+    """Replaces a file with a hardlink or a relative symlink to another file
+
+    The link is created with a temporary name in the same folder and renamed
+    over the file, so the file is never missing.
+    """
+    folder = os.path.dirname(file_path)
+    temporary_path = os.path.join(folder, f".tmp-link-{os.getpid()}-{threading.get_ident()}")
+    if mode == "symlink":
+        os.symlink(os.path.relpath(target_path, folder), temporary_path)
+    else:
+        os.link(target_path, temporary_path)
+    try:
+        os.replace(temporary_path, file_path)
+    except OSError:
+        os.remove(temporary_path)
+        raise
+
+
+def link_identical_files(snap_folder, exclude_list=[], mode="hardlink", jobs=None, verbose=False, dry_run=False):
+    """Replaces the identical files inside a folder with links to one of them
+
+    The files are grouped by size and permissions, then by the hash of their
+    first bytes and finally by the hash of their whole contents, so only the
+    files that can be identical are read. To keep the memory bounded, the
+    folder is walked twice: first to count how many files have each size, and
+    then to keep only the paths of the files whose size is repeated.
+
+    Parameters
+    ----------
+    snap_folder : string
+        The folder to process, usually CRAFT_PART_INSTALL.
+    exclude_list : array of strings, optional
+        fnmatch rules for the files that must not be changed.
+    mode : string, optional
+        "hardlink" to replace the copies with hardlinks, or "symlink" to
+        replace them with relative symlinks, by default "hardlink".
+    jobs : int or None, optional
+        Number of threads used to hash files, or None to use one per CPU
+    verbose : bool, optional
+        Show extra verbose information, by default False
+    dry_run : bool, optional
+        Don't change any file, only report them, by default False
+
+    Returns
+    -------
+    dictionary
+        The report, with the number of files checked and replaced, and the
+        bytes saved.
+    """
+    exclude_matcher = ExcludeMatcher(exclude_list)
+
+    def walk_files():
+        for relative_file_path, entry in walk_install_folder(snap_folder, exclude_matcher):
+            if not entry.is_file(follow_symlinks=False) or exclude_matcher.is_excluded(relative_file_path):
+                continue
+            file_stat = entry.stat(follow_symlinks=False)
+            if file_stat.st_size != 0:
+                yield relative_file_path, (file_stat.st_size, stat.S_IMODE(file_stat.st_mode)), file_stat
+
+    counts = {}
+    scanned_files = 0
+    for _, key, _ in walk_files():
+        counts[key] = counts.get(key, 0) + 1
+        scanned_files += 1
+    groups = {}
+    for relative_file_path, key, file_stat in walk_files():
+        if counts.get(key, 0) > 1:
+            groups.setdefault(key, []).append((relative_file_path, (file_stat.st_dev, file_stat.st_ino)))
+    counts = None
+
+    report = {"folder": snap_folder, "dry_run": dry_run, "mode": mode, "scanned_files": scanned_files,
+              "linked_files": 0, "saved_bytes": 0}
+    jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for (size, _), files in sorted(groups.items()):
+            # the hardlinks of an already processed file are a single file
+            inodes = {}
+            for relative_file_path, inode in sorted(files):
+                inodes.setdefault(inode, relative_file_path)
+            if len(inodes) < 2:
+                continue
+            paths = list(inodes.values())
+            full_paths = [os.path.join(snap_folder, relative_file_path) for relative_file_path in paths]
+            if size > PARTIAL_HASH_SIZE:
+                partial_hashes = list(executor.map(hash_file_start, full_paths))
+                hash_counts = {}
+                for partial_hash in partial_hashes:
+                    hash_counts[partial_hash] = hash_counts.get(partial_hash, 0) + 1
+                candidates = [position for position, partial_hash in enumerate(partial_hashes)
+                              if hash_counts[partial_hash] > 1]
+            else:
+                candidates = list(range(len(paths)))
+            full_hashes = executor.map(hash_file, [full_paths[position] for position in candidates])
+            originals = {}
+            for position, full_hash in zip(candidates, full_hashes):
+                if full_hash not in originals:
+                    originals[full_hash] = position
+                    continue
+                original = originals[full_hash]
+                if verbose:
+                    print(f"{'Would replace' if dry_run else 'Replacing'} {paths[position]} with a {mode} to "
+                          f"{paths[original]}")
+                if not dry_run:
+                    _replace_with_link(full_paths[position], full_paths[original], mode)
+                report["linked_files"] += 1
+                report["saved_bytes"] += size
+    return report
+
+
+def write_report(report_data, report_path):
+    """Writes a report in JSON format
+
+    Parameters
+    ----------
+    report_data : dictionary
+        The report, like the one returned by DedupReport.to_dict().
+    report_path : string
+        The path of the file, or '-' to write it in the standard output.
+    """
+    if report_path == "-":
+        print(json.dumps(report_data, indent=2))
+        return
+    with open(report_path, "w") as report_file:
+        json.dump(report_data, report_file, indent=2)
+
+
+def main(snap_folder, extensions_paths, exclude_list=[], verbose=False, quiet=True, cache_folder=None,
+         verify_content=False, jobs=None, stage_folder=None, dry_run=False, report_path=None, io_threads=0,
+         sonames=False, link_mode=None):
+    """Main function
+
+    Searches each file in 'snap_folder' inside each path in 'extensions_paths'
+    to check if it is already available there, deleting it in that case, unless
+    it matches any of the rules in 'exclude_list'. It is a shortcut to create a
+    Deduplicator and process a single folder with it.
+
+    The check is done based only on the relative path and file name relative to
+    'snap_folder', searching that inside each path in 'extensions_paths', although
+    taking into account the mapping. If 'verify_content' is True, the file is
+    deleted only if it is also identical to the copy in the extension.
+
+    Parameters
+    ----------
+    snap_folder : string
+        The path of the folder where the staged .deb have been uncompressed (usually
+        CRAFT_PART_INSTALL)
+    extensions_paths : array of tuples with two elements
+        An array with tuples containing each one a string with the root
+        path for one of the extensions snap, and, if required, another
+        string with the mapping for that snap (or None if no mapping is
+        required for that snap).
+    exclude_list : array of strings
+        A list of fnmatch rules for excluding files and/or paths
+    verbose : bool, optional
+        Show extra verbose information, by default False
+    quiet : bool, optional
+        Don't show messages, by default False
+    cache_folder : string or None, optional
+        The folder where the path index and the file hashes of each extension
+        snap are stored, or None to not store them, by default None
+    verify_content : bool, optional
+        Remove only the files whose contents are identical to the ones in the
+        extension, by default False
+    jobs : int or None, optional
+        Number of threads used to hash files, or None to use one per CPU
+    stage_folder : string or None, optional
+        The stage folder, to also remove the files already staged by other
+        parts, or None to not check it, by default None
+    dry_run : bool, optional
+        Don't remove any file, only report them, by default False
+    report_path : string or None, optional
+        The file where to write a JSON report with the removed files, '-'
+        to write it in the standard output, or None to not write it
+    io_threads : int, optional
+        Number of threads used to search and remove the files of each folder,
+        or 0 to do it sequentially, by default 0
+    sonames : bool, optional
+        Also remove the libraries with the same soname and ABI than one in
+        the extensions, even if their paths differ, by default False
+    link_mode : string or None, optional
+        After removing the duplicates, replace the identical files inside the
+        folder with "hardlink"s or "symlink"s, or None to not do it
+
+    Returns
+    -------
+    DedupReport
+        The statistics of the removed files.
+    """
+
+    deduplicator = Deduplicator(extensions_paths, exclude_list, verbose, cache_folder, verify_content, jobs,
+                                stage_folder, dry_run, io_threads, sonames)
+    report = DedupReport(snap_folder, dry_run)
+    duplicated_bytes = deduplicator.process(snap_folder, report)
+    report_data = report.to_dict()
+    if link_mode is not None:
+        report_data["links"] = link_identical_files(snap_folder, exclude_list, link_mode, jobs, verbose, dry_run)
+    if report_path is not None:
+        write_report(report_data, report_path)
+    if not quiet and report_path != "-":
+        print(f"{'Would remove' if dry_run else 'Removed'} {duplicated_bytes} bytes in duplicated files")
+        if link_mode is not None:
+            print(f"{'Would replace' if dry_run else 'Replaced'} {report_data['links']['linked_files']} identical "
+                  f"files with {link_mode}s, saving {report_data['links']['saved_bytes']} bytes")
+    return report
+
+
+def create_parser():
+    """Returns the parser for the command line arguments"""
+    parser = argparse.ArgumentParser(prog="remove_common",
+                                     description="An utility to remove from snaps files that are already available "
+                                                 "in extensions")
+    parser.add_argument('extension', nargs='*', default=[])
+    parser.add_argument('-e', '--exclude', nargs='+', help="A list of files and directories to exclude from checking")
+    parser.add_argument('-m', '--map', nargs='+', default=[], help="A list of snap_name:path pairs")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help="Show extra info")
+    parser.add_argument('-q', '--quiet', action='store_true', default=False, help="Don't show any message")
+    parser.add_argument('-c', '--cache-dir', default=None,
+                        help="Folder where to store the path index of each base snap")
+    parser.add_argument('--verify-content', action='store_true', default=False,
+                        help="Remove only the files that are identical to the ones in the base snaps")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of threads used to compare files and process parts")
+    parser.add_argument('--io-threads', type=int, default=0,
+                        help="Number of threads used to search and remove the files of each folder, useful in slow "
+                             "filesystems (0 to do it sequentially)")
+    parser.add_argument('--sonames', action='store_true', default=False,
+                        help="Also remove the libraries whose soname is available in the base snaps in another path")
+    parser.add_argument('--link-identical', nargs='?', const="hardlink", default=None, choices=["hardlink", "symlink"],
+                        help="Replace the identical files inside the install folder with hardlinks (by default) or "
+                             "relative symlinks")
+    parser.add_argument('--unreachable', action='store_true', default=False,
+                        help="Write a JSON report with the libraries that no ELF file of the snap needs, and exit")
+    parser.add_argument('--prune-unreachable', action='store_true', default=False,
+                        help="Remove the libraries that no ELF file of the snap needs, and exit")
+    parser.add_argument('--allow', nargs='+', default=[],
+                        help="fnmatch rules for libraries loaded with dlopen(), that must never be pruned")
+    parser.add_argument('--target-dir', default=None,
+                        help="Folder analyzed with --unreachable and --prune-unreachable (by default, CRAFT_PRIME)")
+    parser.add_argument('-a', '--all-parts', action='store_true', default=False,
+                        help="Process the install folder of every part in snapcraft.yaml, "
+                             "comparing only with the base snaps")
+    parser.add_argument('--parts-dir', default=None, help="Folder with all the parts, used with --all-parts")
+    parser.add_argument('--record-stage', action='store_true', default=False,
+                        help="Read again the stage folders where the current part has staged its files, "
+                             "updating the stage index, and exit")
+    parser.add_argument('-n', '--dry-run', action='store_true', default=False,
+                        help="Don't remove anything, only write a JSON report with the files that would be removed")
+    parser.add_argument('-r', '--report', default=None,
+                        help="Write a JSON report with the removed files in this file ('-' for the standard output)")
+    return parser
+
+
+def run(argv=None):
+    """Runs remove_common as a command line tool
+
+    Parameters
+    ----------
+    argv : array of strings or None
+        The command line arguments, or None to use the ones in sys.argv.
+
+    Returns
+    -------
+    int
+        The exit code.
+    """
+    args = create_parser().parse_args(argv)
+    verbose = args.verbose
+    cache_folder = args.cache_dir if args.cache_dir is not None else get_cache_folder()
+
+    if args.record_stage:
+        stage_index = StageIndex(os.environ["CRAFT_STAGE"], cache_folder)
+        part_name = os.environ.get("CRAFT_PART_NAME",
+                                   os.path.basename(os.path.dirname(os.environ["CRAFT_PART_INSTALL"])))
+        stage_index.refresh_part(os.environ["CRAFT_PART_INSTALL"])
+        stage_index.save()
+        if not args.quiet:
+            print(f"Updated the stage index with the folders staged by {part_name}")
+        return 0
+
+    report_path = args.report
+    if (args.dry_run or args.unreachable) and (report_path is None):
+        report_path = "-"
+    quiet = args.quiet or (report_path == "-")
+
+    exclude_list = global_excludes.copy()
+    if args.exclude is not None:
+        exclude_list += args.exclude
+
+    snapcraft_data = None
+    if args.all_parts or len(args.extension) == 0:
+        snapcraft_data = load_snapcraft_data()
+
+    extensions = get_extension_list(args.extension, snapcraft_data)
+    if len(extensions) == 0:
+        print("Called remove_common.py without a list of snaps, and no 'build-snaps' entry in the snapcraft.yaml file. Aborting.")
+        return 1
+
+    mappings = generate_mappings(global_maps, args.map)
+
+    if verbose:
+        print(f"Removing duplicates already in {extensions}")
+
+    extensions_paths = generate_extensions_paths(extensions, mappings)
+
+    if args.unreachable or args.prune_unreachable:
+        target_folder = args.target_dir
+        if target_folder is None:
+            target_folder = os.environ.get("CRAFT_PRIME") or os.environ["CRAFT_PART_INSTALL"]
+        dry_run = args.dry_run or not args.prune_unreachable
+        unreachable_report = prune_unreachable(target_folder, extensions_paths, DLOPEN_ALLOWLIST + args.allow,
+                                               cache_folder, verbose, dry_run)
+        if report_path is not None:
+            write_report(unreachable_report, report_path)
+        if not quiet:
+            print(f"{'Would remove' if dry_run else 'Removed'} {len(unreachable_report['unreachable'])} unreachable "
+                  f"libraries ({unreachable_report['removed_bytes']} bytes)")
+        return 0
+
+    if args.all_parts:
+        # The stage isn't checked, because it already contains the files
+        # of the parts that have been staged.
+        parts_folder = args.parts_dir if args.parts_dir is not None else get_parts_folder()
+        install_folders = get_parts_install_folders(parts_folder, snapcraft_data["parts"])
+        deduplicator = Deduplicator(extensions_paths, exclude_list, verbose, cache_folder, args.verify_content,
+                                    args.jobs, dry_run=args.dry_run, io_threads=args.io_threads,
+                                    sonames=args.sonames)
+        reports = {}
+        freed_bytes = deduplicator.process_parts(install_folders, args.jobs, reports)
+        reports_data = {part_name: reports[part_name].to_dict() for part_name in reports}
+        if args.link_identical is not None:
+            for part_name, install_folder in install_folders.items():
+                reports_data[part_name]["links"] = link_identical_files(install_folder, exclude_list,
+                                                                        args.link_identical, args.jobs, verbose,
+                                                                        args.dry_run)
+        if report_path is not None:
+            total_report = DedupReport(parts_folder, args.dry_run)
+            for part_report in reports.values():
+                total_report.merge(part_report)
+            write_report({"parts": reports_data, "total": total_report.to_dict()}, report_path)
+        if not quiet:
+            action = 'Would remove' if args.dry_run else 'Removed'
+            for part_name in freed_bytes:
+                print(f"{action} {freed_bytes[part_name]} bytes in duplicated files from {part_name}")
+            print(f"{action} {sum(freed_bytes.values())} bytes in duplicated files from {len(freed_bytes)} parts")
+        return 0
+
+    # This is the folder where to check for duplicates that are already
+    # in other snaps, or in the stage because they were built in other
+    # parts.
+    snap_folder = os.environ["CRAFT_PART_INSTALL"]
+
+    main(snap_folder, extensions_paths, exclude_list, verbose, quiet, cache_folder, args.verify_content, args.jobs,
+         os.environ["CRAFT_STAGE"], args.dry_run, report_path, args.io_threads, args.sonames, args.link_identical)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 
 import os
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import json
+import fnmatch
+import hashlib
 import remove_common
 import shutil
+import struct
 import unittest
 import tempfile
+import threading
+import zlib
 
 ONLY_IN_INSTALL = 0
 IN_BOTH = 1
@@ -79,6 +89,142 @@ class base_system:
         return os.path.exists(full_path)
 
 
+def write_squashfs(image_path, files=(), folders=(), symlinks={}, compress=True):
+    """Writes a minimal squashfs 4.0 image with empty files, folders and symlinks.
+
+    The inode table is stored uncompressed, so the position of each inode is
+    known before building the directory table, which is compressed if
+    'compress' is True."""
+    children = {"": {}}
+
+    def add_folder(path):
+        if path in children:
+            return
+        parent, _, name = path.rpartition('/')
+        add_folder(parent)
+        children[parent][name] = (1, path)
+        children[path] = {}
+
+    for path in folders:
+        add_folder(path)
+    for path in files:
+        parent, _, name = path.rpartition('/')
+        add_folder(parent)
+        children[parent][name] = (2, path)
+    for path, target in symlinks.items():
+        parent, _, name = path.rpartition('/')
+        add_folder(parent)
+        children[parent][name] = (3, target)
+
+    # inodes: (type, key) where key is the folder path, the file path or the symlink target
+    nodes = [(1, path) for path in sorted(children)]
+    for folder in sorted(children):
+        nodes += [node for node in children[folder].values() if node[0] != 1]
+    numbers = {node: position + 1 for position, node in enumerate(nodes)}
+    references = {}
+    position = 0
+    for node in nodes:
+        references[node] = (((position // 8192) * 8194) << 16) | (position % 8192)
+        position += 32 if node[0] != 3 else 24 + len(node[1].encode())
+
+    listings = b""
+    listing_positions = {}
+    for folder in sorted(children):
+        listing_positions[folder] = (len(listings), 0)
+        start = len(listings)
+        entries = sorted(children[folder].items(), key=lambda item: item[0].encode())
+        while len(entries) != 0:
+            block = references[entries[0][1]] >> 16
+            group = list(itertools.takewhile(lambda entry: references[entry[1]] >> 16 == block, entries[:256]))
+            entries = entries[len(group):]
+            base_number = numbers[group[0][1]]
+            listings += struct.pack("<III", len(group) - 1, block, base_number)
+            for name, node in group:
+                name = name.encode()
+                listings += struct.pack("<HhHH", references[node] & 0xFFFF, numbers[node] - base_number, node[0],
+                                        len(name) - 1) + name
+        listing_positions[folder] = (start, len(listings) - start)
+
+    directory_table = b""
+    block_starts = []
+    for start in range(0, len(listings), 8192):
+        chunk = listings[start:start + 8192]
+        block_starts.append(len(directory_table))
+        compressed = zlib.compress(chunk)
+        if compress and len(compressed) < len(chunk):
+            directory_table += struct.pack("<H", len(compressed)) + compressed
+        else:
+            directory_table += struct.pack("<H", 0x8000 | len(chunk)) + chunk
+
+    inodes = b""
+    for node in nodes:
+        inodes += struct.pack("<HHHHII", node[0], 0o755, 0, 0, 0, numbers[node])
+        if node[0] == 1:
+            start, size = listing_positions[node[1]]
+            block_start = block_starts[start // 8192] if size != 0 else 0
+            parent = numbers.get((1, node[1].rpartition('/')[0]), len(nodes) + 1) if node[1] else len(nodes) + 1
+            subfolders = len([child for child in children[node[1]].values() if child[0] == 1])
+            inodes += struct.pack("<IIHHI", block_start, 2 + subfolders, size + 3, start % 8192, parent)
+        elif node[0] == 2:
+            inodes += struct.pack("<IIII", 0, 0xFFFFFFFF, 0, 0)
+        else:
+            inodes += struct.pack("<II", 1, len(node[1].encode())) + node[1].encode()
+    inode_table = b""
+    for start in range(0, len(inodes), 8192):
+        chunk = inodes[start:start + 8192]
+        inode_table += struct.pack("<H", 0x8000 | len(chunk)) + chunk
+
+    directory_table_start = 96 + len(inode_table)
+    id_block_start = directory_table_start + len(directory_table)
+    id_table_start = id_block_start + 6
+    bytes_used = id_table_start + 8
+    superblock = struct.pack("<IIIIIHHHHHHQQQQQQQQ", 0x73717368, len(nodes), 0, 131072, 0, 1, 17, 0x1B, 1, 4, 0,
+                             references[(1, "")], bytes_used, id_table_start, 0xFFFFFFFFFFFFFFFF, 96,
+                             directory_table_start, 0xFFFFFFFFFFFFFFFF, 0xFFFFFFFFFFFFFFFF)
+    with open(image_path, "wb") as image_file:
+        image_file.write(superblock + inode_table + directory_table)
+        image_file.write(struct.pack("<HI", 0x8004, 0) + struct.pack("<Q", id_block_start))
+
+
+def write_elf(path, soname=None, needed=(), runpath=None, elf_class=2, machine=62, elf_type=3):
+    """Writes a minimal little-endian ELF file with a dynamic section.
+
+    The file is a single loadable segment mapped at 0x1000, so the address of
+    the string table differs from its offset in the file."""
+    strings = b"\0"
+    dynamic = []
+    for tag, text in [(1, name) for name in needed] + [(14, soname), (29, runpath)]:
+        if text is not None:
+            dynamic.append((tag, len(strings)))
+            strings += text.encode() + b"\0"
+    if elf_class == 2:
+        header_size, program_header_size, dynamic_format = 64, 56, "<qQ"
+    else:
+        header_size, program_header_size, dynamic_format = 52, 32, "<iI"
+    base_address = 0x1000
+    strings_offset = header_size + 2 * program_header_size
+    dynamic_offset = strings_offset + len(strings)
+    dynamic += [(5, base_address + strings_offset), (10, len(strings)), (0, 0)]
+    dynamic_data = b"".join(struct.pack(dynamic_format, tag, value) for tag, value in dynamic)
+    size = dynamic_offset + len(dynamic_data)
+    ident = b"\x7fELF" + bytes([elf_class, 1, 1]) + bytes(9)
+    if elf_class == 2:
+        header = ident + struct.pack("<HHIQQQIHHHHHH", elf_type, machine, 1, 0, header_size, 0, 0, header_size,
+                                     program_header_size, 2, 64, 0, 0)
+        header += struct.pack("<IIQQQQQQ", 1, 5, 0, base_address, base_address, size, size, 0x1000)
+        header += struct.pack("<IIQQQQQQ", 2, 6, dynamic_offset, base_address + dynamic_offset,
+                              base_address + dynamic_offset, len(dynamic_data), len(dynamic_data), 8)
+    else:
+        header = ident + struct.pack("<HHIIIIIHHHHHH", elf_type, machine, 1, 0, header_size, 0, 0, header_size,
+                                     program_header_size, 2, 40, 0, 0)
+        header += struct.pack("<IIIIIIII", 1, 0, base_address, base_address, size, size, 5, 0x1000)
+        header += struct.pack("<IIIIIIII", 2, dynamic_offset, base_address + dynamic_offset,
+                              base_address + dynamic_offset, len(dynamic_data), len(dynamic_data), 6, 4)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as elf_file:
+        elf_file.write(header + strings + dynamic_data)
+
+
 class TestRemoveCommon(unittest.TestCase):
 
     def test_dups_are_removed(self):
@@ -123,6 +269,231 @@ class TestRemoveCommon(unittest.TestCase):
         self.assertTrue(b.file_exists("usr/bin/more/a3"))
         self.assertTrue(b.file_exists("usr/bin/more/another/a4"))
 
+    def test_walk_install_folder(self):
+        b = base_system()
+        b.create_file("usr/bin/a1", ONLY_IN_INSTALL)
+        b.create_file("usr/bin/more/a2", ONLY_IN_INSTALL)
+        b.create_file("usr/lib/.hidden", ONLY_IN_INSTALL)
+        b.create_file("usr/share/doc/pkg/a3", ONLY_IN_INSTALL)
+        b.create_file("usr/share/doc2/a4", ONLY_IN_INSTALL)
+        os.symlink("bin", os.path.join(b._install_path, "usr", "sbin"))
+        exclude_matcher = remove_common.ExcludeMatcher(["usr/share/doc/*"])
+        paths = sorted(path for path, _ in remove_common.walk_install_folder(b._install_path, exclude_matcher))
+        self.assertEqual(paths, ["usr/bin/a1", "usr/bin/more/a2", "usr/sbin", "usr/share/doc2/a4"])
+        b.delete_folders()
+
+    def test_walk_install_tree(self):
+        b = base_system()
+        b.create_file("usr/bin/a1", ONLY_IN_INSTALL)
+        b.create_file("usr/bin/more/a2", ONLY_IN_INSTALL)
+        b.create_file("usr/lib/.hidden", ONLY_IN_INSTALL)
+        b.create_file("usr/share/doc/pkg/a3", ONLY_IN_INSTALL)
+        os.symlink("bin", os.path.join(b._install_path, "usr", "sbin"))
+        exclude_matcher = remove_common.ExcludeMatcher(["usr/share/doc/*"])
+        open_fds = len(os.listdir("/proc/self/fd"))
+        folders = []
+        for install_folder in remove_common.walk_install_tree(b._install_path, exclude_matcher):
+            folders.append((install_folder.relative_path, sorted(entry.name for entry in install_folder.files)))
+        self.assertEqual(len(os.listdir("/proc/self/fd")), open_fds)
+        self.assertEqual(sorted(folders), [("", []), ("usr/", ["sbin"]), ("usr/bin/", ["a1"]),
+                                           ("usr/bin/more/", ["a2"]), ("usr/lib/", []), ("usr/share/", [])])
+        # each folder is returned after its subfolders
+        paths = [path for path, _ in folders]
+        self.assertLess(paths.index("usr/bin/more/"), paths.index("usr/bin/"))
+        self.assertLess(paths.index("usr/bin/"), paths.index("usr/"))
+        self.assertEqual(paths[-1], "")
+        b.delete_folders()
+
+    def test_emptied_folders_are_removed(self):
+        b = base_system()
+        b.create_file("usr/share/doc/pkg1/copyright", IN_BOTH)
+        b.create_file("usr/share/doc/pkg1/examples/example.c", IN_BOTH)
+        b.create_file("usr/share/doc/pkg2/copyright", IN_BOTH)
+        b.create_file("usr/share/doc/pkg2/.hidden", ONLY_IN_INSTALL)
+        b.create_file("usr/share/doc/pkg3/copyright", IN_BOTH)
+        b.create_file("usr/share/doc/pkg3/excluded/README", IN_BOTH)
+        b.create_file("usr/bin/a1", IN_BOTH)
+        b.create_folder("usr/lib/empty", ONLY_IN_INSTALL)
+        exclude = ["usr/share/doc/pkg3/excluded/*"]
+        report = remove_common.main(b._install_path, [(b._gnome_46_path, None)], exclude, dry_run=True)
+        self.assertEqual(report.removed_folders, 3)
+        self.assertTrue(b.file_exists("usr/share/doc/pkg1/examples"))
+        report = remove_common.main(b._install_path, [(b._gnome_46_path, None)], exclude)
+        self.assertEqual(report.removed_folders, 3)
+        for path, exists in [("usr/share/doc/pkg1", False), ("usr/share/doc/pkg2", True),
+                             ("usr/share/doc/pkg3/excluded/README", True), ("usr/share/doc/pkg3/copyright", False),
+                             ("usr/bin", False), ("usr/lib/empty", True)]:
+            self.assertEqual(b.file_exists(path), exists, path)
+        b.delete_folders()
+
+    def test_io_threads(self):
+        b = base_system()
+        for number in range(40):
+            b.create_file(f"usr/lib/folder{number % 4}/file{number}", IN_BOTH if number % 3 else ONLY_IN_INSTALL)
+        outputs = []
+        for io_threads in [0, 4]:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                deduplicator = remove_common.Deduplicator([(b._gnome_46_path, None)], verbose=True, dry_run=True,
+                                                          io_threads=io_threads)
+                report = remove_common.DedupReport()
+                deduplicator.process(b._install_path, report)
+            outputs.append((output.getvalue(), report.removed_files, report.removed_bytes, report.by_folder))
+        # the threads don't change the order of the messages
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0][1], 26)
+        deduplicator = remove_common.Deduplicator([(b._gnome_46_path, None)], io_threads=4)
+        deduplicator.process(b._install_path)
+        for number in range(40):
+            self.assertEqual(b.file_exists(f"usr/lib/folder{number % 4}/file{number}"), number % 3 == 0)
+        b.delete_folders()
+
+    def test_exclude_matcher_folders(self):
+        matcher = remove_common.ExcludeMatcher(["usr/lib/*", "usr/bin/*", "usr/lib/*/gdk-pixbuf*", "usr/bin/"])
+        self.assertEqual(matcher.match_folder("usr/bin"), "usr/bin/*")
+        self.assertEqual(matcher.match_folder("usr/bin/more"), "usr/bin/*")
+        self.assertEqual(matcher.match_folder("usr/lib/x86/gdk-pixbuf-2.0"), "usr/lib/*")
+        self.assertIsNone(matcher.match_folder("usr"))
+        matcher = remove_common.ExcludeMatcher(["usr/share/icons/*/index.theme", "usr/lib/*/gdk-pixbuf*"])
+        self.assertIsNone(matcher.match_folder("usr/share/icons/hicolor"))
+        self.assertEqual(matcher.match_folder("usr/lib/x86/gdk-pixbuf-2.0"), "usr/lib/*/gdk-pixbuf*")
+
+    def test_exclude_matcher_is_fnmatch(self):
+        rules = ["usr/share/icons/*/index.theme", "usr/share/locale/*", "*.typelib", "usr/lib/[!a]*/libx?.so",
+                 "usr/share/locale/de/*", "usr/lib/*/a*b*c", "usr/share/doc/*"]
+        paths = ["usr/share/icons/hicolor/index.theme", "usr/share/icons/index.theme", "usr/share/locale/de/file.mo",
+                 "usr/share/locale", "usr/lib/girepository-1.0/Gtk.typelib", "usr/lib/x86/libx1.so",
+                 "usr/lib/a86/libx1.so", "usr/lib/x/y/aXbYc", "usr/lib/x/y/aXbY", "usr/share/doc/pkg/copyright",
+                 "usr/bin/ls"]
+        matcher = remove_common.ExcludeMatcher(rules)
+        for path in paths:
+            expected = None
+            for rule in rules:
+                if fnmatch.fnmatch(path, rule):
+                    expected = rule
+                    break
+            self.assertEqual(matcher.match(path), expected)
+            self.assertEqual(matcher.is_excluded(path), expected is not None)
+
+    def test_deduplicator_reused(self):
+        b1 = base_system()
+        b1.create_file("usr/bin/a1", IN_BOTH)
+        b1.create_file("usr/bin/a2", ONLY_IN_INSTALL)
+        # the second install folder uses the same extensions than the first one
+        install_path2 = os.path.join(b1._base_folder, "install2")
+        os.makedirs(os.path.join(install_path2, "usr", "bin"))
+        open(os.path.join(install_path2, "usr", "bin", "a1"), "w").close()
+        open(os.path.join(install_path2, "usr", "bin", "a3"), "w").close()
+        deduplicator = remove_common.Deduplicator([(b1._gnome_46_path, None), (b1._gtk_common_themes_path, "usr/")],
+                                                  b1._exclude)
+        deduplicator.process(b1._install_path)
+        deduplicator.process(install_path2)
+        self.assertFalse(b1.file_exists("usr/bin/a1"))
+        self.assertTrue(b1.file_exists("usr/bin/a2"))
+        self.assertFalse(os.path.exists(os.path.join(install_path2, "usr", "bin", "a1")))
+        self.assertTrue(os.path.exists(os.path.join(install_path2, "usr", "bin", "a3")))
+        b1.delete_folders()
+
+    def test_run_command_line(self):
+        b = base_system()
+        b.create_file("usr/bin/a1", IN_BOTH)
+        b.create_file("usr/bin/a2", IN_BOTH)
+        b.create_file("usr/bin/a3", ONLY_IN_INSTALL)
+        os.environ["CRAFT_STAGE"] = b._gnome_46_path
+        os.environ["CRAFT_PART_INSTALL"] = b._install_path
+        result = remove_common.run(["non-existent-snap", "-q", "-e", "usr/bin/a2",
+                                    "-c", os.path.join(b._base_folder, "cache")])
+        self.assertEqual(result, 0)
+        self.assertFalse(b.file_exists("usr/bin/a1"))
+        self.assertTrue(b.file_exists("usr/bin/a2"))
+        self.assertTrue(b.file_exists("usr/bin/a3"))
+        # the command line excludes must not be added to the global ones
+        self.assertNotIn("usr/bin/a2", remove_common.global_excludes)
+        b.delete_folders()
+
+    def test_process_parts(self):
+        b = base_system()
+        b.create_file("usr/bin/a1", ONLY_IN_BASE)
+        b.create_file("usr/bin/a2", ONLY_IN_BASE)
+        parts_folder = os.path.join(b._base_folder, "parts")
+        for part_name, files in [("part1", ["a1", "a3"]), ("part2", ["a2"]), ("part3", ["a1", "a2"])]:
+            os.makedirs(os.path.join(parts_folder, part_name, "install", "usr", "bin"))
+            for name in files:
+                open(os.path.join(parts_folder, part_name, "install", "usr", "bin", name), "w").close()
+        install_folders = remove_common.get_parts_install_folders(parts_folder, ["part1", "part2", "part3", "part4"])
+        self.assertEqual(sorted(install_folders), ["part1", "part2", "part3"])
+        deduplicator = remove_common.Deduplicator([(b._gnome_46_path, None)])
+        freed_bytes = deduplicator.process_parts(install_folders, 2)
+        self.assertEqual(sorted(freed_bytes), ["part1", "part2", "part3"])
+        for part_name, name, exists in [("part1", "a1", False), ("part1", "a3", True), ("part2", "a2", False),
+                                        ("part3", "a1", False), ("part3", "a2", False)]:
+            self.assertEqual(os.path.exists(os.path.join(install_folders[part_name], "usr", "bin", name)), exists)
+        b.delete_folders()
+
+    def test_process_parts_shared_pools(self):
+        b = base_system()
+        b.create_file("usr/bin/a1", ONLY_IN_BASE)
+        parts_folder = os.path.join(b._base_folder, "parts")
+        install_folders = {}
+        for part_name in ["part1", "part2", "part3", "part4"]:
+            install_folders[part_name] = os.path.join(parts_folder, part_name, "install")
+            os.makedirs(os.path.join(install_folders[part_name], "usr", "bin"))
+            shutil.copy(os.path.join(b._gnome_46_path, "usr", "bin", "a1"),
+                        os.path.join(install_folders[part_name], "usr", "bin", "a1"))
+        cache_folder = os.path.join(b._base_folder, "cache")
+        os.makedirs(cache_folder)
+        deduplicator = remove_common.Deduplicator([(b._gnome_46_path, None)], cache_folder=cache_folder,
+                                                  verify_content=True, jobs=2, io_threads=2)
+        saves = []
+        verifier_save = deduplicator.verifier.save
+        deduplicator.verifier.save = lambda: saves.append(threading.active_count()) or verifier_save()
+        freed_bytes = deduplicator.process_parts(install_folders, 4)
+        self.assertEqual(sorted(freed_bytes), ["part1", "part2", "part3", "part4"])
+        for install_folder in install_folders.values():
+            self.assertFalse(os.path.exists(os.path.join(install_folder, "usr", "bin", "a1")))
+        # stored only once, after all the parts have been processed and their threads have finished
+        self.assertEqual(saves, [threading.active_count()])
+        b.delete_folders()
+
+    def test_get_parts_folder(self):
+        os.environ["CRAFT_PART_INSTALL"] = "/root/parts/part1/install"
+        self.assertEqual(remove_common.get_parts_folder(), "/root/parts")
+
+    def test_dry_run_report(self):
+        b = base_system()
+        b.create_file("usr/bin/a1", IN_BOTH)
+        b.create_file("usr/lib/a2", IN_BOTH)
+        b.create_file("usr/lib/a3", IN_BOTH)
+        b.create_file("etc/a4", IN_BOTH)
+        b.create_file("usr/bin/a5", ONLY_IN_INSTALL)
+        with open(os.path.join(b._install_path, "usr/lib/a2"), "w") as data:
+            data.write("12345")
+        report_path = os.path.join(b._base_folder, "report.json")
+        report = remove_common.main(b._install_path, [(b._gnome_46_path, None)], ["etc/*", "usr/lib/a3"], dry_run=True,
+                                    report_path=report_path)
+        for path in ["usr/bin/a1", "usr/lib/a2", "usr/lib/a3", "etc/a4", "usr/bin/a5"]:
+            self.assertTrue(b.file_exists(path))
+        with open(report_path) as report_file:
+            data = json.load(report_file)
+        self.assertEqual(data, report.to_dict())
+        self.assertTrue(data["dry_run"])
+        # the files inside excluded folders aren't even scanned
+        self.assertEqual(data["scanned_files"], 4)
+        self.assertEqual(data["excluded_files"], 1)
+        self.assertEqual(data["removed_files"], 2)
+        self.assertEqual(data["removed_bytes"], 5)
+        self.assertEqual(data["by_folder"], {"usr": {"files": 2, "bytes": 5}})
+        # folders that aren't a snap revision are reported by path
+        self.assertEqual(data["by_extension"], {b._gnome_46_path: {"files": 2, "bytes": 5}})
+        self.assertEqual(sorted(data["timings"]), ["match", "unlink", "walk"])
+        # without dry run the same files are removed
+        report = remove_common.main(b._install_path, [(b._gnome_46_path, None)], ["etc/*", "usr/lib/a3"])
+        self.assertEqual(report.to_dict()["by_folder"], data["by_folder"])
+        for path, exists in [("usr/bin/a1", False), ("usr/lib/a2", False), ("usr/lib/a3", True), ("etc/a4", True),
+                             ("usr/bin/a5", True)]:
+            self.assertEqual(b.file_exists(path), exists)
+        b.delete_folders()
+
     # Configure function tests
 
     def test_get_extension_list_from_cmdline(self):
@@ -164,5 +535,587 @@ class TestRemoveCommon(unittest.TestCase):
                 self.assertIsNone(entry[1])
 
 
+class TestPathIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._base_folder = tempfile.mkdtemp()
+        self._cache_folder = os.path.join(self._base_folder, "cache")
+        self._snap_path = os.path.join(self._base_folder, "snaps", "gtk-common-themes")
+        revision_path = os.path.join(self._snap_path, "35")
+        os.makedirs(os.path.join(revision_path, "share", "icons", "hicolor"))
+        os.makedirs(os.path.join(revision_path, "lib", "other"))
+        open(os.path.join(revision_path, "share", "icons", "hicolor", "icon1"), "w").close()
+        open(os.path.join(revision_path, "lib", "other", "lib1.so"), "w").close()
+        os.symlink("lib/other", os.path.join(revision_path, "lib64"))
+        os.symlink("35", os.path.join(self._snap_path, "current"))
+        self._current_path = os.path.join(self._snap_path, "current")
+
+    def tearDown(self):
+        shutil.rmtree(self._base_folder)
+
+    def test_snap_revision(self):
+        self.assertEqual(remove_common.get_snap_revision(self._current_path), ("gtk-common-themes", "35"))
+        self.assertIsNone(remove_common.get_snap_revision(os.path.join(self._snap_path, "35")))
+
+    def test_index_with_mapping(self):
+        index = remove_common.load_path_index(self._current_path, "usr/")
+        self.assertIn("usr/share/icons/hicolor/icon1", index)
+        self.assertIn("lib/other/lib1.so", index)
+        self.assertIn("usr/lib/other/lib1.so", index)
+        # unmapped paths are searched as-is, like check_if_exists() does
+        self.assertIn("share/icons/hicolor/icon1", index)
+        self.assertNotIn("usr/share/icons/hicolor/icon2", index)
+        # paths through symlinks to folders
+        self.assertEqual(index.find("usr/lib64/lib1.so"), "usr/lib/other/lib1.so")
+        self.assertEqual(index.find("lib64/lib1.so"), "usr/lib/other/lib1.so")
+        self.assertIsNone(index.find("lib64/lib2.so"))
+
+    def test_index_is_stored(self):
+        remove_common.load_path_index(self._current_path, None, self._cache_folder)
+        self.assertTrue(os.path.exists(os.path.join(self._cache_folder, "gtk-common-themes_35.index")))
+        # remove a file from the snap; the stored index must still have it
+        os.remove(os.path.join(self._snap_path, "35", "lib", "other", "lib1.so"))
+        index = remove_common.load_path_index(self._current_path, None, self._cache_folder)
+        self.assertIn("lib/other/lib1.so", index)
+        self.assertIn("share/icons/hicolor/icon1", index)
+
+    def test_unpinned_folders_arent_indexed(self):
+        indexes = remove_common.load_extensions_indexes([(os.path.join(self._snap_path, "35"), None),
+                                                         (self._current_path, None)], self._cache_folder)
+        self.assertIsNone(indexes[0])
+        self.assertIsNotNone(indexes[1])
+
+    def test_remove_with_index(self):
+        install_path = os.path.join(self._base_folder, "install")
+        os.makedirs(os.path.join(install_path, "usr", "share", "icons", "hicolor"))
+        os.makedirs(os.path.join(install_path, "usr", "lib64"))
+        open(os.path.join(install_path, "usr", "share", "icons", "hicolor", "icon1"), "w").close()
+        open(os.path.join(install_path, "usr", "share", "icons", "hicolor", "icon2"), "w").close()
+        open(os.path.join(install_path, "usr", "lib64", "lib1.so"), "w").close()
+        remove_common.main(install_path, [(self._current_path, "usr/")], cache_folder=self._cache_folder)
+        self.assertFalse(os.path.exists(os.path.join(install_path, "usr", "share", "icons", "hicolor", "icon1")))
+        self.assertTrue(os.path.exists(os.path.join(install_path, "usr", "share", "icons", "hicolor", "icon2")))
+        self.assertFalse(os.path.exists(os.path.join(install_path, "usr", "lib64", "lib1.so")))
+
+
+class TestVerifyContent(unittest.TestCase):
+
+    def setUp(self):
+        self._base_folder = tempfile.mkdtemp()
+        self._cache_folder = os.path.join(self._base_folder, "cache")
+        self._snap_path = os.path.join(self._base_folder, "snaps", "gnome-46")
+        self._install_path = os.path.join(self._base_folder, "install")
+        os.makedirs(os.path.join(self._snap_path, "12", "usr", "lib"))
+        os.makedirs(os.path.join(self._install_path, "usr", "lib"))
+        os.symlink("12", os.path.join(self._snap_path, "current"))
+        self._current_path = os.path.join(self._snap_path, "current")
+
+    def tearDown(self):
+        shutil.rmtree(self._base_folder)
+
+    def _write(self, path, content):
+        with open(path, "w") as file_data:
+            file_data.write(content)
+
+    def _create(self, name, base_content, install_content):
+        # the folder is removed when all its files are duplicated
+        os.makedirs(os.path.join(self._install_path, "usr", "lib"), exist_ok=True)
+        self._write(os.path.join(self._snap_path, "12", "usr", "lib", name), base_content)
+        self._write(os.path.join(self._install_path, "usr", "lib", name), install_content)
+
+    def _exists(self, name):
+        return os.path.lexists(os.path.join(self._install_path, "usr", "lib", name))
+
+    def test_only_identical_are_removed(self):
+        self._create("same", "abcd" * 1000, "abcd" * 1000)
+        self._create("other_size", "abcd", "abcde")
+        self._create("other_content", "abcd", "abce")
+        self._create("empty", "", "")
+        os.symlink("same", os.path.join(self._snap_path, "12", "usr", "lib", "link1"))
+        os.symlink("same", os.path.join(self._install_path, "usr", "lib", "link1"))
+        os.symlink("same", os.path.join(self._snap_path, "12", "usr", "lib", "link2"))
+        os.symlink("empty", os.path.join(self._install_path, "usr", "lib", "link2"))
+        remove_common.main(self._install_path, [(self._current_path, None)], cache_folder=self._cache_folder,
+                           verify_content=True, jobs=2)
+        self.assertFalse(self._exists("same"))
+        self.assertTrue(self._exists("other_size"))
+        self.assertTrue(self._exists("other_content"))
+        self.assertFalse(self._exists("empty"))
+        self.assertFalse(self._exists("link1"))
+        self.assertTrue(self._exists("link2"))
+
+    def test_base_hashes_are_cached(self):
+        self._create("file1", "abcd", "abcd")
+        remove_common.main(self._install_path, [(self._current_path, None)], cache_folder=self._cache_folder,
+                           verify_content=True)
+        self.assertTrue(os.path.exists(os.path.join(self._cache_folder, "gnome-46_12.hashes")))
+        # the revision can't change, so the stored hash is used instead of the new contents
+        self._create("file1", "abce", "abcd")
+        remove_common.main(self._install_path, [(self._current_path, None)], cache_folder=self._cache_folder,
+                           verify_content=True)
+        self.assertFalse(self._exists("file1"))
+
+    def test_save_while_comparing(self):
+        for position in range(200):
+            self._create(f"file{position}", f"abcd{position}", f"abcd{position}")
+        with os.scandir(os.path.join(self._install_path, "usr", "lib")) as entries:
+            candidates = [(entry, [(self._current_path, f"usr/lib/{entry.name}")]) for entry in entries]
+        verifier = remove_common.ContentVerifier(self._cache_folder, 2)
+        os.makedirs(self._cache_folder)
+        comparing = True
+
+        def save():
+            while comparing:
+                verifier.save()
+
+        saver = threading.Thread(target=save)
+        saver.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(lambda candidate: verifier.find_identical([candidate])[0], candidates))
+        finally:
+            comparing = False
+            saver.join()
+        self.assertNotIn(None, results)
+        verifier.save()
+        # no hash is lost, even the ones added while it was being saved
+        with open(os.path.join(self._cache_folder, "gnome-46_12.hashes"), "rb") as hashes_file:
+            hashes = json.loads(zlib.decompress(hashes_file.read()))
+        self.assertEqual(len(hashes), 200)
+
+    def test_hash_file(self):
+        path = os.path.join(self._install_path, "file")
+        self._write(path, "")
+        self.assertEqual(remove_common.hash_file(path), hashlib.sha256(b"").hexdigest())
+        self._write(path, "abcd")
+        self.assertEqual(remove_common.hash_file(path), hashlib.sha256(b"abcd").hexdigest())
+
+
+class TestProbePlanner(unittest.TestCase):
+
+    def setUp(self):
+        self._base_folder = tempfile.mkdtemp()
+        self._cache_folder = os.path.join(self._base_folder, "cache")
+        self._extensions = []
+        for name, map_path in [("core24", None), ("gnome-46", None), ("gtk-common-themes", "usr/")]:
+            self._extensions.append((os.path.join(self._base_folder, name), map_path))
+        self._create("core24", ["usr/lib/libc.so.6", "usr/share/doc/libc6/copyright"])
+        self._create("gnome-46", ["usr/lib/libgtk-4.so.1", "usr/share/doc/libgtk-4-1/copyright"])
+        self._create("gtk-common-themes", [f"share/icons/Yaru/{number}.png" for number in range(10)])
+
+    def tearDown(self):
+        shutil.rmtree(self._base_folder)
+
+    def _create(self, name, paths):
+        for path in paths:
+            full_path = os.path.join(self._base_folder, name, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(full_path, "w").close()
+
+    def test_learned_order(self):
+        self._create("gnome-46", [f"usr/lib/libgnome{number}.so" for number in range(10)])
+        planner = remove_common.ProbePlanner(self._extensions, cache_folder=self._cache_folder)
+        copies, first_probes = planner.find("usr/lib/libgnome0.so")
+        self.assertEqual(copies, [(self._extensions[1][0], None, "usr/lib/libgnome0.so")])
+        # the next libraries are searched first in gnome-46, although core24 has the same folder
+        for number in range(1, 10):
+            copies, probes = planner.find(f"usr/lib/libgnome{number}.so")
+            self.assertEqual(len(copies), 1)
+            self.assertEqual(probes, 1)
+        self.assertEqual(planner.find("usr/lib/libc.so.6")[0][0][0], self._extensions[0][0])
+        planner.save()
+        # and the statistics are kept for the next runs
+        planner = remove_common.ProbePlanner(self._extensions, cache_folder=self._cache_folder)
+        copies, probes = planner.find("usr/lib/libgnome5.so")
+        self.assertEqual(copies[0][0], self._extensions[1][0])
+        self.assertEqual(probes, first_probes - 1)
+        self.assertEqual(planner.find("usr/lib/libgnome6.so")[1], 1)
+
+    def test_missing_folders_are_skipped(self):
+        planner = remove_common.ProbePlanner(self._extensions)
+        copies, probes = planner.find("usr/share/icons/Adwaita/0.png")
+        self.assertEqual(copies, [])
+        # only gtk-common-themes has the icons folder
+        for number in range(1, 5):
+            copies, probes = planner.find(f"usr/share/icons/Adwaita/{number}.png")
+            self.assertEqual(copies, [])
+            self.assertEqual(probes, 0)
+        self.assertEqual(planner.find("usr/lib/libgtk-4.so.1")[0][0][0], self._extensions[1][0])
+        self.assertEqual(planner.find("usr/lib/libc.so.6")[0][0][0], self._extensions[0][0])
+
+    def test_all_copies(self):
+        planner = remove_common.ProbePlanner(self._extensions)
+        self._create("core24", ["usr/lib/libgtk-4.so.1"])
+        self.assertEqual(len(planner.find("usr/lib/libgtk-4.so.1")[0]), 1)
+        copies, probes = planner.find("usr/lib/libgtk-4.so.1", True)
+        self.assertEqual([folder for folder, _, _ in copies], [self._extensions[0][0], self._extensions[1][0]])
+
+    def test_with_indexes(self):
+        indexes = [remove_common.PathIndex(*remove_common.scan_snap_folder(folder), map_path)
+                   for folder, map_path in self._extensions]
+        planner = remove_common.ProbePlanner(self._extensions, indexes)
+        self.assertEqual(planner.find("usr/share/icons/Yaru/0.png")[0],
+                         [(self._extensions[2][0], "usr/", "share/icons/Yaru/0.png")])
+        self.assertEqual(planner.find("usr/share/icons/Yaru/1.png")[1], 1)
+        self.assertEqual(planner.find("usr/share/doc/libgtk-4-1/copyright")[0][0][0], self._extensions[1][0])
+
+
+class TestStageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._base_folder = tempfile.mkdtemp()
+        self._cache_folder = os.path.join(self._base_folder, "cache")
+        self._stage_path = os.path.join(self._base_folder, "stage")
+        os.makedirs(os.path.join(self._stage_path, "usr", "bin"))
+        open(os.path.join(self._stage_path, "usr", "bin", "a1"), "w").close()
+        os.symlink("usr/bin", os.path.join(self._stage_path, "bin"))
+        self._set_old_mtimes()
+
+    def tearDown(self):
+        shutil.rmtree(self._base_folder)
+
+    def _set_old_mtimes(self):
+        for folder in ["", "usr", "usr/bin"]:
+            os.utime(os.path.join(self._stage_path, folder), (1000000, 1000000))
+
+    def test_find(self):
+        index = remove_common.StageIndex(self._stage_path, self._cache_folder)
+        self.assertIn("usr/bin/a1", index)
+        self.assertEqual(index.find("bin/a1"), "usr/bin/a1")
+        self.assertNotIn("usr/bin/a2", index)
+        self.assertNotIn("usr/lib/a1", index)
+
+    def test_unchanged_folders_arent_read(self):
+        index = remove_common.StageIndex(self._stage_path, self._cache_folder)
+        self.assertIn("usr/bin/a1", index)
+        index.save()
+        # remove the file but keep the folder modification time
+        os.remove(os.path.join(self._stage_path, "usr", "bin", "a1"))
+        self._set_old_mtimes()
+        index = remove_common.StageIndex(self._stage_path, self._cache_folder)
+        self.assertIn("usr/bin/a1", index)
+
+    def test_changed_folders_are_read(self):
+        index = remove_common.StageIndex(self._stage_path, self._cache_folder)
+        self.assertIn("usr/bin/a1", index)
+        index.save()
+        open(os.path.join(self._stage_path, "usr", "bin", "a2"), "w").close()
+        os.makedirs(os.path.join(self._stage_path, "usr", "lib"))
+        open(os.path.join(self._stage_path, "usr", "lib", "a3"), "w").close()
+        index = remove_common.StageIndex(self._stage_path, self._cache_folder)
+        self.assertIn("usr/bin/a2", index)
+        self.assertIn("usr/lib/a3", index)
+        shutil.rmtree(os.path.join(self._stage_path, "usr", "lib"))
+        index = remove_common.StageIndex(self._stage_path, self._cache_folder)
+        self.assertNotIn("usr/lib/a3", index)
+
+    def test_refresh_part(self):
+        index = remove_common.StageIndex(self._stage_path, self._cache_folder)
+        self.assertNotIn("usr/bin/a2", index)
+        install_path = os.path.join(self._base_folder, "install")
+        os.makedirs(os.path.join(install_path, "usr", "bin"))
+        open(os.path.join(install_path, "usr", "bin", "a2"), "w").close()
+        shutil.copy(os.path.join(install_path, "usr", "bin", "a2"), os.path.join(self._stage_path, "usr", "bin", "a2"))
+        self._set_old_mtimes()
+        index.refresh_part(install_path)
+        self.assertIn("usr/bin/a2", index)
+        index.save()
+        index = remove_common.StageIndex(self._stage_path, self._cache_folder)
+        self.assertIn("usr/bin/a2", index)
+
+    def test_remove_staged_files(self):
+        install_path = os.path.join(self._base_folder, "install")
+        os.makedirs(os.path.join(install_path, "usr", "bin"))
+        open(os.path.join(install_path, "usr", "bin", "a1"), "w").close()
+        open(os.path.join(install_path, "usr", "bin", "a2"), "w").close()
+        remove_common.main(install_path, [], cache_folder=self._cache_folder, stage_folder=self._stage_path)
+        self.assertFalse(os.path.exists(os.path.join(install_path, "usr", "bin", "a1")))
+        self.assertTrue(os.path.exists(os.path.join(install_path, "usr", "bin", "a2")))
+
+
+class TestSquashfsImage(unittest.TestCase):
+
+    def setUp(self):
+        self._base_folder = tempfile.mkdtemp()
+        self._image_path = os.path.join(self._base_folder, "gtk-common-themes_35.snap")
+        self._files = [f"share/icons/hicolor/icon{number}.png" for number in range(700)]
+        self._files += ["lib/other/lib1.so", "meta/snap.yaml"]
+        write_squashfs(self._image_path, self._files, ["share/empty"],
+                       {"lib64": "lib/other", "lib32": "/lib64", "share/readme": "../meta/snap.yaml"})
+
+    def tearDown(self):
+        shutil.rmtree(self._base_folder)
+
+    def test_scan(self):
+        paths, folder_links = remove_common.SquashfsImage(self._image_path).scan()
+        expected = set(self._files)
+        expected |= {"share", "share/icons", "share/icons/hicolor", "share/empty", "lib", "lib/other", "meta"}
+        expected |= {"lib64", "lib32", "share/readme"}
+        self.assertEqual(sorted(paths), sorted(expected))
+        self.assertEqual(folder_links, {"lib64": "lib/other", "lib32": "lib64"})
+
+    def test_uncompressed_directories(self):
+        write_squashfs(self._image_path, self._files, compress=False)
+        paths, _ = remove_common.SquashfsImage(self._image_path).scan()
+        self.assertIn("share/icons/hicolor/icon699.png", paths)
+
+    def test_not_squashfs(self):
+        with open(self._image_path, "wb") as image_file:
+            image_file.write(b"\0" * 200)
+        self.assertRaises(ValueError, remove_common.SquashfsImage, self._image_path)
+
+    def test_remove_with_image(self):
+        mappings = remove_common.generate_mappings(remove_common.global_maps, [])
+        extensions_paths = remove_common.generate_extensions_paths([self._image_path], mappings)
+        self.assertEqual(extensions_paths, [(self._image_path, "usr/")])
+        self.assertEqual(remove_common.get_snap_revision(self._image_path), ("gtk-common-themes", "35"))
+        install_path = os.path.join(self._base_folder, "install")
+        os.makedirs(os.path.join(install_path, "usr", "share", "icons", "hicolor"))
+        os.makedirs(os.path.join(install_path, "usr", "lib32"))
+        for name in ["usr/share/icons/hicolor/icon1.png", "usr/share/icons/hicolor/other.png", "usr/lib32/lib1.so"]:
+            open(os.path.join(install_path, name), "w").close()
+        cache_folder = os.path.join(self._base_folder, "cache")
+        remove_common.main(install_path, extensions_paths, cache_folder=cache_folder)
+        self.assertTrue(os.path.exists(os.path.join(cache_folder, "gtk-common-themes_35.index")))
+        self.assertFalse(os.path.exists(os.path.join(install_path, "usr/share/icons/hicolor/icon1.png")))
+        self.assertTrue(os.path.exists(os.path.join(install_path, "usr/share/icons/hicolor/other.png")))
+        self.assertFalse(os.path.exists(os.path.join(install_path, "usr/lib32/lib1.so")))
+
+    def _create_install_folder(self):
+        install_path = os.path.join(self._base_folder, "install")
+        os.makedirs(os.path.join(install_path, "usr", "share", "icons", "hicolor"))
+        open(os.path.join(install_path, "usr/share/icons/hicolor/icon1.png"), "w").close()
+        return install_path
+
+    def test_unsupported_compression(self):
+        # like a zstd image
+        with open(self._image_path, "r+b") as image_file:
+            image_file.seek(20)
+            image_file.write(struct.pack("<H", 6))
+        self.assertRaises(ValueError, remove_common.SquashfsImage, self._image_path)
+        install_path = self._create_install_folder()
+        cache_folder = os.path.join(self._base_folder, "cache")
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            remove_common.main(install_path, [(self._image_path, "usr/")], cache_folder=cache_folder)
+        self.assertIn(f"Can't read {self._image_path}: {self._image_path} uses an unsupported compression "
+                      "algorithm (6). Skipping it.", output.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(install_path, "usr/share/icons/hicolor/icon1.png")))
+        self.assertFalse(os.path.exists(os.path.join(cache_folder, "gtk-common-themes_35.index")))
+
+    def test_verify_content_with_image(self):
+        install_path = self._create_install_folder()
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            remove_common.main(install_path, [(self._image_path, "usr/")], verify_content=True)
+        self.assertIn(f"The contents of the files inside {self._image_path} can't be compared",
+                      output.getvalue())
+        # found in the image, but its contents can't be read
+        self.assertTrue(os.path.exists(os.path.join(install_path, "usr/share/icons/hicolor/icon1.png")))
+
+
+class TestSonames(unittest.TestCase):
+
+    def setUp(self):
+        self._base_folder = tempfile.mkdtemp()
+        self._snap_path = os.path.join(self._base_folder, "gnome-46")
+        self._install_path = os.path.join(self._base_folder, "install")
+        os.makedirs(self._install_path)
+
+    def tearDown(self):
+        shutil.rmtree(self._base_folder)
+
+    def _install(self, path):
+        return os.path.join(self._install_path, path)
+
+    def test_read_elf_info(self):
+        write_elf(self._install("lib64.so"), "libfoo.so.1", ["libc.so.6", "libbar.so.2"], "$ORIGIN:/usr/lib")
+        elf_info = remove_common.read_elf_info(self._install("lib64.so"))
+        self.assertEqual(elf_info.abi, (2, 62))
+        self.assertEqual(elf_info.elf_type, 3)
+        self.assertEqual(elf_info.soname, "libfoo.so.1")
+        self.assertEqual(elf_info.needed, ["libc.so.6", "libbar.so.2"])
+        self.assertEqual(elf_info.runpath, ["$ORIGIN", "/usr/lib"])
+        write_elf(self._install("lib32.so"), "libfoo.so.1", ["libc.so.6"], elf_class=1, machine=3)
+        elf_info = remove_common.read_elf_info(self._install("lib32.so"))
+        self.assertEqual(elf_info.abi, (1, 3))
+        self.assertEqual(elf_info.soname, "libfoo.so.1")
+        self.assertEqual(elf_info.needed, ["libc.so.6"])
+        with open(self._install("text.so"), "w") as text_file:
+            text_file.write("INPUT(libfoo.so.1)")
+        self.assertIsNone(remove_common.read_elf_info(self._install("text.so")))
+        with open(self._install("lib64.so"), "rb") as elf_file:
+            data = elf_file.read()
+        with open(self._install("truncated.so"), "wb") as elf_file:
+            elf_file.write(data[:100])
+        self.assertIsNone(remove_common.read_elf_info(self._install("truncated.so")).soname)
+
+    def test_library_folders(self):
+        for folder, expected in [("lib", True), ("usr/lib", True), ("usr/lib64", True), ("usr/lib32", True),
+                                 ("usr/lib/x86_64-linux-gnu", True), ("lib/aarch64-linux-gnu", True),
+                                 ("usr/lib/x86_64-linux-gnu/gtk-4.0", False), ("usr/libexec", False),
+                                 ("usr/share/lib", False), ("usr/lib/python3", False)]:
+            self.assertEqual(remove_common.is_library_folder(folder), expected, folder)
+
+    def test_remove_by_soname(self):
+        write_elf(os.path.join(self._snap_path, "lib/x86_64-linux-gnu/libfoo.so.1.2.0"), "libfoo.so.1")
+        write_elf(os.path.join(self._snap_path, "lib/x86_64-linux-gnu/libbar.so.2.0"), "libbar.so.2")
+        write_elf(os.path.join(self._snap_path, "usr/share/libbaz.so.3"), "libbaz.so.3")
+        folder = "usr/lib/x86_64-linux-gnu/"
+        write_elf(self._install(folder + "libfoo.so.1.3.0"), "libfoo.so.1")
+        os.symlink("libfoo.so.1.3.0", self._install(folder + "libfoo.so.1"))
+        os.symlink("libfoo.so.1", self._install(folder + "libfoo.so"))
+        # different ABI
+        write_elf(self._install(folder + "libbar.so.2.0"), "libbar.so.2", elf_class=1, machine=3)
+        os.symlink("libbar.so.2.0", self._install(folder + "libbar.so.2"))
+        # the library in the base snap isn't in a library folder
+        write_elf(self._install(folder + "libbaz.so.3"), "libbaz.so.3")
+        # private library folder
+        write_elf(self._install(folder + "private/libfoo.so.1.3.0"), "libfoo.so.1")
+        extensions = [(self._snap_path, None)]
+        remove_common.main(self._install_path, extensions)
+        self.assertTrue(os.path.exists(self._install(folder + "libfoo.so.1.3.0")))
+        report = remove_common.main(self._install_path, extensions, sonames=True)
+        self.assertEqual(report.removed_files, 3)
+        for name, exists in [("libfoo.so.1.3.0", False), ("libfoo.so.1", False), ("libfoo.so", False),
+                             ("libbar.so.2.0", True), ("libbar.so.2", True), ("libbaz.so.3", True),
+                             ("private/libfoo.so.1.3.0", True)]:
+            self.assertEqual(os.path.lexists(self._install(folder + name)), exists, name)
+
+    def test_soname_index_is_stored(self):
+        cache_folder = os.path.join(self._base_folder, "cache")
+        write_elf(os.path.join(self._snap_path, "12", "usr/lib/libfoo.so.1"), "libfoo.so.1")
+        os.symlink("12", os.path.join(self._snap_path, "current"))
+        current_path = os.path.join(self._snap_path, "current")
+        sonames = remove_common.load_soname_index(current_path, cache_folder)
+        self.assertEqual(sonames, {"libfoo.so.1:2:62": "usr/lib/libfoo.so.1"})
+        self.assertTrue(os.path.exists(os.path.join(cache_folder, "gnome-46_12.sonames")))
+        os.remove(os.path.join(self._snap_path, "12", "usr/lib/libfoo.so.1"))
+        self.assertEqual(remove_common.load_soname_index(current_path, cache_folder), sonames)
+
+
+class TestUnreachableLibraries(unittest.TestCase):
+
+    def setUp(self):
+        self._base_folder = tempfile.mkdtemp()
+        self._snap_path = os.path.join(self._base_folder, "gnome-46")
+        self._prime_path = os.path.join(self._base_folder, "prime")
+        write_elf(os.path.join(self._snap_path, "usr/lib/x86_64-linux-gnu/libc.so.6"), "libc.so.6")
+        folder = "usr/lib/x86_64-linux-gnu/"
+        self._write_executable("usr/bin/app", ["libA.so.1", "libc.so.6", "libmissing.so.9", "libF.so.6"])
+        self._write_executable("usr/lib/app/bin/app2", ["libE.so.5"], "$ORIGIN/../private")
+        write_elf(self._prime(folder + "libA.so.1.0"), "libA.so.1", ["libB.so.2"])
+        os.symlink("libA.so.1.0", self._prime(folder + "libA.so.1"))
+        write_elf(self._prime(folder + "libB.so.2"), "libB.so.2")
+        write_elf(self._prime(folder + "libC.so.3"), "libC.so.3")
+        os.symlink("libC.so.3", self._prime(folder + "libC.so"))
+        write_elf(self._prime(folder + "libnss_foo.so.2"), "libnss_foo.so.2")
+        write_elf(self._prime(folder + "libF.so.6"), "libF.so.6", elf_class=1, machine=3)
+        write_elf(self._prime("usr/lib/app/plugins/plugin.so"), None, ["libD.so.4"])
+        write_elf(self._prime(folder + "libD.so.4"), "libD.so.4")
+        write_elf(self._prime("usr/lib/app/private/libE.so.5"), "libE.so.5", ["libG.so.7"])
+        write_elf(self._prime("lib/libG.so.7"), "libG.so.7")
+
+    def tearDown(self):
+        shutil.rmtree(self._base_folder)
+
+    def _prime(self, path):
+        return os.path.join(self._prime_path, path)
+
+    def _write_executable(self, path, needed, runpath=None):
+        write_elf(self._prime(path), None, needed, runpath, elf_type=2)
+        os.chmod(self._prime(path), 0o755)
+
+    def test_find_unreachable(self):
+        soname_indexes = [remove_common.load_soname_index(self._snap_path)]
+        graph = remove_common.LibraryGraph(self._prime_path, soname_indexes)
+        unreachable, links = graph.find_unreachable()
+        folder = "usr/lib/x86_64-linux-gnu/"
+        self.assertEqual(unreachable, [folder + "libC.so.3", folder + "libF.so.6"])
+        self.assertEqual(links, [folder + "libC.so"])
+        self.assertEqual(sorted(graph.missing), ["libF.so.6", "libmissing.so.9"])
+        # without the base snap, libc is missing too
+        graph = remove_common.LibraryGraph(self._prime_path)
+        graph.find_unreachable()
+        self.assertIn("libc.so.6", graph.missing)
+        # and without the default allowlist, the NSS module is unreachable
+        graph = remove_common.LibraryGraph(self._prime_path, soname_indexes, [])
+        self.assertIn(folder + "libnss_foo.so.2", graph.find_unreachable()[0])
+
+    def test_prune_unreachable(self):
+        extensions = [(self._snap_path, None)]
+        report = remove_common.prune_unreachable(self._prime_path, extensions)
+        self.assertTrue(report["dry_run"])
+        self.assertEqual(report["elf_files"], 11)
+        self.assertTrue(os.path.exists(self._prime("usr/lib/x86_64-linux-gnu/libC.so.3")))
+        size = os.path.getsize(self._prime("usr/lib/x86_64-linux-gnu/libC.so.3"))
+        allowlist = remove_common.DLOPEN_ALLOWLIST + ["*/libF.so.*"]
+        report = remove_common.prune_unreachable(self._prime_path, extensions, allowlist, dry_run=False)
+        self.assertEqual(report["unreachable"], ["usr/lib/x86_64-linux-gnu/libC.so.3"])
+        self.assertEqual(report["removed_bytes"], size)
+        for name, exists in [("libC.so.3", False), ("libC.so", False), ("libF.so.6", True), ("libA.so.1", True),
+                             ("libA.so.1.0", True), ("libB.so.2", True), ("libD.so.4", True)]:
+            self.assertEqual(os.path.lexists(self._prime("usr/lib/x86_64-linux-gnu/" + name)), exists, name)
+
+
+class TestLinkIdentical(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+        big_content = b"a" * 10000
+        self._write("usr/share/doc/pkg1/copyright", b"same license")
+        self._write("usr/share/doc/pkg2/copyright", b"same license")
+        self._write("usr/share/doc/pkg3/copyright", b"diff license")
+        self._write("usr/share/pkg/data1.bin", big_content)
+        self._write("usr/share/pkg/data2.bin", big_content)
+        # same first bytes, different end
+        self._write("usr/share/pkg/data3.bin", big_content[:-1] + b"b")
+        self._write("usr/share/pkg/excluded.bin", big_content)
+        self._write("usr/bin/tool1", b"#!/bin/sh\n")
+        self._write("usr/bin/tool2", b"#!/bin/sh\n")
+        os.chmod(self._path("usr/bin/tool2"), 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self._folder)
+
+    def _path(self, path):
+        return os.path.join(self._folder, path)
+
+    def _write(self, path, content):
+        os.makedirs(os.path.dirname(self._path(path)), exist_ok=True)
+        with open(self._path(path), "wb") as data_file:
+            data_file.write(content)
+
+    def _same_file(self, path1, path2):
+        return os.path.samefile(self._path(path1), self._path(path2))
+
+    def test_hardlinks(self):
+        report = remove_common.link_identical_files(self._folder, ["usr/share/pkg/excluded.bin"])
+        self.assertEqual(report["scanned_files"], 8)
+        self.assertEqual(report["linked_files"], 2)
+        self.assertEqual(report["saved_bytes"], 10000 + len(b"same license"))
+        self.assertTrue(self._same_file("usr/share/doc/pkg1/copyright", "usr/share/doc/pkg2/copyright"))
+        self.assertTrue(self._same_file("usr/share/pkg/data1.bin", "usr/share/pkg/data2.bin"))
+        self.assertFalse(self._same_file("usr/share/pkg/data1.bin", "usr/share/pkg/data3.bin"))
+        self.assertFalse(self._same_file("usr/share/pkg/data1.bin", "usr/share/pkg/excluded.bin"))
+        self.assertFalse(self._same_file("usr/share/doc/pkg1/copyright", "usr/share/doc/pkg3/copyright"))
+        # different permissions
+        self.assertFalse(self._same_file("usr/bin/tool1", "usr/bin/tool2"))
+        # the files already linked are counted once
+        report = remove_common.link_identical_files(self._folder, ["usr/share/pkg/excluded.bin"])
+        self.assertEqual(report["linked_files"], 0)
+
+    def test_symlinks(self):
+        report = remove_common.link_identical_files(self._folder, mode="symlink")
+        self.assertEqual(report["linked_files"], 3)
+        self.assertEqual(os.readlink(self._path("usr/share/doc/pkg2/copyright")), "../pkg1/copyright")
+        self.assertEqual(os.readlink(self._path("usr/share/pkg/data2.bin")), "data1.bin")
+        self.assertEqual(os.readlink(self._path("usr/share/pkg/excluded.bin")), "data1.bin")
+        with open(self._path("usr/share/pkg/excluded.bin"), "rb") as data_file:
+            self.assertEqual(data_file.read(), b"a" * 10000)
+
+    def test_dry_run(self):
+        report = remove_common.link_identical_files(self._folder, dry_run=True)
+        self.assertEqual(report["linked_files"], 3)
+        self.assertFalse(self._same_file("usr/share/pkg/data1.bin", "usr/share/pkg/data2.bin"))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,38 +2,517 @@
 
 """ Ensures that any python script uses #!/usr/bin/env python3 """
 
-import sys
 import os
-import glob
+import argparse
+import concurrent.futures
+import fnmatch
+import hashlib
+import py_compile
+import re
+import stat
+import struct
+import tempfile
+import time
 
-BASE_PATH = sys.argv[1]
-for full_file_path in glob.glob(os.path.join(BASE_PATH, "**/*"), recursive=True):
-    if not os.path.isfile(full_file_path):
-        continue
+# longer lines are not shebangs, but binary data that starts with "#!"
+MAX_SHEBANG_LENGTH = 4096
+COPY_CHUNK_SIZE = 1024 * 1024
+# version and format of the manifest with the files already checked
+MANIFEST_MAGIC = b"SPRTMANI"
+MANIFEST_VERSION = 1
+MANIFEST_HEADER = struct.Struct("<8sII")
+# device, inode, size, modification time in nanoseconds and verdict
+MANIFEST_ENTRY = struct.Struct("<QQQqB")
+# the .py file has been compiled
+VERDICT_COMPILED = 1
+# files modified less than this time (in nanoseconds) before being checked are checked again
+MTIME_MARGIN = 2000000000
+# folders that contain executable scripts, whatever their names are
+SCRIPT_FOLDERS = {"bin", "sbin", "libexec"}
+# folders that never contain python scripts; they are not walked
+global_excludes = ["usr/share/locale", "usr/share/locale-langpack", "usr/share/icons", "usr/share/doc",
+                   "usr/share/man", "usr/share/info", "usr/share/fonts", "usr/share/mime", "usr/share/i18n",
+                   "usr/share/zoneinfo", "usr/lib/*/gdk-pixbuf-2.0", "usr/lib/*/dri", "usr/lib/*/gconv",
+                   "usr/lib/locale"]
+
+
+def get_new_shebang(first_line):
+    """Returns the shebang that must replace the first line of a script
+
+    Parameters
+    ----------
+    first_line : bytes
+        The first line of the file, including the end of line.
+
+    Returns
+    -------
+    bytes or None
+        The new first line, or None if the file isn't a python script or
+        already has the right shebang.
+    """
+    if not first_line.startswith(b"#!"):
+        return None
+    stripped_line = first_line.strip()
+    if stripped_line.endswith(b"python2"):
+        new_shebang = b"#!/usr/bin/env python2\n"
+    elif stripped_line.endswith(b"python2.7"):
+        new_shebang = b"#!/usr/bin/env python2.7\n"
+    elif stripped_line.endswith(b"python") or stripped_line.endswith(b"python3"):
+        new_shebang = b"#!/usr/bin/env python3\n"
+    else:
+        return None
+    if first_line == new_shebang or first_line == new_shebang[:-1]:
+        return None
+    return new_shebang
+
+
+def copy_range(source_fd, destination_fd, offset):
+    """Copies the contents of a file, from 'offset' to the end, into another
+
+    It uses copy_file_range() or sendfile() when available, so the data
+    isn't copied to user space.
+
+    Parameters
+    ----------
+    source_fd : int
+        File descriptor of the file to copy.
+    destination_fd : int
+        File descriptor of the file to write, at its current position.
+    offset : int
+        Position in the source file where the copy starts.
+    """
+    size = os.fstat(source_fd).st_size
+    for copy_function in [getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)]:
+        if copy_function is None:
+            continue
+        try:
+            while offset < size:
+                if copy_function is os.sendfile:
+                    copied = os.sendfile(destination_fd, source_fd, offset, min(size - offset, COPY_CHUNK_SIZE))
+                else:
+                    copied = os.copy_file_range(source_fd, destination_fd, min(size - offset, COPY_CHUNK_SIZE),
+                                                offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return
+        except OSError:
+            # not supported between these filesystems; the data copied until now is kept
+            continue
+    os.lseek(source_fd, offset, os.SEEK_SET)
+    while True:
+        data = os.read(source_fd, COPY_CHUNK_SIZE)
+        if not data:
+            break
+        os.write(destination_fd, data)
+
+
+def copy_metadata(source_fd, destination_fd):
+    """Copies the permissions, owner and extended attributes of a file into another
+
+    The owner and the extended attributes are copied only if it is allowed.
+
+    Parameters
+    ----------
+    source_fd : int
+        File descriptor of the original file.
+    destination_fd : int
+        File descriptor of the new file.
+    """
+    file_stat = os.fstat(source_fd)
+    os.fchmod(destination_fd, stat.S_IMODE(file_stat.st_mode))
+    try:
+        os.fchown(destination_fd, file_stat.st_uid, file_stat.st_gid)
+    except OSError:
+        pass
+    if not hasattr(os, "listxattr"):
+        return
+    try:
+        attributes = os.listxattr(source_fd)
+    except OSError:
+        return
+    for attribute in attributes:
+        try:
+            os.setxattr(destination_fd, attribute, os.getxattr(source_fd, attribute))
+        except OSError:
+            pass
+
+
+def is_candidate(relative_folder, entry):
+    """Checks if a file can be a python script, without opening it
+
+    A file can be a python script if its name ends in .py, or if it is
+    executable and either it is inside a bin, sbin or libexec folder, or
+    its name has no suffix (so libraries, images, translations... aren't
+    opened).
+
+    Parameters
+    ----------
+    relative_folder : string
+        The path of the folder that contains the file, relative to the
+        base path.
+    entry : os.DirEntry
+        The entry of the file.
+
+    Returns
+    -------
+    bool
+        True if the file must be opened to check its shebang.
+    """
+    if entry.name.endswith(".py"):
+        return True
+    if not entry.stat(follow_symlinks=False).st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+        return False
+    if "." not in entry.name:
+        return True
+    return not SCRIPT_FOLDERS.isdisjoint(relative_folder.split(os.sep))
+
+
+def walk_candidates(base_path, exclude_list=global_excludes):
+    """Returns the files inside a folder that can be python scripts
+
+    The folder is walked with os.scandir(), without following symlinks,
+    skipping the hidden files and folders, and the folders that match any
+    of the fnmatch rules in 'exclude_list'. Only the entries are read; the
+    files aren't opened. The folders that can't be read, or don't exist,
+    are skipped, like os.walk() does.
+
+    Parameters
+    ----------
+    base_path : string
+        The folder to walk.
+    exclude_list : array of strings, optional
+        fnmatch rules with the paths, relative to 'base_path', of the
+        folders that must not be walked, by default global_excludes.
+
+    Returns
+    -------
+    generator of strings
+        The full paths of the files that must be checked.
+    """
+    exclude_regex = re.compile("|".join(fnmatch.translate(rule.rstrip("/")) for rule in exclude_list) or "(?!)")
+    pending_folders = [""]
+    while pending_folders:
+        relative_folder = pending_folders.pop()
+        subfolders = []
+        try:
+            entries = os.scandir(os.path.join(base_path, relative_folder))
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                relative_path = os.path.join(relative_folder, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if not exclude_regex.match(relative_path):
+                        subfolders.append(relative_path)
+                elif entry.is_file(follow_symlinks=False) and is_candidate(relative_folder, entry):
+                    yield entry.path
+        # walk the folders in alphabetical order
+        pending_folders.extend(sorted(subfolders, reverse=True))
+
+
+def fix_shebang(full_file_path):
+    """Replaces the shebang of a python script with the one that uses env
+
+    Only the first line is read. If it has to be changed, the new shebang and
+    the rest of the file are written into a temporary file in the same folder,
+    which then replaces the original one.
+
+    Parameters
+    ----------
+    full_file_path : string
+        The path of the file to check.
+
+    Returns
+    -------
+    bool
+        True if the file has been changed.
+    """
+    # replace the file pointed by a symlink, not the symlink itself
+    full_file_path = os.path.realpath(full_file_path)
     with open(full_file_path, "rb") as file_data:
-        shebang = file_data.read(2)
-    if shebang != b"#!":
-        continue
+        first_line = file_data.readline(MAX_SHEBANG_LENGTH)
+        if len(first_line) == MAX_SHEBANG_LENGTH and not first_line.endswith(b"\n"):
+            return False
+        new_shebang = get_new_shebang(first_line)
+        if new_shebang is None:
+            return False
+        temporary_fd, temporary_path = tempfile.mkstemp(prefix=".", dir=os.path.dirname(full_file_path))
+        try:
+            with os.fdopen(temporary_fd, "wb") as temporary_data:
+                temporary_data.write(new_shebang)
+                temporary_data.flush()
+                copy_range(file_data.fileno(), temporary_data.fileno(), len(first_line))
+                copy_metadata(file_data.fileno(), temporary_data.fileno())
+            os.replace(temporary_path, full_file_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.unlink(temporary_path)
+            raise
+    return True
+
+
+def compile_file(full_file_path, runtime_path=None):
+    """Compiles a python file into its __pycache__ folder
+
+    The .pyc file uses an unchecked hash, so python never compares it with
+    the source; this is needed because the files inside a snap all have the
+    same modification time.
+
+    Parameters
+    ----------
+    full_file_path : string
+        The path of the .py file.
+    runtime_path : string or None, optional
+        The path of the file when the snap is running, stored in the .pyc
+        file and shown in the tracebacks. By default, 'full_file_path'.
+
+    Returns
+    -------
+    float or None
+        The seconds spent compiling the file, or None if it can't be compiled
+        (like a python 2 module).
+    """
+    start = time.perf_counter()
     try:
-        with open(full_file_path, "r", encoding='utf-8') as file_data:
-            content = file_data.readlines()
-    except:
-        content = []
-    if len(content) == 0:
-        continue
-    first_line = content[0].strip()
-    if (not first_line.endswith("python") and
-            not first_line.endswith("python2") and
-            not first_line.endswith("python2.7") and
-            not first_line.endswith("python3")):
-        continue
-    with open(full_file_path, "w", encoding='utf-8') as file_data:
-        if first_line.endswith("python2"):
-            file_data.write("#!/usr/bin/env python2\n")
-        elif first_line.endswith("python2.7"):
-            file_data.write("#!/usr/bin/env python2.7\n")
-        else:
-            file_data.write("#!/usr/bin/env python3\n")
-        for line in content[1:]:
-            file_data.write(line)
-        print(f"Fixing file {full_file_path}")
+        py_compile.compile(full_file_path, dfile=runtime_path, doraise=True,
+                           invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    except (py_compile.PyCompileError, OSError, ValueError):
+        return None
+    return time.perf_counter() - start
+
+
+def get_application(base_path, full_file_path):
+    """Returns the application a python file belongs to
+
+    It is the top-level package for the files in site-packages or
+    dist-packages, or the folder that contains the file for the rest.
+
+    Parameters
+    ----------
+    base_path : string
+        The folder being processed.
+    full_file_path : string
+        The path of the .py file.
+
+    Returns
+    -------
+    string
+        The path of the application, relative to 'base_path'.
+    """
+    path_parts = os.path.relpath(full_file_path, base_path).split(os.sep)
+    for position, path_part in enumerate(path_parts[:-1]):
+        if path_part in ("site-packages", "dist-packages"):
+            application = path_parts[position + 1]
+            if application.endswith(".py"):
+                application = application[:-3]
+            return os.path.join(*path_parts[:position + 1], application)
+    return os.path.join(*path_parts[:-1]) if len(path_parts) > 1 else "."
+
+
+def precompile(base_path, python_files, jobs=None):
+    """Compiles python files in parallel
+
+    Parameters
+    ----------
+    base_path : string
+        The folder being processed.
+    python_files : array of strings
+        The full paths of the .py files to compile.
+    jobs : int or None, optional
+        Number of processes, or None to use one per CPU.
+
+    Returns
+    -------
+    dictionary
+        For each application (see get_application()), a tuple with the
+        number of files compiled and the seconds spent compiling them, which
+        is the time saved the first time they are imported.
+    """
+    applications = {}
+    if len(python_files) == 0:
+        return applications
+    runtime_paths = ["/" + os.path.relpath(full_file_path, base_path) for full_file_path in python_files]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for full_file_path, seconds in zip(python_files,
+                                           executor.map(compile_file, python_files, runtime_paths, chunksize=16)):
+            if seconds is None:
+                continue
+            application = get_application(base_path, full_file_path)
+            files, total_seconds = applications.get(application, (0, 0.0))
+            applications[application] = (files + 1, total_seconds + seconds)
+    return applications
+
+
+def get_cache_folder():
+    """Returns the default folder for the manifests
+
+    It is the same folder used by remove_common for its indexes.
+
+    Returns
+    -------
+    string
+        The path of the folder where the manifests must be stored.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "snap-build-tools")
+
+
+class Manifest:
+    """The files already checked in a folder in previous runs
+
+    Each file is identified by its device, inode, size and modification
+    time, so a file that has been replaced or modified since the last run
+    isn't found. The verdict stores whether it has also been compiled. The
+    manifest is stored in a binary file in the cache folder, one per base
+    path, and is replaced atomically when saved.
+    """
+
+    def __init__(self, base_path, cache_folder):
+        folder_hash = hashlib.sha1(os.path.realpath(base_path).encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(cache_folder, f"set_python_runtime_{folder_hash}.manifest")
+        self.entries = {}
+        self.new_entries = {}
+        self._limit = time.time_ns() - MTIME_MARGIN
+
+    def load(self):
+        """Reads the manifest file, if it exists and has the right version"""
+        try:
+            with open(self.path, "rb") as manifest_file:
+                data = manifest_file.read()
+            magic, version, count = MANIFEST_HEADER.unpack_from(data)
+            if magic != MANIFEST_MAGIC or version != MANIFEST_VERSION:
+                return
+            entries = MANIFEST_ENTRY.iter_unpack(data[MANIFEST_HEADER.size:])
+            self.entries = {entry[:4]: entry[4] for entry in entries}
+            if len(self.entries) != count:
+                self.entries = {}
+        except (OSError, struct.error):
+            self.entries = {}
+
+    @staticmethod
+    def get_signature(file_stat):
+        return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+    def get(self, signature):
+        """Returns the verdict of a file, or None if it must be checked"""
+        return self.entries.get(signature)
+
+    def add(self, signature, verdict):
+        """Stores the verdict of a file checked in this run
+
+        Files modified just before being checked aren't stored, because they
+        could be modified again without changing their modification time.
+        """
+        if signature[3] < self._limit:
+            self.new_entries[signature] = verdict
+
+    def save(self):
+        """Writes the files checked in this run, replacing the old manifest"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".tmp-")
+        try:
+            with os.fdopen(descriptor, "wb") as temporary_file:
+                temporary_file.write(MANIFEST_HEADER.pack(MANIFEST_MAGIC, MANIFEST_VERSION, len(self.new_entries)))
+                temporary_file.write(b"".join(MANIFEST_ENTRY.pack(*signature, verdict)
+                                              for signature, verdict in self.new_entries.items()))
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+
+def main(base_path, exclude_list=global_excludes, compile_python=False, jobs=None, cache_folder=None, full=False):
+    """Fixes the shebang of all the python scripts inside a folder
+
+    Parameters
+    ----------
+    base_path : string
+        The folder to check recursively.
+    exclude_list : array of strings, optional
+        fnmatch rules with the folders that must not be walked, by default
+        global_excludes.
+    compile_python : bool, optional
+        Compile also the .py files after fixing the shebangs, by default
+        False.
+    jobs : int or None, optional
+        Number of processes used to compile, or None to use one per CPU.
+    cache_folder : string or None, optional
+        Folder where the manifest with the files already checked is stored,
+        or None to not use a manifest and check all the files.
+    full : bool, optional
+        Check all the files, even those that haven't changed since the
+        last run, by default False.
+
+    Returns
+    -------
+    tuple of int
+        The number of files checked and the number of files fixed.
+    """
+    manifest = None
+    if cache_folder is not None:
+        manifest = Manifest(base_path, cache_folder)
+        if not full:
+            manifest.load()
+    checked_files = 0
+    fixed_files = 0
+    python_files = []
+    for full_file_path in walk_candidates(base_path, exclude_list):
+        must_compile = compile_python and full_file_path.endswith(".py")
+        signature = None
+        if manifest is not None:
+            signature = Manifest.get_signature(os.lstat(full_file_path))
+            verdict = manifest.get(signature)
+            if verdict is not None and (verdict & VERDICT_COMPILED or not must_compile):
+                manifest.add(signature, verdict)
+                continue
+        checked_files += 1
+        if fix_shebang(full_file_path):
+            fixed_files += 1
+            print(f"Fixing file {full_file_path}")
+            if manifest is not None:
+                signature = Manifest.get_signature(os.lstat(full_file_path))
+        if must_compile:
+            python_files.append((full_file_path, signature))
+        elif signature is not None:
+            manifest.add(signature, 0)
+    if compile_python:
+        compiled_files = precompile(base_path, [full_file_path for full_file_path, _ in python_files], jobs)
+        for application, (files, seconds) in sorted(compiled_files.items()):
+            print(f"Precompiled {files} files in {application}, saving {seconds * 1000:.1f} ms on first import")
+        if manifest is not None:
+            # the files that can't be compiled are marked as compiled too, so they aren't tried again
+            for _, signature in python_files:
+                manifest.add(signature, VERDICT_COMPILED)
+    if manifest is not None:
+        manifest.save()
+    return checked_files, fixed_files
+
+
+def run():
+    parser = argparse.ArgumentParser(prog="set_python_runtime",
+                                     description="Ensures that any python script uses #!/usr/bin/env python3")
+    parser.add_argument('base_path', help="The folder with the scripts, like $CRAFT_PART_INSTALL")
+    parser.add_argument('-e', '--exclude', nargs='+', default=[],
+                        help="Folders that must not be walked, in fnmatch format (like usr/share/foo*)")
+    parser.add_argument('--no-default-excludes', action='store_true', default=False,
+                        help="Walk also the folders that never contain python scripts, like usr/share/locale")
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help="Compile the .py files into .pyc files with unchecked hashes")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of processes used to compile (by default, one per CPU)")
+    parser.add_argument('-c', '--cache-folder', default=None,
+                        help="Folder for the manifest of the files already checked (by default, "
+                             "$XDG_CACHE_HOME/snap-build-tools)")
+    parser.add_argument('--full', action='store_true', default=False,
+                        help="Check all the files, even those that haven't changed since the last run")
+    args = parser.parse_args()
+    exclude_list = args.exclude if args.no_default_excludes else global_excludes + args.exclude
+    cache_folder = args.cache_folder if args.cache_folder is not None else get_cache_folder()
+    main(args.base_path, exclude_list, args.compile, args.jobs, cache_folder, args.full)
+
+
+if __name__ == "__main__":
+    run()
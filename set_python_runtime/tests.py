@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import os
+import importlib.util
+import marshal
+import set_python_runtime
+import shutil
+import stat
+import unittest
+import tempfile
+
+
+class TestSetPythonRuntime(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._folder)
+
+    def _write(self, path, content, mode=0o644):
+        full_path = os.path.join(self._folder, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as file_data:
+            file_data.write(content)
+        os.chmod(full_path, mode)
+        return full_path
+
+    def _read(self, full_path):
+        with open(full_path, "rb") as file_data:
+            return file_data.read()
+
+    def test_get_new_shebang(self):
+        for first_line, new_shebang in [
+                (b"#!/snap/gnome-42-2204-sdk/current/usr/bin/python3\n", b"#!/usr/bin/env python3\n"),
+                (b"#!/usr/bin/python\n", b"#!/usr/bin/env python3\n"),
+                (b"#!/usr/bin/python2 \r\n", b"#!/usr/bin/env python2\n"),
+                (b"#!/usr/bin/python2.7\n", b"#!/usr/bin/env python2.7\n"),
+                (b"#!/usr/bin/env python3\n", None),
+                (b"#!/usr/bin/env python3", None),
+                (b"#!/bin/sh\n", None),
+                (b"import os\n", None),
+                (b"", None)]:
+            self.assertEqual(set_python_runtime.get_new_shebang(first_line), new_shebang, first_line)
+
+    def test_fix_shebang(self):
+        # not valid UTF-8, and bigger than the copy chunk
+        body = b"# \xff\xfe\n" + b"print('hello')\n" * 100000
+        script = self._write("usr/bin/script", b"#!/build/usr/bin/python3\n" + body, 0o750)
+        self.assertTrue(set_python_runtime.fix_shebang(script))
+        self.assertEqual(self._read(script), b"#!/usr/bin/env python3\n" + body)
+        self.assertEqual(stat.S_IMODE(os.stat(script).st_mode), 0o750)
+        self.assertFalse(set_python_runtime.fix_shebang(script))
+        self.assertEqual(os.listdir(os.path.dirname(script)), ["script"])
+
+    def test_symlink(self):
+        script = self._write("usr/lib/script.py", b"#!/usr/bin/python3\n")
+        link = os.path.join(self._folder, "usr/lib/link.py")
+        os.symlink("script.py", link)
+        self.assertTrue(set_python_runtime.fix_shebang(link))
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(self._read(script), b"#!/usr/bin/env python3\n")
+
+    def test_main(self):
+        scripts = [self._write("bin/a", b"#!/usr/bin/python3\nprint(1)\n", 0o755),
+                   self._write("lib/b.py", b"#!/usr/bin/python2\n"),
+                   self._write("bin/c", b"#!/bin/sh\necho 1\n"),
+                   self._write("share/d", b"#!" + b"a" * 5000 + b"python3\n"),
+                   self._write("share/e", b"")]
+        contents = [self._read(script) for script in scripts]
+        set_python_runtime.main(self._folder)
+        self.assertEqual(self._read(scripts[0]), b"#!/usr/bin/env python3\nprint(1)\n")
+        self.assertEqual(self._read(scripts[1]), b"#!/usr/bin/env python2\n")
+        for script, content in list(zip(scripts, contents))[2:]:
+            self.assertEqual(self._read(script), content)
+
+    def test_walk_candidates(self):
+        shebang = b"#!/usr/bin/python3\n"
+        for path, mode in [("usr/bin/tool", 0o755), ("usr/bin/tool.real", 0o755), ("usr/bin/readme", 0o644),
+                           ("usr/libexec/pkg/helper-1.0", 0o755), ("usr/lib/pkg/module.py", 0o644),
+                           ("usr/lib/pkg/run", 0o700), ("usr/lib/x86_64-linux-gnu/libfoo.so.1", 0o755),
+                           ("usr/share/pkg/data.txt", 0o755), ("usr/share/locale/es/LC_MESSAGES/run", 0o755),
+                           ("usr/lib/x86_64-linux-gnu/gdk-pixbuf-2.0/loader.py", 0o644),
+                           ("usr/lib/.hidden/run", 0o755), ("usr/share/extra/tool.py", 0o644)]:
+            self._write(path, shebang, mode)
+        os.symlink("tool", os.path.join(self._folder, "usr/bin/link"))
+        candidates = [os.path.relpath(path, self._folder)
+                      for path in set_python_runtime.walk_candidates(self._folder)]
+        self.assertEqual(candidates, ["usr/bin/tool", "usr/bin/tool.real", "usr/lib/pkg/module.py",
+                                      "usr/lib/pkg/run", "usr/libexec/pkg/helper-1.0", "usr/share/extra/tool.py"])
+        candidates = list(set_python_runtime.walk_candidates(self._folder, ["usr/share/extra", "usr/lib/pkg/"]))
+        self.assertEqual(len(candidates), 5)
+        self.assertNotIn(os.path.join(self._folder, "usr/share/extra/tool.py"), candidates)
+        self.assertIn(os.path.join(self._folder, "usr/share/locale/es/LC_MESSAGES/run"), candidates)
+
+    def test_walk_missing_folder(self):
+        # a part that doesn't install any bin or usr/bin folder
+        self._write("usr/lib/pkg/module.py", b"VALUE = 1\n")
+        self.assertEqual(list(set_python_runtime.walk_candidates(os.path.join(self._folder, "usr/bin"))), [])
+        self.assertEqual(list(set_python_runtime.walk_candidates(os.path.join(self._folder, "bin"))), [])
+        self.assertEqual(set_python_runtime.main(os.path.join(self._folder, "usr/bin")), (0, 0))
+        self.assertEqual(list(set_python_runtime.walk_candidates(self._folder)),
+                         [os.path.join(self._folder, "usr/lib/pkg/module.py")])
+
+    def test_precompile(self):
+        module = self._write("usr/lib/python3/dist-packages/pkg/module.py", b"#!/usr/bin/python3\nVALUE = 1\n")
+        self._write("usr/lib/python3/dist-packages/single.py", b"VALUE = 2\n")
+        old_module = self._write("usr/lib/python2.7/old.py", b"print 'hello'\n")
+        applications = set_python_runtime.precompile(self._folder, [
+            module, os.path.join(self._folder, "usr/lib/python3/dist-packages/single.py"), old_module], 2)
+        self.assertEqual(sorted(applications), ["usr/lib/python3/dist-packages/pkg",
+                                                "usr/lib/python3/dist-packages/single"])
+        self.assertEqual(applications["usr/lib/python3/dist-packages/pkg"][0], 1)
+        with open(importlib.util.cache_from_source(module), "rb") as compiled_file:
+            header = compiled_file.read(8)
+        # hash based, without checking the source
+        self.assertEqual(int.from_bytes(header[4:8], "little"), 1)
+        with open(importlib.util.cache_from_source(module), "rb") as compiled_file:
+            code = marshal.loads(compiled_file.read()[16:])
+        # the path inside the snap, not the one in the build folder
+        self.assertEqual(code.co_filename, "/usr/lib/python3/dist-packages/pkg/module.py")
+        self.assertFalse(os.path.exists(importlib.util.cache_from_source(old_module)))
+
+    def test_main_compile(self):
+        module = self._write("usr/lib/app/module.py", b"#!/usr/bin/python3\nVALUE = 1\n")
+        set_python_runtime.main(self._folder, compile_python=True, jobs=1)
+        # compiled after fixing the shebang
+        with open(importlib.util.cache_from_source(module), "rb") as compiled_file:
+            self.assertEqual(compiled_file.read()[8:16], importlib.util.source_hash(self._read(module)))
+
+    def test_manifest(self):
+        cache_folder = os.path.join(self._folder, "cache")
+        base_path = os.path.join(self._folder, "stage")
+        scripts = [self._write("stage/usr/bin/tool", b"#!/usr/bin/env python3\n", 0o755),
+                   self._write("stage/usr/lib/app/module.py", b"VALUE = 1\n"),
+                   self._write("stage/usr/bin/other", b"#!/usr/bin/python3\n", 0o755)]
+        for script in scripts:
+            os.utime(script, ns=(1000000000, 1000000000))
+        self.assertEqual(set_python_runtime.main(base_path, cache_folder=cache_folder), (3, 1))
+        # the fixed file has just been modified, so it is checked again
+        self.assertEqual(set_python_runtime.main(base_path, cache_folder=cache_folder), (1, 0))
+        os.utime(scripts[2], ns=(1000000000, 1000000000))
+        self.assertEqual(set_python_runtime.main(base_path, cache_folder=cache_folder), (1, 0))
+        self.assertEqual(set_python_runtime.main(base_path, cache_folder=cache_folder), (0, 0))
+        self._write("stage/usr/bin/tool", b"#!/usr/bin/python3\n", 0o755)
+        os.utime(scripts[0], ns=(1000000000, 1000000000))
+        self.assertEqual(set_python_runtime.main(base_path, cache_folder=cache_folder), (1, 1))
+        os.utime(scripts[0], ns=(1000000000, 1000000000))
+        self.assertEqual(set_python_runtime.main(base_path, cache_folder=cache_folder, full=True), (3, 0))
+        # the files not compiled yet are checked again when compiling
+        self.assertEqual(set_python_runtime.main(base_path, compile_python=True, jobs=1, cache_folder=cache_folder),
+                         (1, 0))
+        self.assertEqual(set_python_runtime.main(base_path, compile_python=True, jobs=1, cache_folder=cache_folder),
+                         (0, 0))
+        # a corrupted manifest is ignored
+        manifest = set_python_runtime.Manifest(base_path, cache_folder)
+        with open(manifest.path, "wb") as manifest_file:
+            manifest_file.write(b"SPRT")
+        self.assertEqual(set_python_runtime.main(base_path, cache_folder=cache_folder), (3, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+""" Micro-benchmarks for test_doc_checker """
+
+import sys
+import timeit
+import test_doc_checker
+
+OPTION_TYPES = [("boolean", "true"), ("feature", "'auto'"), ("combo", "'auto'"), ("string", "''")]
+
+
+def generate_options(count):
+    """Returns a meson options file with 'count' options, with comments and choices"""
+    lines = ["# generated options file"]
+    for number in range(count):
+        option_type, value = OPTION_TYPES[number % len(OPTION_TYPES)]
+        choices = ", choices: ['auto', 'yes', 'no']" if option_type == "combo" else ""
+        lines.append(f"option('option{number}', type: '{option_type}', value: {value}{choices},")
+        lines.append(f"  description: 'Option number {number} (see the docs)')  # comment {number}")
+    return "\n".join(lines) + "\n"
+
+
+def split_options(data):
+    """The way test_doc_checker read the options before the parser"""
+    options = []
+    for option in data.split('option('):
+        option_name = test_doc_checker.extract_option_value(option)
+        if option_name is None:
+            continue
+        options.append((option_name,
+                        test_doc_checker.extract_option_value(option, 'description:'),
+                        test_doc_checker.extract_option_value(option, 'value:'),
+                        test_doc_checker.extract_option_value(option, 'type:')))
+    return options
+
+
+def benchmark_parser(count=20000):
+    data = generate_options(count)
+    assert len(test_doc_checker.parse_meson_options(data)) == count
+    split_time = min(timeit.repeat(lambda: split_options(data), number=1, repeat=3))
+    parser_time = min(timeit.repeat(lambda: test_doc_checker.parse_meson_options(data), number=1, repeat=3))
+    print(f"Meson options: {count} options, {len(data)} bytes")
+    print(f"  split and search: {split_time:.3f} s")
+    print(f"  parser:           {parser_time:.3f} s ({count / parser_time:.0f} options per second)")
+
+
+BENCHMARKS = {"parser": benchmark_parser}
+
+if __name__ == "__main__":
+    for name in (sys.argv[1:] if len(sys.argv) > 1 else BENCHMARKS.keys()):
+        BENCHMARKS[name]()
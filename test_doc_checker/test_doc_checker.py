@@ -1,8 +1,47 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import yaml
+import argparse
+import concurrent.futures
 import fnmatch
+import hashlib
+import json
+import tempfile
+import threading
+import time
+import zlib
+
+# the files with the meson options, in order of preference
+MESON_OPTIONS_FILES = ['meson.options', 'meson_options.txt']
+# the tokens of the meson options files, each one with the spaces and comments before it; meson
+# ignores the newlines inside parentheses, and the options files only contain option() calls, so
+# newlines are just spaces here
+MESON_TOKEN_REGEX = re.compile(r"""
+    (?:[ \t\r\n]|\#[^\n]*)*
+    (?:
+    (?P<end>$)
+  | (?P<multiline_string>'''.*?''')
+  | (?P<string>'(?:[^'\\\n]|\\.)*')
+  | (?P<number>0[xX][0-9a-fA-F]+|0[oO][0-7]+|0[bB][01]+|[0-9]+)
+  | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<symbol>[()\[\]{},:+-])
+  | (?P<error>.)
+    )
+""", re.VERBOSE | re.DOTALL)
+MESON_ESCAPES = {'\\': '\\', "'": "'", 'n': '\n', 't': '\t', 'r': '\r', 'a': '\a', 'b': '\b', 'f': '\f',
+                 'v': '\v', '0': '\0'}
+# the default value of each option type, when it has no 'value'
+MESON_DEFAULT_VALUES = {'boolean': True, 'feature': 'auto', 'string': '', 'integer': None}
+
+# version of the format of the options cache
+CACHE_VERSION = 1
+# files modified less than this time (in nanoseconds) before being read are read again the next time
+MTIME_MARGIN = 2000000000
+
+# the libyaml based loader is much faster, but it isn't always available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 def get_snapcraft_yaml():
     """Returns a string with the full path of the snapcraft file.
@@ -25,6 +64,35 @@ def get_snapcraft_yaml():
     return snapcraft_file_path
 
 
+class Project:
+    """The contents of a snapcraft.yaml file
+
+    The file is parsed only once, when the object is created, and the object
+    is passed to the functions that need the data of the parts.
+
+    Parameters
+    ----------
+    snapcraft_file : string or None
+        The path of the snapcraft.yaml file, or None to search it in the
+        project folder (see get_snapcraft_yaml()).
+
+    Raises
+    ------
+    FileNotFoundError
+        Raised if the snapcraft.yaml file can't be found.
+    """
+
+    def __init__(self, snapcraft_file=None):
+        if snapcraft_file is None:
+            snapcraft_file = get_snapcraft_yaml()
+        if snapcraft_file is None:
+            raise FileNotFoundError("Can't find snapcraft.yaml file")
+        self.path = snapcraft_file
+        with open(snapcraft_file, "r") as snapcraft_stream:
+            self.data = yaml.load(snapcraft_stream, Loader=YamlLoader)
+        self.parts = {part_name: self.data["parts"][part_name] for part_name in self.data["parts"]}
+
+
 def get_all_parts():
     """Get a list with the name of all the parts in the YAML file
 
@@ -38,13 +106,7 @@ def get_all_parts():
     FileNotFoundError
         Raised if the snapcraft.yaml file can't be found.
     """
-    snapcraft_file = get_snapcraft_yaml()
-    if snapcraft_file is None:
-        raise FileNotFoundError("Can't find snapcraft.yaml file")
-    with open(snapcraft_file, "r") as snapcraft_stream:
-        snapcraft_data = yaml.load(snapcraft_stream, Loader=yaml.Loader)
-    parts_data = {part_name:snapcraft_data["parts"][part_name] for part_name in snapcraft_data["parts"] }
-    return parts_data
+    return Project().parts
 
 
 def get_parts_folder():
@@ -72,8 +134,11 @@ def get_parts_folder():
     return src_folder[:pos + len(parts_string) - 1] # -1 to remove the trailing '/'
 
 
-def get_meson_options_file_for_part(part_name):
-    """Returns the contents of the meson_options.txt file for the specified part
+def get_meson_options_path_for_part(part_name):
+    """Returns the path of the meson options file for the specified part
+
+    Like meson, it uses meson.options if it exists, and meson_options.txt
+    if not.
 
     Parameters
     ----------
@@ -83,19 +148,280 @@ def get_meson_options_file_for_part(part_name):
     Returns
     -------
     string or None
-        The contents of the meson_options.txt for the specified part, or None if
+        The path of the options file for the specified part, or None if
         the file or the part doesn't exist.
     """
     parts_folder = get_parts_folder()
+    for options_file in MESON_OPTIONS_FILES:
+        meson_path = os.path.join(parts_folder, part_name, 'src', options_file)
+        if os.path.exists(meson_path):
+            return meson_path
+    return None
+
+
+def get_meson_options_file_for_part(part_name):
+    """Returns the contents of the meson options file for the specified part
 
-    meson_path = os.path.join(parts_folder, part_name, 'src', 'meson_options.txt')
-    if not os.path.exists(meson_path):
+    Parameters
+    ----------
+    part_name : string
+        the part name
+
+    Returns
+    -------
+    string or None
+        The contents of the meson.options or meson_options.txt file for the
+        specified part, or None if the file or the part doesn't exist.
+    """
+    meson_path = get_meson_options_path_for_part(part_name)
+    if meson_path is None:
         return None
     with open(meson_path, "r") as meson_file:
         data = meson_file.read()
     return data
 
 
+class MesonParseError(ValueError):
+    """Raised when a meson options file has a syntax error
+
+    Attributes
+    ----------
+    line : int
+        The line where the error is.
+    """
+
+    def __init__(self, message, line):
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+
+
+class MesonOption:
+    """An option defined in a meson options file
+
+    Attributes
+    ----------
+    name : string
+        The option name.
+    type : string or None
+        The option type ('boolean', 'feature', 'combo', 'string', 'integer'
+        or 'array').
+    value : bool, string, int, list or None
+        The default value, with its type. If the option doesn't set it, the
+        default value that meson uses for its type.
+    description : string or None
+        The description of the option.
+    choices : list or None
+        The valid values for 'combo' and 'array' options.
+    arguments : dictionary
+        All the keyword arguments of the option() call.
+    line : int
+        The line where the option is defined.
+    """
+
+    def __init__(self, name, arguments, line):
+        self.name = name
+        self.arguments = arguments
+        self.line = line
+        self.type = arguments.get('type')
+        self.description = arguments.get('description')
+        self.choices = arguments.get('choices')
+        if 'value' in arguments:
+            self.value = arguments['value']
+        elif self.type in ('combo', 'array') and self.choices:
+            self.value = self.choices[0] if self.type == 'combo' else list(self.choices)
+        else:
+            self.value = MESON_DEFAULT_VALUES.get(self.type)
+
+    def get_value_string(self):
+        """Returns the default value as it is written in meson ('true', 'auto'...)"""
+        if isinstance(self.value, bool):
+            return 'true' if self.value else 'false'
+        if self.value is None:
+            return None
+        return str(self.value)
+
+
+def tokenize_meson(data):
+    """Splits the contents of a meson options file into tokens
+
+    Parameters
+    ----------
+    data : string
+        The contents of the file.
+
+    Returns
+    -------
+    array of tuples
+        Each token, as (kind, value, line), where kind is 'string', 'number',
+        'identifier', 'symbol' or 'end' (the last one). The strings are
+        already unquoted and the numbers converted.
+
+    Raises
+    ------
+    MesonParseError
+        Raised if there is an unexpected character.
+    """
+    tokens = []
+    line = 1
+    line_position = 0
+    position = 0
+    while True:
+        match = MESON_TOKEN_REGEX.match(data, position)
+        kind = match.lastgroup
+        text = match.group(kind)
+        start = match.start(kind)
+        line += data.count('\n', line_position, start)
+        line_position = start
+        position = match.end()
+        if kind == 'end':
+            break
+        if kind == 'error':
+            raise MesonParseError(f"unexpected character '{text}'", line)
+        if kind == 'string':
+            text = text[1:-1]
+            if '\\' in text:
+                text = re.sub(r"\\(.)", lambda escape: MESON_ESCAPES.get(escape.group(1), escape.group(0)), text)
+        elif kind == 'multiline_string':
+            kind = 'string'
+            text = text[3:-3]
+        elif kind == 'number':
+            text = int(text, 0)
+        tokens.append((kind, text, line))
+    tokens.append(('end', None, line))
+    return tokens
+
+
+class MesonOptionsParser:
+    """Parses the tokens of a meson options file
+
+    It only understands what the options files allow: a list of calls to
+    option(), whose arguments are strings, numbers, booleans, arrays and
+    dictionaries, optionally joined with '+'.
+    """
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._position = 0
+
+    def _peek(self):
+        return self._tokens[self._position]
+
+    def _next(self):
+        token = self._tokens[self._position]
+        if token[0] != 'end':
+            self._position += 1
+        return token
+
+    def _expect(self, kind, value=None):
+        token = self._next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            expected = value if value is not None else kind
+            found = token[1] if token[0] != 'end' else 'end of file'
+            raise MesonParseError(f"expected '{expected}' but found '{found}'", token[2])
+        return token
+
+    def _is_symbol(self, value):
+        token = self._peek()
+        return token[0] == 'symbol' and token[1] == value
+
+    def parse(self):
+        """Returns the options defined in the file, as MesonOption objects"""
+        options = []
+        while self._peek()[0] != 'end':
+            function = self._expect('identifier')
+            arguments, keyword_arguments = self._parse_arguments()
+            if function[1] != 'option':
+                raise MesonParseError(f"unexpected function '{function[1]}'", function[2])
+            if len(arguments) != 1 or not isinstance(arguments[0], str):
+                raise MesonParseError("option() needs the option name as the only positional argument",
+                                      function[2])
+            options.append(MesonOption(arguments[0], keyword_arguments, function[2]))
+        return options
+
+    def _parse_arguments(self):
+        self._expect('symbol', '(')
+        arguments = []
+        keyword_arguments = {}
+        while not self._is_symbol(')'):
+            token = self._peek()
+            if token[0] == 'identifier' and self._tokens[self._position + 1][1] == ':':
+                self._next()
+                self._next()
+                keyword_arguments[token[1]] = self._parse_expression()
+            elif keyword_arguments:
+                raise MesonParseError("positional argument after keyword arguments", token[2])
+            else:
+                arguments.append(self._parse_expression())
+            if not self._is_symbol(')'):
+                self._expect('symbol', ',')
+        self._next()
+        return arguments, keyword_arguments
+
+    def _parse_expression(self):
+        value = self._parse_value()
+        while self._is_symbol('+'):
+            token = self._next()
+            other_value = self._parse_value()
+            if type(value) is not type(other_value) or isinstance(value, bool):
+                raise MesonParseError("wrong types for '+'", token[2])
+            value = value + other_value
+        return value
+
+    def _parse_list(self, end_symbol):
+        elements = []
+        while not self._is_symbol(end_symbol):
+            elements.append(self._parse_expression())
+            if not self._is_symbol(end_symbol):
+                self._expect('symbol', ',')
+        self._next()
+        return elements
+
+    def _parse_value(self):
+        token = self._next()
+        kind, value, line = token
+        if kind in ('string', 'number'):
+            return value
+        if kind == 'identifier' and value in ('true', 'false'):
+            return value == 'true'
+        if kind == 'symbol' and value == '-':
+            return -self._expect('number')[1]
+        if kind == 'symbol' and value == '[':
+            return self._parse_list(']')
+        if kind == 'symbol' and value == '{':
+            dictionary = {}
+            while not self._is_symbol('}'):
+                key = self._parse_expression()
+                self._expect('symbol', ':')
+                dictionary[key] = self._parse_expression()
+                if not self._is_symbol('}'):
+                    self._expect('symbol', ',')
+            self._next()
+            return dictionary
+        found = value if kind != 'end' else 'end of file'
+        raise MesonParseError(f"unexpected '{found}'", line)
+
+
+def parse_meson_options(data):
+    """Parses the contents of a meson options file
+
+    Parameters
+    ----------
+    data : string
+        The contents of a meson.options or meson_options.txt file.
+
+    Returns
+    -------
+    array of MesonOption
+        The options defined in the file, in the same order.
+
+    Raises
+    ------
+    MesonParseError
+        Raised if the file has a syntax error.
+    """
+    return MesonOptionsParser(tokenize_meson(data)).parse()
+
+
 def extract_option_value(data, option_name = None):
     """Extract the data for the specified option name, removing simple quotes if needed
 
@@ -141,10 +467,156 @@ def extract_option_value(data, option_name = None):
     return data[begin: end]
 
 
-def find_test_doc_options(part_name):
-    """Finds the relevant options in the meson_options.txt file
+def get_cache_folder():
+    """Returns the default folder for the options cache
+
+    It is the same folder used by the other tools for their caches.
+
+    Returns
+    -------
+    string
+        The path of the folder where the cache must be stored.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "snap-build-tools")
 
-    This function reads the meson_options.txt file and searches the options
+
+class OptionsCache:
+    """The options of the meson options files already parsed
+
+    Each file is stored with its size, modification time and inode, so an
+    unchanged file costs only a stat() call, and with the hash of its
+    contents, so a file that has been touched or copied but not changed
+    isn't parsed again. The cache is stored in the cache folder, and can be
+    used from several threads.
+
+    Parameters
+    ----------
+    cache_folder : string or None
+        The folder where the cache is stored, or None to keep it only in
+        memory.
+    """
+
+    def __init__(self, cache_folder=None):
+        self.path = None if cache_folder is None else os.path.join(cache_folder, "test_doc_checker.cache")
+        self.files = {}
+        self._by_hash = {}
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Reads the cache file, if it exists and has the right version"""
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "rb") as cache_file:
+                data = json.loads(zlib.decompress(cache_file.read()))
+        except (OSError, ValueError, zlib.error):
+            return
+        if data.get("version") != CACHE_VERSION:
+            return
+        self.files = data["files"]
+        self._by_hash = {entry["hash"]: entry["options"] for entry in self.files.values()}
+
+    def save(self):
+        """Writes the cache file if it has changed, replacing it atomically"""
+        if self.path is None or not self._changed:
+            return
+        data = zlib.compress(json.dumps({"version": CACHE_VERSION, "files": self.files}).encode("utf-8"))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".tmp-")
+        try:
+            with os.fdopen(descriptor, "wb") as temporary_file:
+                temporary_file.write(data)
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+        self._changed = False
+
+    def get_options(self, meson_path, file_stat):
+        """Returns the options of a meson options file, parsing it only if needed
+
+        Parameters
+        ----------
+        meson_path : string
+            The path of the options file.
+        file_stat : os.stat_result
+            The result of stat() for the file.
+
+        Returns
+        -------
+        array of MesonOption
+            The options defined in the file.
+
+        Raises
+        ------
+        MesonParseError
+            Raised if the file has a syntax error.
+        """
+        signature = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+        with self._lock:
+            entry = self.files.get(meson_path)
+        if entry is not None and entry["signature"] == signature:
+            return [MesonOption(option["name"], option["arguments"], option["line"]) for option in entry["options"]]
+        with open(meson_path, "rb") as meson_file:
+            data = meson_file.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            cached_options = self._by_hash.get(content_hash)
+        if cached_options is not None:
+            options = [MesonOption(option["name"], option["arguments"], option["line"]) for option in cached_options]
+        else:
+            options = parse_meson_options(data.decode("utf-8"))
+            cached_options = [{"name": option.name, "arguments": option.arguments, "line": option.line}
+                              for option in options]
+        if file_stat.st_mtime_ns > time.time_ns() - MTIME_MARGIN:
+            # it could be modified again without changing its signature
+            signature = None
+        with self._lock:
+            self.files[meson_path] = {"signature": signature, "hash": content_hash, "options": cached_options}
+            self._by_hash[content_hash] = cached_options
+            self._changed = True
+        return options
+
+
+def load_meson_options_for_part(part_name, cache=None):
+    """Returns the options defined in the meson options file of a part
+
+    Parameters
+    ----------
+    part_name : string
+        the part name
+    cache : OptionsCache or None
+        The cache with the files already parsed, or None to parse the file.
+
+    Returns
+    -------
+    array of MesonOption
+        The options, or an empty list if the part has no options file.
+
+    Raises
+    ------
+    MesonParseError
+        Raised if the options file has a syntax error.
+    """
+    if cache is None:
+        cache = OptionsCache()
+    parts_folder = get_parts_folder()
+    for options_file in MESON_OPTIONS_FILES:
+        meson_path = os.path.join(parts_folder, part_name, 'src', options_file)
+        try:
+            file_stat = os.stat(meson_path)
+        except OSError:
+            continue
+        return cache.get_options(meson_path, file_stat)
+    return []
+
+
+def find_test_doc_options(part_name, cache=None):
+    """Finds the relevant options in the meson options file
+
+    This function reads the meson.options or meson_options.txt file and searches the options
     that could be relevant for building a snap. Specifically it searches for
     documentation, tests, vapi and gobject introspection options. The former
     two should be disabled, while the later two should be enabled.
@@ -153,46 +625,39 @@ def find_test_doc_options(part_name):
     ----------
     part_name : string
         The part to search for options in the meson_options.txt file.
+    cache : OptionsCache or None
+        The cache with the files already parsed, or None to parse the file.
 
     Returns
     -------
     Array of dictionaries with these entries:
         * name: the meson option name
         * description: the description of the option
-        * value: the default value of the option
+        * value: the default value of the option, as written in meson
         * type: the option type
         * desired: if that option should be enabled or disabled
+
+    Raises
+    ------
+    MesonParseError
+        Raised if the options file has a syntax error.
     """
     options_list_disabled = ['doc*', 'test*', 'demo*']
     options_list_enabled = ['*vapi*', 'introspection']
-    meson_data = get_meson_options_file_for_part(part_name)
-
-    if meson_data is None:
-        return []
-
     valid_options = []
-
-    options = meson_data.split('option(')
-    for option in options:
-        option_name = extract_option_value(option)
-        if option_name is None:
-            continue
-        option_description = extract_option_value(option, 'description:')
-        option_value = extract_option_value(option, 'value:')
-        option_type = extract_option_value(option, 'type:')
-
+    for option in load_meson_options_for_part(part_name, cache):
         for option_mask in options_list_disabled + options_list_enabled:
-            if fnmatch.fnmatch(option_name, option_mask):
+            if fnmatch.fnmatch(option.name, option_mask):
                 valid_options.append({"desired": option_mask in options_list_enabled,
-                                      "name": option_name,
-                                      "description": option_description,
-                                      "value": option_value,
-                                      "type": option_type})
+                                      "name": option.name,
+                                      "description": option.description,
+                                      "value": option.get_value_string(),
+                                      "type": option.type})
                 break
     return valid_options
 
 
-def find_meson_parameters_for_part(part_name):
+def find_meson_parameters_for_part(part_name, project=None):
     """Returns the list of meson parameters for a part
 
     Returns the configurable parameters (the ones with the form -Dxxxx) currently
@@ -202,6 +667,8 @@ def find_meson_parameters_for_part(part_name):
     ----------
     part_name : string
         The part to analyze
+    project : Project or None
+        The project, or None to read the snapcraft.yaml file
 
     Returns
     -------
@@ -210,25 +677,65 @@ def find_meson_parameters_for_part(part_name):
         the value set for that option. It will return None if the part doesn't use
         the 'meson' plugin.
     """
-    part_data = get_all_parts()[part_name]
+    if project is None:
+        project = Project()
+    part_data = project.parts[part_name]
     if part_data['plugin'] != 'meson':
         return None
-    if 'meson-parameters' not in part_data:
+    # an empty 'meson-parameters' entry is null
+    meson_parameters = part_data.get('meson-parameters') or []
+    if not isinstance(meson_parameters, list):
         return {}
     parameters = {}
-    for parameter in part_data['meson-parameters']:
-        if not parameter.startswith('-D'):
+    for parameter in meson_parameters:
+        if not isinstance(parameter, str) or not parameter.startswith('-D'):
             continue
-        parameter = parameter[2:].split('=')
-        parameters[parameter[0].strip()] = parameter[1].strip()
+        # a bare -Dxxxx has an empty value
+        name, _, value = parameter[2:].partition('=')
+        parameters[name.strip()] = value.strip()
     return parameters
 
 
-def find_missing_meson_options(part_name):
-    parameters = find_meson_parameters_for_part(part_name)
+def scan_parts(project, jobs=None, cache=None):
+    """Finds the relevant options of all the meson parts in parallel
+
+    Parameters
+    ----------
+    project : Project
+        The project.
+    jobs : int or None
+        Number of threads, or None to use one per CPU.
+    cache : OptionsCache or None
+        The cache with the files already parsed, or None to parse all of them.
+
+    Returns
+    -------
+    dictionary
+        For each part that uses the meson plugin, the list returned by
+        find_test_doc_options(), or the MesonParseError raised when parsing
+        its options file.
+    """
+    if cache is None:
+        cache = OptionsCache()
+    meson_parts = [part_name for part_name, part_data in project.parts.items()
+                   if part_data.get('plugin') == 'meson']
+
+    def scan_part(part_name):
+        try:
+            return find_test_doc_options(part_name, cache)
+        except MesonParseError as error:
+            return error
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(meson_parts, executor.map(scan_part, meson_parts)))
+
+
+def find_missing_meson_options(part_name, project=None, options=None):
+    parameters = find_meson_parameters_for_part(part_name, project)
     if parameters is None:
         return {}
-    options = find_test_doc_options(part_name)
+    if options is None:
+        options = find_test_doc_options(part_name)
     if len(options) == 0:
         return {}
 
@@ -246,12 +753,167 @@ def find_missing_meson_options(part_name):
         missing_options[option["name"]] = option
     return missing_options
 
-def process_project():
-    parts = get_all_parts()
-    for part in parts:
-        missing_options = find_missing_meson_options(part)
+
+def get_fixed_value(option):
+    """Returns the value that an option must have, or None if it can't be decided
+
+    Parameters
+    ----------
+    option : dictionary
+        An option, like the ones returned by find_test_doc_options().
+
+    Returns
+    -------
+    string or None
+        'true' or 'false' for boolean options, 'enabled' or 'disabled' for
+        feature options, and None for the other types.
+    """
+    if option['type'] == 'boolean':
+        return 'true' if option['desired'] else 'false'
+    if option['type'] == 'feature':
+        return 'enabled' if option['desired'] else 'disabled'
+    return None
+
+
+def _get_mapping_entry(mapping_node, key):
+    """Returns the key and value nodes of an entry of a YAML mapping node, or (None, None)"""
+    if not isinstance(mapping_node, yaml.MappingNode):
+        return None, None
+    for key_node, value_node in mapping_node.value:
+        if isinstance(key_node, yaml.ScalarNode) and key_node.value == key:
+            return key_node, value_node
+    return None, None
+
+
+def fix_snapcraft_yaml(snapcraft_file, part_parameters):
+    """Adds meson parameters to several parts of a snapcraft.yaml file
+
+    The file is composed (not loaded) to know where the nodes of each part
+    are, and the new parameters are inserted as text in those places, so
+    the comments and the format of the rest of the file are kept. All the
+    parts are changed at once, and the file is written only once. The pure
+    python loader is used because its marks are always in characters.
+
+    If a part has no 'meson-parameters' entry, it is added after the
+    'plugin' entry, and if the entry is empty (null), the list is added to
+    it. The parts whose 'meson-parameters' list is shared with other parts
+    through an alias, or whose entry isn't a list, aren't changed.
+
+    Parameters
+    ----------
+    snapcraft_file : string
+        The path of the snapcraft.yaml file.
+    part_parameters : dictionary
+        For each part, the list of parameters to add (like '-Ddocs=false').
+
+    Returns
+    -------
+    dictionary
+        For each part changed, the list of parameters added.
+    """
+    with open(snapcraft_file, "r") as snapcraft_stream:
+        text = snapcraft_stream.read()
+    root_node = yaml.compose(text, Loader=yaml.SafeLoader)
+    line_offsets = [0] + [match.end() for match in re.finditer('\n', text)]
+
+    def get_line_offset(line):
+        return line_offsets[line] if line < len(line_offsets) else len(text)
+
+    _, parts_node = _get_mapping_entry(root_node, 'parts')
+    parameter_nodes = {}
+    for _, part_node in (parts_node.value if isinstance(parts_node, yaml.MappingNode) else []):
+        _, parameters_node = _get_mapping_entry(part_node, 'meson-parameters')
+        if parameters_node is not None:
+            parameter_nodes[id(parameters_node)] = parameter_nodes.get(id(parameters_node), 0) + 1
+
+    insertions = []
+    fixed_parts = {}
+    for part_name, parameters in part_parameters.items():
+        _, part_node = _get_mapping_entry(parts_node, part_name)
+        if len(parameters) == 0 or not isinstance(part_node, yaml.MappingNode):
+            continue
+        parameters_key, parameters_node = _get_mapping_entry(part_node, 'meson-parameters')
+        if parameters_node is None:
+            plugin_key, plugin_value = _get_mapping_entry(part_node, 'plugin')
+            if plugin_key is None:
+                continue
+            indentation = ' ' * plugin_key.start_mark.column
+            new_text = f"{indentation}meson-parameters:\n"
+            new_text += "".join(f"{indentation}  - {parameter}\n" for parameter in parameters)
+            offset = get_line_offset(plugin_value.end_mark.line + 1)
+            insertions.append((offset, offset, new_text))
+        elif parameter_nodes[id(parameters_node)] > 1:
+            print(f"Can't add the meson parameters to {part_name}: its meson-parameters entry is shared")
+            continue
+        elif isinstance(parameters_node, yaml.ScalarNode) and parameters_node.tag == 'tag:yaml.org,2002:null':
+            # like "meson-parameters:" or "meson-parameters: ~"; the null value is removed
+            insertions.append((parameters_key.end_mark.index, parameters_node.end_mark.index, ":"))
+            indentation = ' ' * parameters_key.start_mark.column
+            new_text = "".join(f"{indentation}  - {parameter}\n" for parameter in parameters)
+            offset = get_line_offset(parameters_node.end_mark.line + 1)
+            insertions.append((offset, offset, new_text))
+        elif not isinstance(parameters_node, yaml.SequenceNode):
+            print(f"Can't add the meson parameters to {part_name}: its meson-parameters entry is not a list")
+            continue
+        elif parameters_node.flow_style or len(parameters_node.value) == 0:
+            # like "meson-parameters: [ -Dfoo=bar ]"
+            if len(parameters_node.value) != 0:
+                offset = parameters_node.value[-1].end_mark.index
+                insertions.append((offset, offset, ", " + ", ".join(parameters)))
+            elif text[parameters_node.end_mark.index - 1] == ']':
+                offset = parameters_node.end_mark.index - 1
+                insertions.append((offset, offset, " " + ", ".join(parameters) + " "))
+            else:
+                continue
+        else:
+            first_node = parameters_node.value[0]
+            last_node = parameters_node.value[-1]
+            first_line = text[get_line_offset(first_node.start_mark.line):first_node.start_mark.index]
+            indentation = first_line[:first_line.rfind('-')]
+            quote = text[last_node.start_mark.index]
+            quote = quote if quote in "'\"" else ""
+            end_line = last_node.end_mark.line + (0 if last_node.end_mark.column == 0 else 1)
+            new_text = "".join(f"{indentation}- {quote}{parameter}{quote}\n" for parameter in parameters)
+            offset = get_line_offset(end_line)
+            insertions.append((offset, offset, new_text))
+        fixed_parts[part_name] = parameters
+
+    # each insertion replaces the text between its two offsets
+    for start, end, new_text in sorted(insertions, key=lambda insertion: insertion[0], reverse=True):
+        if start == len(text) and not text.endswith("\n") and new_text.endswith("\n"):
+            new_text = "\n" + new_text
+        text = text[:start] + new_text + text[end:]
+    if len(insertions) != 0:
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(snapcraft_file), prefix=".tmp-")
+        try:
+            with os.fdopen(descriptor, "w") as temporary_file:
+                temporary_file.write(text)
+                os.fchmod(temporary_file.fileno(), os.stat(snapcraft_file).st_mode & 0o7777)
+            os.replace(temporary_path, snapcraft_file)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+    return fixed_parts
+
+
+def process_project(project=None, jobs=None, cache_folder=None, fix=False):
+    if project is None:
+        project = Project()
+    cache = OptionsCache(cache_folder)
+    cache.load()
+    part_options = scan_parts(project, jobs, cache)
+    cache.save()
+    part_parameters = {}
+    for part in project.parts:
+        if isinstance(part_options.get(part), MesonParseError):
+            print(f"Can't read the meson options for {part}: {part_options[part]}")
+            continue
+        missing_options = find_missing_meson_options(part, project, part_options.get(part, []))
         if len(missing_options) == 0:
             continue
+        part_parameters[part] = [f"-D{option_name}={get_fixed_value(missing_options[option_name])}"
+                                 for option_name in missing_options
+                                 if get_fixed_value(missing_options[option_name]) is not None]
         print(f"Missing meson options for {part}:")
         for option_name in missing_options:
             option = missing_options[option_name]
@@ -267,6 +929,26 @@ def process_project():
                     print(f"    should be '{'enabled' if option['desired'] else 'disabled'}'")
                 else:
                     print(f"    type: {option['type']}")
+    if fix:
+        fixed_parts = fix_snapcraft_yaml(project.path, part_parameters)
+        for part in fixed_parts:
+            print(f"Added {' '.join(fixed_parts[part])} to {part}")
+
+
+def run():
+    parser = argparse.ArgumentParser(prog="test_doc_checker",
+                                     description="Checks the meson options for docs, tests, VAPI and introspection")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of parts scanned at the same time (by default, one per CPU)")
+    parser.add_argument('-c', '--cache-folder', default=None,
+                        help="Folder for the cache of the options files already parsed (by default, "
+                             "$XDG_CACHE_HOME/snap-build-tools)")
+    parser.add_argument('--fix', action='store_true', default=False,
+                        help="Add the missing options to the meson-parameters of the parts in snapcraft.yaml")
+    args = parser.parse_args()
+    process_project(None, args.jobs, args.cache_folder if args.cache_folder is not None else get_cache_folder(),
+                    args.fix)
+
 
 if __name__ == "__main__":
-    process_project()
+    run()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
 import os
+import contextlib
+import io
+import shutil
 import test_doc_checker
 
 import unittest
@@ -16,6 +19,16 @@ class TestDocTestOptions(unittest.TestCase):
         self.assertIn('ninja', parts) # just two of them are enough
         self.assertEqual(len(parts['ninja']), 6)
 
+    def test_project(self):
+        snapcraft_file = os.path.join(os.getcwd(), 'test_data', 'snapcraft.yaml')
+        project = test_doc_checker.Project(snapcraft_file)
+        self.assertEqual(project.path, snapcraft_file)
+        self.assertEqual(len(project.parts), 64)
+        os.environ['CRAFT_PART_SRC'] = os.path.join(os.getcwd(), 'test_data', 'parts', 'main_test', 'src')
+        missing_options = test_doc_checker.find_missing_meson_options('harfbuzz', project)
+        self.assertEqual(sorted(missing_options), ['docs', 'tests'])
+        self.assertRaises(FileNotFoundError, test_doc_checker.Project, os.path.join(os.getcwd(), 'snapcraft.yaml'))
+
     def test_yaml_file_fails(self):
         os.environ['CRAFT_PROJECT_DIR'] = os.path.join(os.getcwd())
         self.assertRaises(FileNotFoundError, test_doc_checker.get_all_parts)
@@ -109,6 +122,287 @@ class TestDocTestOptions(unittest.TestCase):
         self.assertIsNone(option_invalid)
 
 
+class TestMesonOptionsParser(unittest.TestCase):
+
+    OPTIONS = """# comment
+option('docs',  type  :  'boolean', value: false, # trailing comment
+  description: 'Build docs (needs gi-docgen (>= 2021.1))')
+option('tests', type: 'combo', choices: ['auto', 'yes', 'no'], description: 'it\\'s' + ' joined')
+option('size', type: 'integer', min: -1, max: 10, value: 0x10)
+option('list', type: 'array', choices: ['a', 'b',], deprecated: {'a': 'b'})
+option('text', type: 'string', value: '''multi
+line''')
+option('introspection', type: 'feature')
+"""
+
+    def test_parse_options(self):
+        options = test_doc_checker.parse_meson_options(self.OPTIONS)
+        self.assertEqual([option.name for option in options], ['docs', 'tests', 'size', 'list', 'text',
+                                                               'introspection'])
+        self.assertEqual([option.line for option in options], [2, 4, 5, 6, 7, 9])
+        self.assertEqual(options[0].value, False)
+        self.assertEqual(options[0].get_value_string(), 'false')
+        self.assertEqual(options[0].description, 'Build docs (needs gi-docgen (>= 2021.1))')
+        self.assertEqual(options[1].choices, ['auto', 'yes', 'no'])
+        self.assertEqual(options[1].value, 'auto')
+        self.assertEqual(options[1].description, "it's joined")
+        self.assertEqual(options[2].arguments['min'], -1)
+        self.assertEqual(options[2].value, 16)
+        self.assertEqual(options[3].value, ['a', 'b'])
+        self.assertEqual(options[3].arguments['deprecated'], {'a': 'b'})
+        self.assertEqual(options[4].value, 'multi\nline')
+        self.assertEqual(options[5].get_value_string(), 'auto')
+
+    def test_parse_errors(self):
+        for data, line in [("option('a', type: 'boolean'\nfoo)", 2), ("option('a',\n  type: $)", 2),
+                           ("project('a')", 1), ("option(type: 'boolean')", 1), ("option('a', type: ", 1)]:
+            with self.assertRaises(test_doc_checker.MesonParseError) as context:
+                test_doc_checker.parse_meson_options(data)
+            self.assertEqual(context.exception.line, line, data)
+
+    def test_meson_options_file(self):
+        folder = tempfile.mkdtemp()
+        old_part_src = os.environ.get('CRAFT_PART_SRC')
+        try:
+            src_folder = os.path.join(folder, 'parts', 'newpart', 'src')
+            os.makedirs(src_folder)
+            with open(os.path.join(src_folder, 'meson_options.txt'), 'w') as options_file:
+                options_file.write("option('tests', type: 'boolean', value: false)\n")
+            with open(os.path.join(src_folder, 'meson.options'), 'w') as options_file:
+                options_file.write(self.OPTIONS)
+            os.environ['CRAFT_PART_SRC'] = src_folder
+            self.assertEqual(test_doc_checker.get_meson_options_path_for_part('newpart'),
+                             os.path.join(src_folder, 'meson.options'))
+            options = test_doc_checker.find_test_doc_options('newpart')
+            self.assertEqual([(option['name'], option['value']) for option in options],
+                             [('docs', 'false'), ('tests', 'auto'), ('introspection', 'auto')])
+        finally:
+            shutil.rmtree(folder)
+            if old_part_src is not None:
+                os.environ['CRAFT_PART_SRC'] = old_part_src
+
+
+class TestOptionsCache(unittest.TestCase):
+
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+        self._parse_meson_options = test_doc_checker.parse_meson_options
+        self._parsed_files = 0
+
+        def counted_parse(data):
+            self._parsed_files += 1
+            return self._parse_meson_options(data)
+        test_doc_checker.parse_meson_options = counted_parse
+
+    def tearDown(self):
+        test_doc_checker.parse_meson_options = self._parse_meson_options
+        shutil.rmtree(self._folder)
+
+    def _write(self, path, content):
+        with open(path, "w") as options_file:
+            options_file.write(content)
+        os.utime(path, ns=(1000000000, 1000000000))
+
+    def test_cache(self):
+        cache_folder = os.path.join(self._folder, 'cache')
+        options_path = os.path.join(self._folder, 'meson_options.txt')
+        self._write(options_path, "option('docs', type: 'boolean', value: false, description: 'Docs')\n")
+        cache = test_doc_checker.OptionsCache(cache_folder)
+        options = cache.get_options(options_path, os.stat(options_path))
+        self.assertEqual([(option.name, option.value, option.description) for option in options],
+                         [('docs', False, 'Docs')])
+        cache.save()
+        # unchanged file
+        cache = test_doc_checker.OptionsCache(cache_folder)
+        cache.load()
+        options = cache.get_options(options_path, os.stat(options_path))
+        self.assertEqual([(option.name, option.value, option.line) for option in options], [('docs', False, 1)])
+        self.assertEqual(self._parsed_files, 1)
+        # a copy of the same file is found by its hash
+        copy_path = os.path.join(self._folder, 'meson.options')
+        shutil.copy(options_path, copy_path)
+        cache.get_options(copy_path, os.stat(copy_path))
+        self.assertEqual(self._parsed_files, 1)
+        # a modified file is parsed again
+        self._write(options_path, "option('tests', type: 'feature')\n")
+        options = cache.get_options(options_path, os.stat(options_path))
+        self.assertEqual([(option.name, option.value) for option in options], [('tests', 'auto')])
+        self.assertEqual(self._parsed_files, 2)
+
+    def test_scan_parts(self):
+        os.environ['CRAFT_PART_SRC'] = os.path.join(os.getcwd(), 'test_data', 'parts', 'main_test', 'src')
+        project = test_doc_checker.Project(os.path.join(os.getcwd(), 'test_data', 'snapcraft.yaml'))
+        cache = test_doc_checker.OptionsCache()
+        part_options = test_doc_checker.scan_parts(project, 4, cache)
+        self.assertEqual(sorted(option['name'] for option in part_options['harfbuzz']),
+                         ['doc_tests', 'docs', 'introspection', 'tests'])
+        self.assertEqual(part_options['glib'], [])
+        self.assertNotIn('buildenv', part_options)
+        parsed_files = self._parsed_files
+        test_doc_checker.scan_parts(project, 4, cache)
+        self.assertEqual(self._parsed_files, parsed_files)
+
+
+class TestFixSnapcraftYaml(unittest.TestCase):
+
+    SNAPCRAFT_YAML = """name: test # the name
+parts:
+  block:
+    plugin: meson
+    meson-parameters:
+      - --prefix=/usr # the prefix
+      - '-Dfoo=bar'
+    # comment after the parameters
+    source: .
+  flow:
+    plugin: meson
+    meson-parameters: [ --prefix=/usr ]
+  empty:
+    plugin: meson
+    meson-parameters: []
+  missing:
+    source: .
+    plugin: meson
+    build-packages: [ ragel ]
+  shared1:
+    plugin: meson
+    meson-parameters: &parameters
+      - -Dfoo=bar
+  shared2:
+    plugin: meson
+    meson-parameters: *parameters
+  unset:
+    plugin: meson
+    meson-parameters:
+    source: .
+  tilde:
+    plugin: meson
+    meson-parameters: ~ # no parameters
+  scalar:
+    plugin: meson
+    meson-parameters: -Dfoo=bar
+"""
+
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+        self._path = os.path.join(self._folder, 'snapcraft.yaml')
+        with open(self._path, 'w') as snapcraft_file:
+            snapcraft_file.write(self.SNAPCRAFT_YAML)
+
+    def tearDown(self):
+        shutil.rmtree(self._folder)
+
+    def test_fix_snapcraft_yaml(self):
+        parameters = ['-Ddocs=false', '-Dintrospection=enabled']
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            fixed_parts = test_doc_checker.fix_snapcraft_yaml(self._path, {part: parameters for part in [
+                'block', 'flow', 'empty', 'missing', 'shared2', 'nonexistent', 'unset', 'tilde', 'scalar']})
+        self.assertEqual(sorted(fixed_parts), ['block', 'empty', 'flow', 'missing', 'tilde', 'unset'])
+        self.assertEqual(output.getvalue().splitlines(), [
+            "Can't add the meson parameters to shared2: its meson-parameters entry is shared",
+            "Can't add the meson parameters to scalar: its meson-parameters entry is not a list"])
+        with open(self._path, 'r') as snapcraft_file:
+            content = snapcraft_file.read()
+        self.assertEqual(content, """name: test # the name
+parts:
+  block:
+    plugin: meson
+    meson-parameters:
+      - --prefix=/usr # the prefix
+      - '-Dfoo=bar'
+      - '-Ddocs=false'
+      - '-Dintrospection=enabled'
+    # comment after the parameters
+    source: .
+  flow:
+    plugin: meson
+    meson-parameters: [ --prefix=/usr, -Ddocs=false, -Dintrospection=enabled ]
+  empty:
+    plugin: meson
+    meson-parameters: [ -Ddocs=false, -Dintrospection=enabled ]
+  missing:
+    source: .
+    plugin: meson
+    meson-parameters:
+      - -Ddocs=false
+      - -Dintrospection=enabled
+    build-packages: [ ragel ]
+  shared1:
+    plugin: meson
+    meson-parameters: &parameters
+      - -Dfoo=bar
+  shared2:
+    plugin: meson
+    meson-parameters: *parameters
+  unset:
+    plugin: meson
+    meson-parameters:
+      - -Ddocs=false
+      - -Dintrospection=enabled
+    source: .
+  tilde:
+    plugin: meson
+    meson-parameters: # no parameters
+      - -Ddocs=false
+      - -Dintrospection=enabled
+  scalar:
+    plugin: meson
+    meson-parameters: -Dfoo=bar
+""")
+        parts = test_doc_checker.Project(self._path).parts
+        self.assertEqual(parts['missing']['meson-parameters'], parameters)
+        self.assertEqual(parts['unset']['meson-parameters'], parameters)
+        self.assertEqual(parts['tilde']['meson-parameters'], parameters)
+
+    def test_get_fixed_value(self):
+        for option_type, desired, value in [('boolean', True, 'true'), ('boolean', False, 'false'),
+                                            ('feature', True, 'enabled'), ('feature', False, 'disabled'),
+                                            ('combo', False, None)]:
+            self.assertEqual(test_doc_checker.get_fixed_value({'type': option_type, 'desired': desired}), value)
+
+    def test_process_project_fix(self):
+        snapcraft_file = os.path.join(self._folder, 'snapcraft.yaml')
+        shutil.copy(os.path.join(os.getcwd(), 'test_data', 'snapcraft.yaml'), snapcraft_file)
+        os.environ['CRAFT_PART_SRC'] = os.path.join(os.getcwd(), 'test_data', 'parts', 'main_test', 'src')
+        with contextlib.redirect_stdout(io.StringIO()):
+            test_doc_checker.process_project(test_doc_checker.Project(snapcraft_file), fix=True)
+        project = test_doc_checker.Project(snapcraft_file)
+        self.assertEqual(project.parts['harfbuzz']['meson-parameters'][-2:], ['-Dtests=disabled', '-Ddocs=disabled'])
+        self.assertEqual(test_doc_checker.find_missing_meson_options('harfbuzz', project), {})
+
+    def test_process_project_fix_empty_parameters(self):
+        snapcraft_file = os.path.join(self._folder, 'snapcraft.yaml')
+        with open(os.path.join(os.getcwd(), 'test_data', 'snapcraft.yaml'), 'r') as snapcraft_stream:
+            content = snapcraft_stream.read()
+        harfbuzz_parameters = """    meson-parameters:
+      - --prefix=/usr
+      - -Dgraphite2=enabled
+      - -Dintrospection=enabled
+      - -Dgobject=enabled
+      - -Doptimization=3
+      - -Ddebug=true
+      - --default-library=both
+"""
+        self.assertIn(harfbuzz_parameters, content)
+        with open(snapcraft_file, 'w') as snapcraft_stream:
+            snapcraft_stream.write(content.replace(harfbuzz_parameters, "    meson-parameters:\n"))
+        os.environ['CRAFT_PART_SRC'] = os.path.join(os.getcwd(), 'test_data', 'parts', 'main_test', 'src')
+        project = test_doc_checker.Project(snapcraft_file)
+        self.assertIsNone(project.parts['harfbuzz']['meson-parameters'])
+        self.assertEqual(test_doc_checker.find_meson_parameters_for_part('harfbuzz', project), {})
+        with contextlib.redirect_stdout(io.StringIO()):
+            test_doc_checker.process_project(project, fix=True)
+        project = test_doc_checker.Project(snapcraft_file)
+        self.assertEqual(project.parts['harfbuzz']['meson-parameters'],
+                         ['-Dtests=disabled', '-Dintrospection=enabled', '-Ddocs=disabled'])
+        self.assertEqual(test_doc_checker.find_missing_meson_options('harfbuzz', project), {})
+
+    def test_bare_parameter(self):
+        with open(self._path, 'w') as snapcraft_file:
+            snapcraft_file.write("parts:\n  bare:\n    plugin: meson\n    meson-parameters: [ -Dfoo, -Dbar=baz ]\n")
+        parameters = test_doc_checker.find_meson_parameters_for_part('bare', test_doc_checker.Project(self._path))
+        self.assertEqual(parameters, {'foo': '', 'bar': 'baz'})
+
 
 if __name__ == '__main__':
     unittest.main()